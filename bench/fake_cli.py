@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the btrfs, blkid, df, mount, umount, and sudo commands used
+by the benchmarks (see run_bench.py).  Invoked as "fake_cli.py NAME ARGS..."
+by the wrapper scripts that run_bench.py puts first on PATH.
+
+The synthetic "world" (devices and their subvolumes) is the JSON file
+named by $FAKE_BTRFS_WORLD; snapshot/delete commands update it (under
+an flock) so that a rediscovery sees the changes. Each command first
+sleeps $FAKE_BTRFS_LATENCY_MS to model slow disks/commands.
+"""
+# pylint: disable=invalid-name
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import contextlib
+
+WORLD = os.environ.get('FAKE_BTRFS_WORLD', '')
+
+@contextlib.contextmanager
+def world_locked(write=False):
+    """Yield the world (saving it afterward if write)."""
+    with open(WORLD, 'r+', encoding='utf-8') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        world = json.load(fh)
+        yield world
+        if write:
+            fh.seek(0)
+            fh.truncate()
+            json.dump(world, fh)
+
+def locate(world, path):
+    """Map a path to (device-dict, path relative to the top of its fs)."""
+    path = os.path.abspath(path)
+    tmp_dir = world['tmp_dir'].rstrip('/') + '/'
+    if path.startswith(tmp_dir):
+        dev, _, rel = path[len(tmp_dir):].partition('/')
+    else:
+        dev, rel = world['restore_dev'], os.path.relpath(path, world['mnt_dir'])
+    for device in world['devices']:
+        if device['dev'] == dev:
+            return device, '' if rel == '.' else rel
+    sys.exit(f'fake: no device for {path!r}')
+
+def sub_list(args):
+    with world_locked() as world:
+        device, _ = locate(world, args[-1])
+        for sub in device['subvols']:
+            print(f'ID {sub["id"]} gen {sub["gen"]} top level {sub["parent"]} path {sub["path"]}')
+
+def sub_snap(args):
+    args = [x for x in args if not x.startswith('-')]
+    src, dst = args[-2], args[-1]
+    with world_locked(write=True) as world:
+        device, rel = locate(world, dst)
+        parent = 5
+        top, _, _ = rel.partition('/')
+        for sub in device['subvols']:
+            if sub['path'] == top and top != rel:
+                parent = sub['id']
+        device['next_id'] += 1
+        device['generation'] += 1
+        device['subvols'].append({'id': device['next_id'], 'gen': device['generation'],
+                                  'parent': parent, 'path': rel, 'of': src})
+    if os.path.isdir(os.path.dirname(os.path.abspath(dst))):
+        os.makedirs(dst, exist_ok=True)
+
+def sub_del(args):
+    with world_locked(write=True) as world:
+        for path in [x for x in args if not x.startswith('-')]:
+            device, rel = locate(world, path)
+            subs = [x for x in device['subvols'] if x['path'] == rel]
+            if not subs:
+                sys.exit(f"ERROR: Could not statfs: No such file or directory: '{path}'")
+            device['subvols'].remove(subs[0])
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            print(f"Delete subvolume (no-commit): '{path}'")
+
+def sub_find_new(args):
+    """Some extents with generations spread from the given one to now."""
+    with world_locked() as world:
+        device, rel = locate(world, args[0])
+    first, last = int(args[1]), device['generation']
+    for idx in range(50):
+        gen = first + (last - first) * idx // 50
+        print(f'inode {257 + idx} file offset 0 len {(idx + 1) << 16} disk start'
+              f' {(idx + 1) << 24} offset 0 gen {gen} flags NONE {rel}/file{idx}')
+    print(f'transid marker was {last}')
+
+def fi_du(args):
+    raw = '--raw' in args
+    with world_locked() as world:
+        print('     Total   Exclusive  Set shared  Filename')
+        for arg in [x for x in args if not x.startswith('-')]:
+            device, rel = locate(world, arg)
+            names = [(arg, rel)]
+            if arg.endswith('/*'): # a relative glob the shell did not expand
+                prefix = rel[:-1]
+                names = [(x['path'], x['path']) for x in device['subvols']
+                         if x['path'].startswith(prefix)]
+            for name, rel in names:
+                size = 1 + sum(map(ord, rel)) % 997
+                if raw:
+                    print(f'{size * 10 << 20:>10} {size << 17:>10}           -  {name}')
+                else:
+                    print(f'{size * 10.0:>9.2f}MiB {size / 10.0:>9.2f}MiB           -  {name}')
+
+def fi_usage(args):
+    with world_locked() as world:
+        device = world['devices'][0]
+        for dev in world['devices']:
+            if dev.get('mount', '') == args[-1]:
+                device = dev
+    size = device['size']
+    data, meta, system = size * 6 // 10, size // 50, 8 * 1024 * 1024
+    print('Overall:')
+    print(f'    Device size:\t\t{size}')
+    print(f'    Device allocated:\t\t{data + 2 * meta + 2 * system}')
+    print(f'    Device unallocated:\t\t{size - data - 2 * meta - 2 * system}')
+    print(f'    Used:\t\t\t{data * 8 // 10 + meta}')
+    print('    Data ratio:\t\t\t      1.00')
+    print('    Metadata ratio:\t\t      2.00')
+    print(f'\nData,single: Size:{data}, Used:{data * 8 // 10} (80.00%)')
+    print(f'   /dev/{device["dev"]}\t{data}')
+    print(f'\nMetadata,DUP: Size:{meta}, Used:{meta // 2} (50.00%)')
+    print(f'   /dev/{device["dev"]}\t{2 * meta}')
+    print(f'\nSystem,DUP: Size:{system}, Used:16384 (0.20%)')
+    print(f'   /dev/{device["dev"]}\t{2 * system}')
+
+def fi_show(_args):
+    with world_locked() as world:
+        for device in world['devices']:
+            print(f"Label: '{device['label']}'  uuid: {device['uuid']}")
+            print(f"\tTotal devices 1 FS bytes used {device['size'] // 2}")
+            print(f"\tdevid    1 size {device['size']} used {device['size'] // 2}"
+                  f" path /dev/{device['dev']}\n")
+
+def send(args):
+    """A stand-in stream: a line naming the snapshot (and parent) and
+    then 256KiB (full) or 32KiB (incremental) of filler."""
+    parent = args[args.index('-p') + 1] if '-p' in args else ''
+    out = sys.stdout.buffer
+    out.write(f'{os.path.basename(args[-1])} {os.path.basename(parent)}\n'.encode())
+    out.write(b'x' * ((32 if parent else 256) << 10))
+
+def receive(args):
+    first = sys.stdin.buffer.readline().decode().split()
+    while sys.stdin.buffer.read(1 << 16):
+        pass
+    os.makedirs(os.path.join(args[-1], first[0]))
+    with open(os.path.join(args[-1], first[0], '.received'), 'w', encoding='utf-8') as fh:
+        fh.write('fake-received-uuid\n') # for "sub show" (set when complete)
+
+def sub_show(args):
+    """Just the received UUID (of a fake receive's destination)."""
+    marker = os.path.join(args[-1], '.received')
+    if not os.path.isdir(args[-1]):
+        sys.exit(f"ERROR: cannot find real path for '{args[-1]}'")
+    received = '-'
+    if os.path.isfile(marker):
+        with open(marker, 'r', encoding='utf-8') as fh:
+            received = fh.read().strip()
+    print(f'{os.path.basename(args[-1])}\n\tReceived UUID: \t\t{received}')
+
+def btrfs(args):
+    words = [x for x in args if x not in ('-b', '-q')]
+    if words[:1] == ['balance']:
+        return None
+    if words[:1] in (['send'], ['receive']):
+        return (send if words[0] == 'send' else receive)(words[1:])
+    groups = {'sub': 'sub', 'subvolume': 'sub', 'fi': 'fi', 'filesystem': 'fi'}
+    verbs = {('sub', 'list'): sub_list, ('sub', 'snapshot'): sub_snap,
+             ('sub', 'delete'): sub_del, ('sub', 'find-new'): sub_find_new,
+             ('sub', 'show'): sub_show,
+             ('fi', 'du'): fi_du,
+             ('fi', 'usage'): fi_usage, ('fi', 'show'): fi_show}
+    if len(words) >= 2 and words[0] in groups:
+        for (group, verb), func in verbs.items():
+            if groups[words[0]] == group and verb.startswith(words[1]):
+                return func(words[2:])
+    return sys.exit(f'fake btrfs: unsupported: {" ".join(args)}')
+
+def blkid(_args):
+    with world_locked() as world:
+        for device in world['devices']:
+            print(f'/dev/{device["dev"]}: LABEL="{device["label"]}" UUID="{device["uuid"]}"'
+                  f' UUID_SUB="{device["uuid"][::-1]}" BLOCK_SIZE="4096" TYPE="btrfs"')
+        print('/dev/fakeswap: UUID="0000-swap" TYPE="swap"')
+
+def df(args):
+    print('Filesystem      Size  Used Avail Use% Mounted on')
+    print(f'{args[-1]:<14}  954G  400G  552G  43% /')
+
+def main():
+    name, args = sys.argv[1], sys.argv[2:]
+    if name == 'sudo':
+        os.execvp(args[0], args)
+    time.sleep(float(os.environ.get('FAKE_BTRFS_LATENCY_MS', '0')) / 1000)
+    funcs = {'btrfs': btrfs, 'blkid': blkid, 'df': df,
+             'mount': lambda _: None, 'umount': lambda _: None}
+    funcs[name](args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for my-snaps, my-restore, and bt-smart-balance that need
+neither root nor real disks: stand-in btrfs/blkid/df/mount/umount/sudo
+commands (fake_cli.py) go first on PATH, and a synthetic world of N
+devices, each with M subvolumes having K snapshots per label, is
+generated along with a matching fake /proc/mounts and blkid cache.
+
+Each scenario (discovery, filtering, the snapshot replace/schedule/free/delete/du/changed
+actions, diff decoding, replication, my-restore's state and plan, balance stats) is run --repeat
+times on a fresh world; the wall times plus the per-phase and
+per-command breakdowns (from my_snaps.Profiler) go to a JSON file that
+--compare can diff against an earlier run. With --backend sim, the
+subvolume operations go to the in-memory simulator instead (i.e., to
+compare the cost of the tools' own logic with that of the commands).
+
+    python3 bench/run_bench.py -D2 -M8 -K8 -o /tmp/bench.json
+    python3 bench/run_bench.py -D2 -M8 -K8 -c /tmp/bench.json
+"""
+# pylint: disable=invalid-name,too-many-instance-attributes,too-many-locals
+# pylint: disable=wrong-import-position,protected-access
+import os
+import sys
+import json
+import atexit
+import time
+import shutil
+import struct
+import platform
+import argparse
+import tempfile
+import statistics
+import contextlib
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from my_snaps.Profiler import profiler
+from my_snaps.main import BTRFS, parse_schedule
+from my_snaps.my_restore import BtrfsRestore
+from my_snaps.bt_smart_balance import BtSmartBalance
+from my_snaps.MyUtils import find_btrfs_filesystems
+from my_snaps.Backends import SimBackend
+from my_snaps.SendStream import COMMANDS
+from my_snaps.snap_diff import run_diff
+from my_snaps.replicate import Replicator
+
+FAKES = ('btrfs', 'blkid', 'df', 'mount', 'umount', 'sudo')
+
+@contextlib.contextmanager
+def quiet():
+    """Silence stdout/stderr at the fd level (i.e., also of commands)."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + (devnull,):
+            os.close(fd)
+
+class Bench:
+    """ Generates the fake world and runs the scenarios. """
+    def __init__(self, opts):
+        self.opts = opts
+        self.work = tempfile.mkdtemp(prefix='my-snaps-bench-')
+        self.fakebin = os.path.join(self.work, 'bin')
+        self.world_path = os.path.join(self.work, 'world.json')
+        self.mounts_path = os.path.join(self.work, 'proc-mounts')
+        self.blkid_tab = os.path.join(self.work, 'blkid.tab')
+        self.tmp_dir = os.path.join(self.work, 'btrfs') + '/'
+        self.mnt_dir = os.path.join(self.work, 'mnt')
+        self.labels = ['Daily', 'Weekly', 'Monthly', 'Update', 'Manual'][:opts.labels] or ['']
+        self.results = {}
+        self.sim = None # the SimBackend matching the world (if --backend sim)
+
+    def make_fakebin(self):
+        """Write the wrapper scripts and put them first on PATH."""
+        os.makedirs(self.fakebin)
+        fake_cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_cli.py')
+        for name in FAKES:
+            pathname = os.path.join(self.fakebin, name)
+            with open(pathname, 'w', encoding='utf-8') as fh:
+                fh.write(f'#!/bin/sh\nexec {sys.executable} {fake_cli} {name} "$@"\n')
+            os.chmod(pathname, 0o755)
+        os.environ['PATH'] = self.fakebin + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_BTRFS_WORLD'] = self.world_path
+        os.environ['FAKE_BTRFS_LATENCY_MS'] = str(self.opts.latency_ms)
+
+    def make_world(self):
+        """(Re)generate the world, /proc/mounts, the blkid cache, and the
+        directories of the subvolumes of the device my-restore mounts."""
+        opts, devices, mounts, tabs = self.opts, [], [], []
+        now = datetime.now()
+        for d in range(opts.devices):
+            dev = f'fake{d}'
+            subvols, ident = [], 255
+            def add(path, parent=5):
+                nonlocal ident
+                ident += 1
+                subvols.append({'id': ident, 'gen': ident * 7, 'parent': parent, 'path': path})
+                return ident
+            snaps_id = add('eos@snapshots')
+            for m in range(opts.subvols):
+                sub_id = add(f'eos@sub{m}')
+                mount = '/' if (d, m) == (0, 0) else f'/vol{d}/sub{m}'
+                mounts.append(f'/dev/{dev} {mount} btrfs rw,relatime,ssd,'
+                              f'subvolid={sub_id},subvol=/eos@sub{m} 0 0')
+                for label in self.labels:
+                    for k in range(opts.snaps):
+                        when = now - timedelta(days=k + 1, minutes=m + 7 * len(label))
+                        add(f'eos@snapshots/eos@sub{m}.{when.strftime("%Y-%m-%d-%H%M%S")}'
+                            + (f'={label}' if label else ''), parent=snaps_id)
+            if d == 0:
+                mounts.append(f'/dev/{dev} /.snapshots btrfs rw,relatime,ssd,'
+                              f'subvolid={snaps_id},subvol=/eos@snapshots 0 0')
+            uuid = f'{d:08x}-0000-4000-8000-{d:012x}'
+            devices.append({'dev': dev, 'label': f'pool{d}', 'uuid': uuid,
+                            'size': (500 + 100 * d) << 30, 'mount': '/' if d == 0 else '',
+                            'subvols': subvols, 'next_id': ident, 'generation': ident * 7})
+            tabs.append(f'<device DEVNO="0x08{d:02x}" LABEL="pool{d}" UUID="{uuid}"'
+                        f' TYPE="btrfs">/dev/{dev}</device>')
+        mounts.append('proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0')
+        world = {'tmp_dir': self.tmp_dir, 'mnt_dir': self.mnt_dir,
+                 'restore_dev': 'fake0', 'devices': devices}
+        with open(self.world_path, 'w', encoding='utf-8') as fh:
+            json.dump(world, fh)
+        with open(self.mounts_path, 'w', encoding='utf-8') as fh:
+            fh.write('\n'.join(mounts) + '\n')
+        with open(self.blkid_tab, 'w', encoding='utf-8') as fh:
+            fh.write('\n'.join(tabs) + '\n')
+        shutil.rmtree(self.mnt_dir, ignore_errors=True)
+        for sub in devices[0]['subvols']:
+            if '/' not in sub['path']:
+                os.makedirs(os.path.join(self.mnt_dir, sub['path']))
+        if self.opts.backend == 'sim':
+            self.make_sim(world, mounts)
+        return world
+
+    def make_sim(self, world, mounts):
+        """A SimBackend with the same subvolumes (and IDs) as the world;
+        my-restore's /mnt is the top of the first device."""
+        self.sim = SimBackend(latency=self.opts.latency_ms / 1000)
+        mount_of = {} # (dev, subvolid) => mount point
+        for line in mounts:
+            wds = line.split()
+            if 'subvolid=' in wds[3]:
+                ident = int(wds[3].split('subvolid=')[1].split(',')[0])
+                mount_of[(os.path.basename(wds[0]), ident)] = wds[1]
+        for device in world['devices']:
+            fs = self.sim.add_filesystem(os.path.join(self.tmp_dir, device['dev']))
+            fs.next_id = device['subvols'][0]['id'] - 1
+            for sub in device['subvols']:
+                self.sim.add_subvol(os.path.join(fs.top, sub['path']),
+                                    mount=mount_of.get((device['dev'], sub['id']), ''))
+        self.sim.mounts[self.mnt_dir] = (os.path.join(self.tmp_dir, 'fake0'), '')
+
+    def measure(self, name, func, setup=None):
+        """Run func(setup()) --repeat times; record the wall times and the
+        phase/command breakdown of the median run."""
+        runs = []
+        for _ in range(self.opts.repeat):
+            arg = setup() if setup else None
+            profiler.events = []
+            cwd = os.getcwd()
+            with quiet():
+                start = time.perf_counter()
+                func(arg)
+                wall = (time.perf_counter() - start) * 1000
+            os.chdir(cwd)
+            runs.append((wall, list(profiler.events)))
+        runs.sort(key=lambda x: x[0])
+        walls = [x[0] for x in runs]
+        phases, commands = {}, {}
+        for event in runs[len(runs) // 2][1]:
+            bucket = phases if event['cat'] == 'phase' else commands
+            ns = bucket.setdefault(event['name'], {'count': 0, 'wall_ms': 0.0})
+            ns['count'] += 1
+            ns['wall_ms'] = round(ns['wall_ms'] + event['dur'] / 1000, 3)
+        self.results[name] = {
+            'wall_ms': {'min': round(walls[0], 3), 'median': round(statistics.median(walls), 3),
+                        'max': round(walls[-1], 3)},
+            'runs': len(walls), 'phases': phases, 'commands': commands}
+        print(f'{name:<28} median={statistics.median(walls):10.1f}ms'
+              f'  commands={sum(x["count"] for x in commands.values()):5}', flush=True)
+
+    def new_btrfs(self, refresh=True):
+        """A BTRFS (i.e., my-snaps) on a fresh world, discovered if refresh."""
+        self.make_world()
+        opts = SimpleNamespace(DB=False, add_snap_max=0, metrics_file='')
+        btrfs = BTRFS(opts)
+        atexit.unregister(btrfs.umount_tmps) # nothing is really mounted
+        btrfs.backend = self.sim or btrfs.backend
+        btrfs.tmp_dir, btrfs.proc_mounts = self.tmp_dir, self.mounts_path
+        if refresh:
+            with quiet():
+                btrfs._refresh_if_dirty()
+        return btrfs
+
+    def run_my_snaps(self):
+        """Discovery, filtering, and the snapshot actions of my-snaps."""
+        def discover(btrfs):
+            btrfs._refresh_if_dirty()
+        self.measure('my-snaps.discover', discover, setup=lambda: self.new_btrfs(refresh=False))
+
+        def filter_rows(btrfs):
+            for expr in ('sub1', f'={self.labels[0].lower()} >2d', 'zzz', ''):
+                btrfs.filter_str = expr
+                btrfs.filter_rows()
+        self.measure('my-snaps.filter', filter_rows, setup=self.new_btrfs)
+
+        def replace(btrfs):
+            btrfs.add_limit, btrfs.label = self.opts.snaps, f'={self.labels[0]}'
+            btrfs._replace_eldest_snaps()
+        self.measure('my-snaps.replace_eldest', replace, setup=self.new_btrfs)
+
+        def schedule(btrfs): # every period due; pruned to one less than held
+            btrfs._run_schedule(parse_schedule(','.join(
+                f'{x}/1s={max(1, self.opts.snaps - 1)}' for x in self.labels if x)))
+        self.measure('my-snaps.schedule', schedule, setup=self.new_btrfs)
+
+        def free_target(btrfs): # more than there is; so, all but the newest per label
+            btrfs._free_target(1 << 50, {'*': 1}, yes=True)
+        self.measure('my-snaps.free_target', free_target, setup=self.new_btrfs)
+
+        def rediscover(btrfs):
+            btrfs._refresh_if_dirty()
+        def after_replace():
+            btrfs = self.new_btrfs()
+            btrfs.add_limit, btrfs.label = self.opts.snaps, f'={self.labels[0]}'
+            with quiet():
+                btrfs._replace_eldest_snaps()
+            return btrfs
+        self.measure('my-snaps.rediscover', rediscover, setup=after_replace)
+
+        def disk_usage(btrfs):
+            btrfs._get_disk_usage()
+        self.measure('my-snaps.disk_usage', disk_usage, setup=self.new_btrfs)
+
+        def changed(btrfs):
+            btrfs._get_changed()
+        self.measure('my-snaps.changed', changed, setup=self.new_btrfs)
+
+    def new_restore(self):
+        """A BtrfsRestore (i.e., my-restore) on a fresh world."""
+        self.make_world()
+        BtrfsRestore.proc_mounts = self.mounts_path
+        restore = BtrfsRestore()
+        restore.backend = self.sim or restore.backend
+        restore.filesystems = find_btrfs_filesystems(sysfs=self.work, udev_dir=self.work,
+                                                     blkid_tabs=(self.blkid_tab,))
+        return restore
+
+    def run_my_restore(self):
+        """Filesystem discovery, state scan, and restore plan of my-restore."""
+        self.measure('my-restore.find_fs.blkid_tab', lambda _: find_btrfs_filesystems(
+                sysfs=self.work, udev_dir=self.work, blkid_tabs=(self.blkid_tab,)),
+                setup=self.make_world)
+        self.measure('my-restore.find_fs.cli', lambda _: find_btrfs_filesystems(
+                sysfs=self.work, udev_dir=self.work, blkid_tabs=()), setup=self.make_world)
+
+        def get_state(restore):
+            os.chdir(self.mnt_dir)
+            restore.make_actions(restore.get_state())
+        self.measure('my-restore.get_state', get_state, setup=self.new_restore)
+
+        def run_plan(restore):
+            os.chdir(self.mnt_dir)
+            subs = restore.get_state()
+            actions = restore.make_actions(subs)
+            plan = [restore.resolve_restore(f'{x}=latest:{self.labels[0]}', subs, actions)
+                    for x in subs]
+            assert restore.run_plan(plan)
+        self.measure('my-restore.run_plan', run_plan, setup=self.new_restore)
+
+    def make_send_stream(self, nfiles):
+        """A "btrfs send --no-data -p" stream changing nfiles files: for
+        each, a new file (w/ its orphan name), a modified one, a renamed
+        one, and a deleted one; returns its pathname."""
+        codes = {name: code for code, name in COMMANDS.items()}
+        def command(name, *attrs):
+            payload = b''
+            for kind, value in attrs:
+                value = value.encode() if isinstance(value, str) else struct.pack('<Q', value)
+                payload += struct.pack('<HH', kind, len(value)) + value
+            return struct.pack('<IHI', len(payload), codes[name], 0) + payload
+        pathname = os.path.join(self.work, 'send.stream')
+        with open(pathname, 'wb') as fh:
+            fh.write(b'btrfs-stream\0' + struct.pack('<I', 1))
+            fh.write(command('snapshot', (15, 'new')))
+            for idx in range(nfiles):
+                folder, orphan = f'usr/share/d{idx % 97}', f'o{1000 + idx}-9-0'
+                fh.write(command('mkfile', (15, orphan)))
+                fh.write(command('rename', (15, orphan), (16, f'{folder}/new{idx}')))
+                fh.write(command('update_extent', (15, f'{folder}/mod{idx}'), (18, 0), (4, 4096)))
+                fh.write(command('chown', (15, f'{folder}/mod{idx}')))
+                fh.write(command('rename', (15, f'{folder}/a{idx}'), (16, f'{folder}/b{idx}')))
+                fh.write(command('unlink', (15, f'{folder}/old{idx}')))
+                fh.write(command('utimes', (15, folder)))
+            fh.write(command('end'))
+        return pathname
+
+    def run_diff(self):
+        """Decoding a snapshot-to-snapshot diff stream."""
+        nfiles = 1000 * self.opts.subvols * self.opts.snaps
+        stream = self.make_send_stream(nfiles)
+        for by_dir in (0, 1):
+            opts = SimpleNamespace(old='', new='', stream=stream, by_dir=by_dir)
+            with open(os.devnull, 'w', encoding='utf-8') as out:
+                self.measure(f'my-snaps.diff{"_by_dir" if by_dir else ""}',
+                             lambda _, opts=opts, out=out: run_diff(opts, out=out))
+
+    def run_replicate(self):
+        """Replicating the snapshots of the first device (all new, then
+        a rerun with nothing new)."""
+        src, dst = os.path.join(self.work, 'rep-src'), os.path.join(self.work, 'rep-dst')
+        def fresh():
+            world = self.make_world()
+            for folder in (src, dst):
+                shutil.rmtree(folder, ignore_errors=True)
+                os.makedirs(folder)
+            for sub in world['devices'][0]['subvols']:
+                if '/' in sub['path']:
+                    os.makedirs(os.path.join(src, os.path.basename(sub['path'])))
+            return Replicator(src, dst, jobs=4, say=lambda _: None)
+        def replicate(replicator):
+            done, wanted = replicator.run()
+            assert done == wanted
+        self.measure('my-snaps.replicate', replicate, setup=fresh)
+        def replicated():
+            replicator = fresh()
+            replicator.run()
+            return Replicator(src, dst, jobs=4, say=lambda _: None)
+        self.measure('my-snaps.replicate_rerun', replicate, setup=replicated)
+
+    def run_balance(self):
+        """Stats retrieval and parsing of bt-smart-balance."""
+        def new_balance():
+            self.make_world()
+            opts = SimpleNamespace(mount_point='/', stats='cli', allocated_pct_min=70,
+                                   wasted_pct_min=7, meta_wasted_pct_min=5)
+            return BtSmartBalance(opts)
+        self.measure('bt-smart-balance.get_usage', lambda x: x.get_usage(), setup=new_balance)
+
+        def parse(balance):
+            for _ in range(1000):
+                balance.parse_usage_data(balance.usage_text)
+        def with_text():
+            balance = new_balance()
+            with quiet():
+                balance.usage_text = balance.get_bt_usage()
+            return balance
+        self.measure('bt-smart-balance.parse_x1000', parse, setup=with_text)
+
+    def run(self):
+        """Run all the scenarios; returns the results document."""
+        self.make_fakebin()
+        profiler.start(os.devnull) # for the breakdowns; no trace file
+        try:
+            self.run_my_snaps()
+            self.run_my_restore()
+            self.run_diff()
+            self.run_replicate()
+            self.run_balance()
+        finally:
+            profiler.enabled = False
+            shutil.rmtree(self.work, ignore_errors=True)
+        return {'version': 1, 'created': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(), 'host': platform.node(),
+                'params': {'devices': self.opts.devices, 'subvols': self.opts.subvols,
+                           'snaps': self.opts.snaps, 'labels': len(self.labels),
+                           'latency_ms': self.opts.latency_ms, 'repeat': self.opts.repeat,
+                           'backend': self.opts.backend},
+                'results': self.results}
+
+def compare(old, new):
+    """Print the median wall times of two results documents side by side."""
+    if old.get('params') != new.get('params'):
+        print(f'NOTE: params differ: old={old.get("params")} new={new.get("params")}')
+    print(f'{"scenario":<28} {"old_ms":>10} {"new_ms":>10} {"ratio":>7}')
+    for name, result in new['results'].items():
+        was = old.get('results', {}).get(name, None)
+        now_ms = result['wall_ms']['median']
+        if not was:
+            print(f'{name:<28} {"-":>10} {now_ms:>10.1f}')
+            continue
+        was_ms = was['wall_ms']['median']
+        ratio = now_ms / was_ms if was_ms else 0
+        print(f'{name:<28} {was_ms:>10.1f} {now_ms:>10.1f} {ratio:>6.2f}x')
+
+def main():
+    """ Entry point """
+    parser = argparse.ArgumentParser(description='my-snaps benchmarks on a fake btrfs')
+    parser.add_argument('-D', '--devices', type=int, default=2,
+            help='number of BTRFS devices [dflt=2]')
+    parser.add_argument('-M', '--subvols', type=int, default=8,
+            help='top-level subvolumes per device [dflt=8]')
+    parser.add_argument('-K', '--snaps', type=int, default=8,
+            help='snapshots per subvolume per label [dflt=8]')
+    parser.add_argument('-L', '--labels', type=int, default=2,
+            help='snapshot labels (of Daily, Weekly, Monthly, Update, Manual) [dflt=2]')
+    parser.add_argument('-l', '--latency-ms', type=float, default=0,
+            help='added latency of each fake command [dflt=0]')
+    parser.add_argument('-B', '--backend', choices=('cli', 'sim'), default='cli',
+            help='subvolume operations via the fake "btrfs" command or the'
+                 ' in-memory simulator (w/ the same latency) [dflt=cli]')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='runs per scenario (the median is reported) [dflt=3]')
+    parser.add_argument('-o', '--output', type=str, default='',
+            help='write the results as JSON to this file')
+    parser.add_argument('-c', '--compare', type=str, default='',
+            help='compare with the results in this earlier JSON file')
+    opts = parser.parse_args()
+    opts.devices, opts.repeat = max(1, opts.devices), max(1, opts.repeat)
+    opts.subvols = max(1, opts.subvols)
+
+    results = Bench(opts).run()
+    if opts.output:
+        with open(opts.output, 'w', encoding='utf-8') as fh:
+            json.dump(results, fh, indent=2)
+        print(f'wrote {opts.output!r}')
+    if opts.compare:
+        with open(opts.compare, 'r', encoding='utf-8') as fh:
+            compare(json.load(fh), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+Storage backends: the few BTRFS operations the tools need, i.e.,
+  - list_subvols(top): the subvolumes of the filesystem holding 'top'
+  - snapshot(src, dst, readonly): snapshot subvolume src as dst
+  - delete(path): delete a subvolume
+  - delete_many(paths): delete several subvolumes (batched if possible)
+  - rename(src, dst): rename a subvolume
+  - usage(paths): the total/exclusive bytes of the given subvolumes
+  - qgroup_usage(top): the exclusive bytes per subvolume ID when quotas
+    are enabled (a cheap alternative to usage())
+  - changed_extents(path, gen): the bytes of the extents of a subvolume
+    written after a generation (e.g., that of a snapshot of it)
+with implementations for
+  - CliBackend: runs the "btrfs" command (the default),
+  - IoctlBackend: calls the kernel directly (no process per operation),
+  - SimBackend: an in-memory model (subvolume trees, generations, and
+    latency) for tests and benchmarks w/o root or disks.
+All paths are absolute (or relative to the current directory), and
+failures raise BackendError.
+"""
+# pylint: disable=invalid-name,too-many-arguments,too-few-public-methods
+# pylint: disable=consider-using-with
+import os
+import re
+import time
+import errno
+import struct
+import threading
+import subprocess
+from types import SimpleNamespace
+
+class BackendError(Exception):
+    """ A failed operation; has the command (or operation), its exit
+    code (or errno), and any output lines (for the user). """
+    def __init__(self, command, code, output=None):
+        self.command, self.code = command, code
+        self.output = output or []
+        super().__init__(f'FAILED({code}): {command}'
+                         + (f': {self.output[-1]}' if self.output else ''))
+
+def subvol_ns(ident, gen, parent, path):
+    """ A listed subvolume; path is relative to the top-level (e.g.,
+    '@snapshots/@root.2024-01-13-093817=Daily')."""
+    return SimpleNamespace(ident=ident, gen=gen, parent=parent, path=path)
+
+class Backend:
+    """ The interface; see the module docstring. """
+    name = ''
+
+    def list_subvols(self, top):
+        """ All subvolumes of the filesystem (as subvol_ns)."""
+        raise NotImplementedError
+
+    def snapshot(self, src, dst, readonly=True):
+        """ Snapshot the subvolume 'src' as 'dst' (read-only by default)."""
+        raise NotImplementedError
+
+    def delete(self, path):
+        """ Delete the subvolume 'path'."""
+        raise NotImplementedError
+
+    def delete_many(self, paths):
+        """ Delete the subvolumes in order (e.g., nested ones first)."""
+        for path in paths:
+            self.delete(path)
+
+    def rename(self, src, dst):
+        """ Rename a subvolume (just a directory rename in BTRFS)."""
+        try:
+            os.rename(src, dst)
+        except OSError as exc:
+            raise BackendError(f'mv "{src}" "{dst}"', exc.errno, [str(exc)]) from exc
+
+    def usage(self, paths):
+        """ {path: ns(total, exclusive)} in bytes for the given subvolumes."""
+        raise NotImplementedError
+
+    def qgroup_usage(self, top):
+        """ {subvolume ID: exclusive bytes} per the level-0 qgroups of the
+        filesystem holding 'top'; empty if quotas are not enabled."""
+        return {}
+
+    def changed_extents(self, path, gen):
+        """ {generation: bytes} of the file extents of subvolume 'path'
+        written after generation 'gen'; so, the bytes changed since a
+        snapshot of generation G is the sum of the values with keys > G
+        (i.e., one scan serves all the snapshots of the subvolume)."""
+        raise NotImplementedError
+
+class CliBackend(Backend):
+    """ Runs the "btrfs" command for each operation. """
+    name = 'cli'
+    du_batch = 200 # paths per "btrfs fi du/sub del" to bound the command length
+
+    @staticmethod
+    def run(args):
+        """ Run a command; returns its output lines or raises BackendError."""
+        proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        out = proc.stdout.decode('utf-8', 'replace').splitlines()
+        if proc.returncode:
+            err = proc.stderr.decode('utf-8', 'replace').splitlines()
+            raise BackendError(' '.join(args), proc.returncode, out + err)
+        return out
+
+    def list_subvols(self, top):
+        rv = []
+        for line in self.run(['btrfs', 'sub', 'list', top]):
+            # ID 782 gen 216849 top level 699 path eos@snapshots/eos@root.2024-01-10-174732=Update
+            wds = line.split(maxsplit=8)
+            if len(wds) < 9 or wds[0] != 'ID':
+                continue
+            rv.append(subvol_ns(int(wds[1]), int(wds[3]), int(wds[6]), wds[8]))
+        return rv
+
+    def snapshot(self, src, dst, readonly=True):
+        self.run(['btrfs', 'sub', 'snap'] + (['-r'] if readonly else []) + [src, dst])
+
+    def delete(self, path):
+        self.run(['btrfs', 'sub', 'del', path])
+
+    def delete_many(self, paths):
+        for idx in range(0, len(paths), self.du_batch):
+            self.run(['btrfs', 'sub', 'del'] + paths[idx:idx+self.du_batch])
+
+    def usage(self, paths):
+        rv = {}
+        for idx in range(0, len(paths), self.du_batch):
+            lines = self.run(['btrfs', 'fi', 'du', '-s', '--raw'] + paths[idx:idx+self.du_batch])
+            for line in lines[1:]: # after the header
+                wds = line.strip().split(maxsplit=3)
+                if len(wds) == 4 and wds[0].isdigit() and wds[1].isdigit():
+                    rv[wds[3]] = SimpleNamespace(total=int(wds[0]), exclusive=int(wds[1]))
+        return rv
+
+    def qgroup_usage(self, top):
+        try:
+            lines = self.run(['btrfs', 'qgroup', 'show', '--raw', top])
+        except BackendError: # i.e., quotas not enabled
+            return {}
+        rv = {}
+        for line in lines: # 0/256  12345678  40960  eos@root
+            mat = re.match(r'^0/(\d+)\s+(\d+)\s+(\d+)', line.strip())
+            if mat:
+                rv[int(mat.group(1))] = int(mat.group(3))
+        return rv
+
+    def changed_extents(self, path, gen):
+        rv = {}
+        # inode 257 file offset 0 len 4096 disk start 13631488 offset 0 gen 9 flags NONE a.txt
+        pattern = re.compile(r'\blen (\d+) .*\bgen (\d+) ')
+        for line in self.run(['btrfs', 'sub', 'find-new', path, str(gen + 1)]):
+            mat = pattern.search(line)
+            if mat:
+                found = int(mat.group(2))
+                rv[found] = rv.get(found, 0) + int(mat.group(1))
+        return rv
+
+class IoctlBackend(CliBackend):
+    """ Calls the BTRFS ioctls directly for listing, snapshots, deletes,
+    and changed extents (saving a fork/exec of "btrfs" per operation);
+    usage still comes from "btrfs fi du" as it needs no special
+    privileges to compute that way w/o quotas. """
+    name = 'ioctl'
+    MAGIC = 0x94
+    ARGS_SIZE = 4096 # all of the args structs used are 4KiB
+    SEARCH_KEY = struct.Struct('=QQQQQQQIIII32x') # btrfs_ioctl_search_key (104 bytes)
+    SEARCH_HEADER = struct.Struct('=QQQII') # transid, objectid, offset, type, len
+    ROOT_TREE_OBJECTID, FS_TREE_OBJECTID, LAST_FREE_OBJECTID = 1, 5, (1 << 64) - 256
+    ROOT_ITEM_KEY, ROOT_REF_KEY, EXTENT_DATA_KEY = 132, 156, 108
+    FILE_EXTENT_INLINE = 0
+    SUBVOL_RDONLY = 1 << 1
+
+    @classmethod
+    def _iowr(cls, nr, write_only=False):
+        direction = 1 if write_only else 3 # _IOC_WRITE or _IOC_READ|_IOC_WRITE
+        return (direction << 30) | (cls.ARGS_SIZE << 16) | (cls.MAGIC << 8) | nr
+
+    def _ioctl(self, fd, nr, buf, what, write_only=False):
+        import fcntl
+        try:
+            return fcntl.ioctl(fd, self._iowr(nr, write_only), buf)
+        except OSError as exc:
+            raise BackendError(what, exc.errno, [os.strerror(exc.errno)]) from exc
+
+    @staticmethod
+    def _open_dir(path):
+        try:
+            return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as exc:
+            raise BackendError(f'open {path}', exc.errno, [str(exc)]) from exc
+
+    def _ino_lookup(self, fd, tree_id, dirid):
+        """ The path of directory 'dirid' within subvolume 'tree_id'
+        (BTRFS_IOC_INO_LOOKUP); '' for its top directory."""
+        buf = bytearray(struct.pack('=QQ', tree_id, dirid) + bytes(self.ARGS_SIZE - 16))
+        self._ioctl(fd, 18, buf, f'INO_LOOKUP {tree_id}:{dirid}')
+        return bytes(buf[16:]).split(b'\0', 1)[0].decode('utf-8', 'replace')
+
+    def _search(self, fd, tree_id, min_type, max_type, min_objectid=0, min_transid=0):
+        """ Yield (header, data) of the items of a tree (BTRFS_IOC_TREE_SEARCH);
+        tree_id 0 is the tree of the subvolume of fd.  With min_transid,
+        only items in tree blocks written since that transaction are seen."""
+        min_offset = 0
+        while True:
+            key = self.SEARCH_KEY.pack(tree_id, min_objectid, self.LAST_FREE_OBJECTID,
+                                       min_offset, (1 << 64) - 1, min_transid, (1 << 64) - 1,
+                                       min_type, max_type, 4096, 0)
+            buf = bytearray(key + bytes(self.ARGS_SIZE - len(key)))
+            self._ioctl(fd, 17, buf, f'TREE_SEARCH {tree_id}')
+            nr_items = self.SEARCH_KEY.unpack_from(buf)[9]
+            if not nr_items:
+                return
+            pos, header = self.SEARCH_KEY.size, None
+            for _ in range(nr_items):
+                header = self.SEARCH_HEADER.unpack_from(buf, pos)
+                pos += self.SEARCH_HEADER.size
+                yield header, bytes(buf[pos:pos + header[4]])
+                pos += header[4]
+            # continue after the last key returned; keys compare as whole
+            # (objectid, type, offset) tuples, so all three advance
+            _, objectid, offset, item_type, _ = header
+            if offset < (1 << 64) - 1:
+                min_objectid, min_type, min_offset = objectid, item_type, offset + 1
+            elif item_type < 255:
+                min_objectid, min_type, min_offset = objectid, item_type + 1, 0
+            elif objectid < self.LAST_FREE_OBJECTID:
+                min_objectid, min_type, min_offset = objectid + 1, 0, 0
+            else:
+                return
+
+    def list_subvols(self, top):
+        fd = self._open_dir(top)
+        try:
+            gens, refs = {}, {} # id => generation, id => (parent, dirid, name)
+            for header, data in self._search(fd, self.ROOT_TREE_OBJECTID,
+                                              self.ROOT_ITEM_KEY, self.ROOT_REF_KEY):
+                _, objectid, offset, item_type, _ = header
+                if item_type == self.ROOT_ITEM_KEY and len(data) >= 168:
+                    gens[objectid] = struct.unpack_from('=Q', data, 160)[0]
+                elif item_type == self.ROOT_REF_KEY:
+                    dirid, _, name_len = struct.unpack_from('=QQH', data)
+                    refs[offset] = (objectid, dirid, data[18:18 + name_len].decode('utf-8', 'replace'))
+            paths = {self.FS_TREE_OBJECTID: ''}
+            def path_of(ident):
+                if ident not in paths:
+                    parent, dirid, name = refs[ident]
+                    if parent not in paths and parent not in refs:
+                        paths[ident] = name # parent gone (e.g., being deleted); as is
+                        return name
+                    try:
+                        folder = self._ino_lookup(fd, parent, dirid)
+                    except BackendError: # e.g., the parent is being deleted
+                        folder = ''
+                    paths[ident] = os.path.join(path_of(parent), folder, name).lstrip('/')
+                return paths[ident]
+            return [subvol_ns(x, gens.get(x, 0), refs[x][0], path_of(x)) for x in sorted(refs)]
+        finally:
+            os.close(fd)
+
+    def changed_extents(self, path, gen):
+        """ As "btrfs sub find-new": walk the file extent items of tree
+        blocks newer than gen and keep those whose own generation is."""
+        fd = self._open_dir(path)
+        try:
+            rv = {}
+            for header, data in self._search(fd, 0, self.EXTENT_DATA_KEY, self.EXTENT_DATA_KEY,
+                                              min_transid=gen + 1):
+                # the key range spans other item types between inodes
+                if header[3] != self.EXTENT_DATA_KEY or len(data) < 21:
+                    continue
+                # btrfs_file_extent_item: generation, ram_bytes, compression,
+                #   encryption, other_encoding(u16), type(u8), then for
+                #   non-inline: disk_bytenr, disk_num_bytes, offset, num_bytes
+                found, ram_bytes = struct.unpack_from('=QQ', data)
+                if found <= gen:
+                    continue
+                if data[20] == self.FILE_EXTENT_INLINE:
+                    nbytes = ram_bytes
+                elif len(data) >= 53:
+                    nbytes = struct.unpack_from('=Q', data, 45)[0]
+                else:
+                    continue
+                rv[found] = rv.get(found, 0) + nbytes
+            return rv
+        finally:
+            os.close(fd)
+
+    def snapshot(self, src, dst, readonly=True):
+        what = f'SNAP_CREATE_V2 {src} {dst}'
+        src_fd = self._open_dir(src)
+        try:
+            dst_fd = self._open_dir(os.path.dirname(os.path.abspath(dst)))
+            try:
+                name = os.path.basename(dst).encode('utf-8')
+                # btrfs_ioctl_vol_args_v2: fd, transid, flags, unused[4], name[4040]
+                buf = struct.pack('=qQQ32x', src_fd, 0, self.SUBVOL_RDONLY if readonly else 0)
+                buf += name + bytes(self.ARGS_SIZE - len(buf) - len(name))
+                self._ioctl(dst_fd, 23, bytearray(buf), what, write_only=True)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def delete(self, path):
+        fd = self._open_dir(os.path.dirname(os.path.abspath(path)))
+        try:
+            name = os.path.basename(path).encode('utf-8')
+            # btrfs_ioctl_vol_args: fd, name[4088]
+            buf = struct.pack('=q', 0) + name + bytes(self.ARGS_SIZE - 8 - len(name))
+            self._ioctl(fd, 15, bytearray(buf), f'SNAP_DESTROY {path}', write_only=True)
+        finally:
+            os.close(fd)
+
+class SimBackend(Backend):
+    """ An in-memory model of BTRFS filesystems for tests/benchmarks.
+    Each filesystem has a 'top' (where its top-level subvolume is
+    reachable; e.g., /tmp/.btrfs/sda2) and optional mount points of its
+    subvolumes. Each subvolume has an ID, parent ID, generation (the
+    filesystem's transaction counter when last changed), a size, and
+    the bytes written per generation (see write()).  Operations sleep 'latency' seconds, are serialized per backend,
+    and are counted in 'ops'. """
+    name = 'sim'
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.filesystems = {} # top => ns(top, generation, next_id, subvols={rel-path: ns})
+        self.mounts = {} # mount point => (top, rel-path)
+        self.ops = {} # op name => count
+
+    def add_filesystem(self, top):
+        """ Add an empty filesystem; returns its namespace."""
+        top = os.path.abspath(top)
+        self.filesystems[top] = SimpleNamespace(top=top, generation=10, next_id=256, subvols={})
+        return self.filesystems[top]
+
+    def add_subvol(self, path, size=1 << 30, mount=''):
+        """ Create a subvolume (e.g., while setting up a scenario)."""
+        fs, rel = self._locate(path)
+        self._create(fs, rel, size=size)
+        if mount:
+            self.mounts[mount] = (fs.top, rel)
+
+    def write(self, path, nbytes):
+        """ Model writing nbytes of new extents to subvolume 'path'."""
+        with self.lock:
+            fs, rel = self._locate(path)
+            ns = fs.subvols[rel]
+            fs.generation += 1
+            ns.gen = fs.generation
+            ns.writes[ns.gen] = ns.writes.get(ns.gen, 0) + nbytes
+
+    def _op(self, name):
+        self.ops[name] = self.ops.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _locate(self, path):
+        """ (filesystem ns, path relative to its top) for a path that is
+        under a mount point or a top (the longest match wins)."""
+        path = os.path.abspath(path)
+        best = None
+        for mount, (top, rel) in self.mounts.items():
+            if path == mount or path.startswith(mount.rstrip('/') + '/'):
+                if not best or len(mount) > len(best[0]):
+                    best = (mount, top, os.path.join(rel, path[len(mount):].lstrip('/')))
+        for top in self.filesystems:
+            if path == top or path.startswith(top + '/'):
+                if not best or len(top) > len(best[0]):
+                    best = (top, top, path[len(top):].lstrip('/'))
+        if not best:
+            raise BackendError(f'locate {path}', errno.ENOENT, ['not in any filesystem'])
+        return self.filesystems[best[1]], best[2].rstrip('/')
+
+    @staticmethod
+    def _parent_of(fs, rel):
+        """ The ID of the innermost subvolume containing rel."""
+        folder = os.path.dirname(rel)
+        while folder:
+            if folder in fs.subvols:
+                return fs.subvols[folder].ident
+            folder = os.path.dirname(folder)
+        return 5
+
+    def _create(self, fs, rel, size, readonly=False, origin=None):
+        if rel in fs.subvols:
+            raise BackendError(f'create {rel}', errno.EEXIST, [f"ERROR: target path already exists: {rel}"])
+        fs.generation += 1
+        fs.next_id += 1
+        fs.subvols[rel] = SimpleNamespace(ident=fs.next_id, gen=fs.generation,
+                parent=self._parent_of(fs, rel), path=rel, size=size,
+                readonly=readonly, origin=origin, ogen=fs.generation, writes={})
+        return fs.subvols[rel]
+
+    def list_subvols(self, top):
+        with self.lock:
+            self._op('list')
+            fs, _ = self._locate(top)
+            return [subvol_ns(x.ident, x.gen, x.parent, x.path)
+                    for x in sorted(fs.subvols.values(), key=lambda x: x.ident)]
+
+    def snapshot(self, src, dst, readonly=True):
+        with self.lock:
+            self._op('snapshot')
+            src_fs, src_rel = self._locate(src)
+            dst_fs, dst_rel = self._locate(dst)
+            what = f'btrfs sub snap {src} {dst}'
+            if src_rel and src_rel not in src_fs.subvols:
+                raise BackendError(what, errno.EINVAL, [f'ERROR: Not a Btrfs subvolume: {src}'])
+            if src_fs is not dst_fs:
+                raise BackendError(what, errno.EXDEV, ['ERROR: Invalid cross-device link'])
+            origin = src_fs.subvols.get(src_rel, None)
+            self._create(dst_fs, dst_rel, size=origin.size if origin else 0,
+                         readonly=readonly, origin=origin)
+
+    def delete(self, path):
+        with self.lock:
+            self._op('delete')
+            fs, rel = self._locate(path)
+            what = f'btrfs sub del {path}'
+            if rel not in fs.subvols:
+                raise BackendError(what, errno.ENOENT, [f"ERROR: Could not statfs: {path}"])
+            if any(x.startswith(rel + '/') for x in fs.subvols):
+                raise BackendError(what, errno.ENOTEMPTY, ['ERROR: Directory not empty'])
+            if any(x == (fs.top, rel) for x in self.mounts.values()):
+                raise BackendError(what, errno.EBUSY, ['ERROR: Device or resource busy'])
+            del fs.subvols[rel]
+            fs.generation += 1
+
+    def rename(self, src, dst):
+        with self.lock:
+            self._op('rename')
+            fs, src_rel = self._locate(src)
+            dst_fs, dst_rel = self._locate(dst)
+            what = f'mv "{src}" "{dst}"'
+            if fs is not dst_fs:
+                raise BackendError(what, errno.EXDEV, ['Invalid cross-device link'])
+            if src_rel not in fs.subvols or dst_rel in fs.subvols:
+                raise BackendError(what, errno.ENOENT if src_rel not in fs.subvols
+                                   else errno.EEXIST, ['cannot rename'])
+            fs.generation += 1
+            for rel in sorted(fs.subvols):
+                if rel == src_rel or rel.startswith(src_rel + '/'):
+                    ns = fs.subvols.pop(rel)
+                    ns.path = dst_rel + rel[len(src_rel):]
+                    fs.subvols[ns.path] = ns
+            for mount, (top, rel) in list(self.mounts.items()):
+                if top == fs.top and rel == src_rel:
+                    self.mounts[mount] = (top, dst_rel)
+
+    def usage(self, paths):
+        """ A snapshot shares all but what its origin wrote since (up to
+        all of it); anything else is all exclusive."""
+        with self.lock:
+            self._op('usage')
+            rv = {}
+            for path in paths:
+                fs, rel = self._locate(path)
+                ns = fs.subvols.get(rel, None)
+                if ns:
+                    changed = (sum(b for g, b in ns.origin.writes.items() if g > ns.ogen)
+                               if ns.origin else ns.size)
+                    rv[path] = SimpleNamespace(total=ns.size, exclusive=min(ns.size, changed))
+            return rv
+
+    def changed_extents(self, path, gen):
+        with self.lock:
+            self._op('changed')
+            fs, rel = self._locate(path)
+            if rel not in fs.subvols:
+                raise BackendError(f'btrfs sub find-new {path}', errno.EINVAL,
+                                   [f'ERROR: not a subvolume: {path}'])
+            return {g: b for g, b in fs.subvols[rel].writes.items() if g > gen}
+
+def make_backend(name):
+    """ The backend for a --backend option value."""
+    return {'cli': CliBackend, 'ioctl': IoctlBackend, 'sim': SimBackend}[name]()
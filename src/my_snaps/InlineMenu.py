@@ -29,11 +29,15 @@ Create the menu by passing in:
 # pylint: disable=invalid-name,broad-except,too-many-instance-attributes
 # pylint: disable=too-few-public-methods
 
+import os
+import re
 import sys
+import codecs
 import termios
 import tty
 import shutil
 import signal
+import selectors
 from types import SimpleNamespace
 
 ####################################################################################
@@ -61,6 +65,13 @@ class Term:
     def col(pos): return f'{Term.esc}[{pos}G'
     @staticmethod
     def clear_screen(): return f'{Term.esc}[H{Term.esc}[2J{Term.esc}[3J'
+    # terse forms (for slow consoles)
+    @staticmethod
+    def erase_eol(): return f'{Term.esc}[K'
+    @staticmethod
+    def up(cnt): return '' if cnt <= 0 else f'{Term.esc}[F' if cnt == 1 else Term.pos_up(cnt)
+    @staticmethod
+    def down(cnt): return '' if cnt <= 0 else f'{Term.esc}[E' if cnt == 1 else Term.pos_down(cnt)
 
 ####################################################################################
 
@@ -68,10 +79,23 @@ class Menu:
     """ A simple menu system """
     fd = sys.stdin.fileno()
     save_attrs = None
+    # Input is read with select() on stdin and on a self-pipe written
+    # by our SIGWINCH handler; keys decoded but not yet consumed are
+    # queued (class-wide since successive menus share stdin).
+    selector = None
+    winch_pipe = None
+    prev_winch = None
+    decoder = None
+    key_queue = []
+    partial = '' # the start of an escape sequence still arriving
+    esc_re = re.compile(r'\x1b(\[[0-?]*[ -/]*[@-~]|O.|[^\[O])', re.DOTALL)
+    esc_partial_re = re.compile(r'\x1b(\[[0-?]*[ -/]*|O)?')
+    esc_wait = 0.05 # secs to wait for the rest of an escape sequence
+    # Minimal redraw mode (for slow serial/IPMI consoles): track what is
+    # on screen and emit only changed lines with the tersest sequences.
+    minimal = False
+    bytes_total, keys_total = 0, 0 # bytes written / keys handled (all menus)
 
-    class InputTimeout(Exception):
-        """ Raised for obvious reasons. """
-        
     @staticmethod
     def _prompt_mode(enable=False):
         """ Used to start / complete prompting the user so that we can read
@@ -81,33 +105,89 @@ class Menu:
             if not Menu.save_attrs:
                 Menu.save_attrs = termios.tcgetattr(Menu.fd)
                 tty.setcbreak(Menu.fd)
+                Menu._init_input()
+                Menu.prev_winch = signal.signal(signal.SIGWINCH, Menu._on_winch)
         else:
             if Menu.save_attrs:
                 termios.tcsetattr(Menu.fd, termios.TCSADRAIN, Menu.save_attrs)
                 Menu.save_attrs = None
+                signal.signal(signal.SIGWINCH, Menu.prev_winch or signal.SIG_DFL)
+
+    @staticmethod
+    def _init_input():
+        """ Create the selector and self-pipe once per process. """
+        if Menu.selector:
+            return
+        Menu.winch_pipe = os.pipe()
+        for pipe_fd in Menu.winch_pipe:
+            os.set_blocking(pipe_fd, False)
+        Menu.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        Menu.selector = selectors.DefaultSelector()
+        Menu.selector.register(Menu.fd, selectors.EVENT_READ, 'key')
+        Menu.selector.register(Menu.winch_pipe[0], selectors.EVENT_READ, 'winch')
 
-    def __init__(self, prompts, default=None, title=''):
+    @staticmethod
+    def _on_winch(*_):
+        """ SIGWINCH handler: just wake up the select(). """
+        try:
+            os.write(Menu.winch_pipe[1], b'.')
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def _split_keys(text):
+        """ Split decoded input into keys keeping escape sequences whole.
+            Returns (keys, partial) where partial is an escape sequence
+            cut off at the end of the text.
+        """
+        keys, idx = [], 0
+        while idx < len(text):
+            if text[idx] != Term.esc:
+                keys.append(text[idx])
+                idx += 1
+                continue
+            mat = Menu.esc_re.match(text, idx)
+            if mat:
+                keys.append(mat.group())
+                idx = mat.end()
+            elif Menu.esc_partial_re.fullmatch(text, idx):
+                return keys, text[idx:]
+            else:
+                keys.append(text[idx])
+                idx += 1
+        return keys, ''
+
+    def __init__(self, prompts, default=None, title='', minimal=None):
+        self.minimal = Menu.minimal if minimal is None else minimal
+        self.screen = {} # in minimal mode, screen row => text shown
+        self.bytes_written = 0
+        self.key_bytes = [] # bytes written in response to each key
         self.prompts = prompts
         self.lines, self.keys = [], []
         self.objects = {}
+        self.key_idx = {} # key => index into lines
         self.selected = len(prompts)
         self.title = title
         self.cols, self.rows = shutil.get_terminal_size()
         self.max_line = 0
         # time.sleep(10)
-        self.pos = 0
+        self.pos = 0 # screen row of the cursor (0 is the top visible line)
+        self.top = 0 # index of the top visible line
+        self.view = 0 # number of visible lines
+        self.search = None # type-ahead text when searching
+        self.lower_lines = None # for searching (made on first search)
         self._parse_prompts()
         self.input = ''
         self.default_bottom = 'Use Up/Down/key to highlight and Enter to select'
+        if self._calc_view() < len(self.lines):
+            self.default_bottom = 'Up/Down/PgUp/PgDn/key or / to search; Enter to select'
         self.prev_bottom = self.default_bottom
         self._refresh(clear=False)
-        self.pos = len(self.lines)
         if hasattr(default, 'next'):
             default = default.next
         default = default if default else self.keys[0]
-        if default in self.prompts:
-            idx = list(self.keys).index(default)
-            self._move(idx - self.selected)
+        if default in self.key_idx:
+            self._move(self.key_idx[default] - self.selected)
 
     def _parse_prompts(self):
         for key, prompt in self.prompts.items():
@@ -123,6 +203,7 @@ class Menu:
             if len(lines) > 1:
                 prompt, extra = lines[0], '\n'.join(lines[1:])
             prompt = prompt.rstrip()
+            self.key_idx[key] = len(self.lines)
             self.lines.append(f'{key}: {prompt}')
             self.keys.append(key)
             self.objects[key] = SimpleNamespace(key=key, prompt=prompt,
@@ -130,109 +211,171 @@ class Menu:
         for idx, ns in enumerate(self.objects.values()):
             ns.next = self.keys[ min(idx+1, len(self.keys)-1) ]
 
+    def _calc_view(self):
+        """ Compute how many lines fit (i.e., the virtual window) and keep
+            the top such that the selected line is visible.
+        """
+        self.view = max(1, min(len(self.lines), self.rows - 5))
+        if self.selected < len(self.lines):
+            self.top = min(self.top, self.selected)
+            self.top = max(self.top, self.selected - self.view + 1)
+        self.top = max(0, min(self.top, len(self.lines) - self.view))
+        return self.view
+
+    def _write(self, action):
+        """ Write to the terminal counting the bytes. """
+        if action:
+            size = len(action.encode('utf-8'))
+            self.bytes_written += size
+            Menu.bytes_total += size
+            print(action, end='', flush=True)
+
     def _refresh(self, clear=True):
         """ Draw/redraw the menu optionally clearing the screen.
             Do this a first and after screen resizes.
+            Only the visible window of lines is drawn.
         """
-        self.pos = len(self.prompts)
+        self._calc_view()
+        self.pos = self.view
+        self.screen = {}
         if clear:
-            print(Term.clear_screen(), end='', flush=True)
-        print(f'\n\n     {Term.bold()}<<<< {self.title} >>>>'
-              + Term.normal_video() + '\n'*len(self.prompts))
-        for idx in range(0, len(self.lines)+1):
-            print(self._get_line_str(idx), end='', flush=True)
+            self._write(Term.clear_screen())
+        self._write(f'\n\n     {Term.bold()}<<<< {self.title} >>>>'
+              + Term.normal_video() + '\n'*self.view + '\n')
+        for idx in range(self.top, self.top + self.view):
+            self._write(self._get_line_str(idx))
         self._bottom_line()
-        print(self._set_pos_str(self.selected), end='', flush=True)
+        self._write(self._park_str())
 
-    def _set_pos_str(self, idx):
-        """ Goto the given line from where we are at."""
-        idx = 0 if idx < 0 else len(self.lines) if idx > len(self.lines) else idx
-        if idx == self.pos:
+    def _set_pos_str(self, row):
+        """ Goto the given screen row from where we are at."""
+        row = 0 if row < 0 else self.view if row > self.view else row
+        if row == self.pos:
+            return ''
+        if row < self.pos:
+            self.pos, cnt = row, self.pos - row
+            return Term.up(cnt) if self.minimal else Term.pos_up(cnt)
+        self.pos, cnt = row, row - self.pos
+        return Term.down(cnt) if self.minimal else Term.pos_down(cnt)
+
+    def _park_str(self):
+        """ Goto the selected line (or the bottom if none)."""
+        return self._set_pos_str(self.selected - self.top)
+
+    def _put_line_str(self, row, text):
+        """ In minimal mode, the string to change the row to the given plain
+            text (i.e., w/o escapes) by rewriting only the differing span;
+            '' if already showing.
+        """
+        was_text = self.screen.get(row, '')
+        if row in self.screen and text == was_text:
             return ''
-        if idx < self.pos:
-            self.pos, cnt = idx, self.pos - idx
-            return Term.pos_up(cnt)
-        self.pos, cnt = idx, idx - self.pos
-        return Term.pos_down(cnt)
+        self.screen[row] = text
+        beg, end = 0, len(text)
+        while beg < min(end, len(was_text)) and text[beg] == was_text[beg]:
+            beg += 1
+        if len(text) == len(was_text):
+            while end > beg and text[end-1] == was_text[end-1]:
+                end -= 1
+        action = self._set_pos_str(row)
+        action += f'{Term.esc}[{beg}C' if beg else ''
+        action += text[beg:end]
+        if len(text) < len(was_text):
+            action += Term.erase_eol()
+        return action + '\r'
 
     def _get_line_str(self, idx):
-        """ Returns the string to write for the given line of the menu.
-            'where' overrides the line to put it on.
+        """ Returns the string to write for the given line of the menu
+            ('' if not in the visible window).
         """
-        idx = 0 if idx < 0 else len(self.lines) if idx > len(self.lines) else idx
+        if not self.top <= idx < min(self.top + self.view, len(self.lines)):
+            return ''
         action, pre, on, off = '', ' ', '', ''
-        if idx == self.selected and idx < len(self.lines):
+        if idx == self.selected:
             pre, on, off = '>',Term.reverse_video(), Term.normal_video()
-        if idx < len(self.lines):
-            self.max_line = max(2+len(self.lines[idx]), self.max_line)
-            action += self._set_pos_str(idx)
-            action += Term.erase_line()
-            line = self.lines[idx][:self.cols-2]
-            action += f'{pre} {on}{line}{off}'
-            action += Term.col(0)
+        if self.minimal: # just the '>' marks the pick
+            return self._put_line_str(idx - self.top,
+                                      f'{pre} {self.lines[idx][:self.cols-2]}')
+        self.max_line = max(2+len(self.lines[idx]), self.max_line)
+        action += self._set_pos_str(idx - self.top)
+        action += Term.erase_line()
+        line = self.lines[idx][:self.cols-2]
+        action += f'{pre} {on}{line}{off}'
+        action += Term.col(0)
         return action
 
     def _move(self, cnt):
         """ Move the cursor by the cnt lines up (negative) or down (positive).
             If actually moving, then the old cursor will be un-highlighted
-            and the new cursor is highlighted.
+            and the new cursor is highlighted; if the new cursor is outside
+            the visible window, the window scrolls (redrawing just it).
         """
         action = ''
         idx = self.selected + cnt
         idx = 0 if idx < 0 else len(self.lines)-1 if idx >= len(self.lines) else idx
         if idx != self.selected:
             was_selected, self.selected = self.selected, idx
-            action += self._get_line_str(was_selected)
-            action += self._get_line_str(self.selected)
-            action += self._set_pos_str(self.selected)
-            print(action, end='', flush=True)
-
-    def _get_char(self):
-        """ Get one char from stdin """
-        def init_timeout_handling():
-            # `SIGWINCH` is send on terminal resizes
-            def handle_timeout(*ignore):
-                raise Menu.InputTimeout
-            signal.signal(signal.SIGALRM, handle_timeout)
-            signal.setitimer(signal.ITIMER_REAL, 0.25, 0.25)
-
-        def reset_timeout_handling() -> None:
-            signal.setitimer(signal.ITIMER_REAL, 0, 0)
-            signal.signal(signal.SIGALRM, signal.SIG_IGN)
-
-        rv = None
-        init_timeout_handling()
-        while True:
-            try:
-                init_timeout_handling()
-                rv = sys.stdin.read(1)
-                reset_timeout_handling()
-            except Menu.InputTimeout:
-                reset_timeout_handling()
-            except Exception as caught:
-                reset_timeout_handling()
-                raise caught
-
-            reset_timeout_handling()
-            cols, rows = shutil.get_terminal_size()
-            if self.cols != cols or self.rows != rows:
-                self.cols, self.rows = cols, rows
-                # self._bottom_line(f'resize: rows={self.rows}, cols={self.cols}')
+            was_top = self.top
+            self._calc_view()
+            if self.top != was_top:
+                for row_idx in range(self.top, self.top + self.view):
+                    action += self._get_line_str(row_idx)
+                self._write(action)
                 self._bottom_line()
-                self._refresh()
-            if rv is not None:
-                return rv
+                action = ''
+            else:
+                action += self._get_line_str(was_selected)
+                action += self._get_line_str(self.selected)
+            action += self._park_str()
+            self._write(action)
+
+    def _get_key(self):
+        """ Get one key (a char or a whole escape sequence) from stdin;
+            blocks until there is one, redrawing on terminal resizes.
+        """
+        while not Menu.key_queue:
+            events = Menu.selector.select(Menu.esc_wait if Menu.partial else None)
+            if not events and Menu.partial: # a lone ESC (or junk) after all
+                Menu.key_queue.extend(Menu.partial)
+                Menu.partial = ''
+            for sel_key, _ in events:
+                if sel_key.data == 'winch':
+                    try:
+                        while os.read(Menu.winch_pipe[0], 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    cols, rows = shutil.get_terminal_size()
+                    if self.cols != cols or self.rows != rows:
+                        self.cols, self.rows = cols, rows
+                        self._bottom_line()
+                        self._refresh()
+                    continue
+                data = os.read(Menu.fd, 4096) # all that is available
+                if not data:
+                    raise EOFError('end of input')
+                text = Menu.partial + Menu.decoder.decode(data)
+                keys, Menu.partial = self._split_keys(text)
+                Menu.key_queue.extend(keys)
+        return Menu.key_queue.pop(0)
 
     def _bottom_line(self, string=None):
         """ Draw/redraw the bottom line possibly with an error message """
         self.prev_bottom = string if string else self.prev_bottom
-        action = self._set_pos_str(len(self.lines))
-        action += Term.erase_line()
         bottom = f':::: {self.prev_bottom} ::::'
+        if self.view < len(self.lines):
+            bottom += f' [{self.top+1}-{self.top+self.view} of {len(self.lines)}]'
+        if self.minimal:
+            action = self._put_line_str(self.view, bottom[:self.cols-1])
+            if action:
+                self._write(action + self._park_str())
+            return
+        action = self._set_pos_str(self.view)
+        action += Term.erase_line()
         action += bottom[:self.cols-1]
-        action += self._set_pos_str(self.selected)
+        action += self._park_str()
         action += Term.col(0)
-        print(action, end='', flush=True)
+        self._write(action)
 
     def _finish(self, string=''):
         """ Complete the menu selection by moving the cursor after the
@@ -247,30 +390,71 @@ class Menu:
         # self.max_line = max(len(self.lines[self.selected]), self.max_line)
         # action += self.lines[self.selected][:self.cols]
 #       print(action, 'RUN\n', flush=True)
-        for idx in range(len(self.lines)):
-            print(self._set_pos_str(idx) + Term.erase_line(), end='')
-        print(Term.pos_down(1) + Term.erase_line(), end='', flush=True)
-        action = Term.pos_up(1+len(self.lines)) + Term.erase_line()
+        for row in range(self.view):
+            self._write(self._set_pos_str(row) + Term.erase_line())
+        self._write(Term.pos_down(1) + Term.erase_line())
+        action = Term.pos_up(1+self.view) + Term.erase_line()
         action += Term.reverse_video() + 'PICK' + Term.normal_video() + ': '
         action += self.lines[self.selected][:self.cols-6]
-        print(action + Term.pos_down(3), end='', flush=True)
+        self._write(action + Term.pos_down(3))
 
     def _restore_default_bottom(self):
         """ After the user does something right, clear the error message. """
         if self.prev_bottom != self.default_bottom:
             self._bottom_line(self.default_bottom)
 
+    def _search_key(self, ans):
+        """ Handle a key while searching (after '/'); returns False if the
+            key is not for the search (e.g., Enter or arrows).  Each typed
+            char extends the text and jumps to the next line containing it
+            (from the current one); Ctrl-N or '/' jumps to the next match.
+        """
+        if ans == Term.esc:
+            self.search = None
+            self._bottom_line(self.default_bottom)
+            return True
+        start = self.selected if self.selected < len(self.lines) else 0
+        if ans in ('\x0e', '/'): # next match
+            start += 1
+        elif ans in ('\x7f', '\x08'):
+            self.search = self.search[:-1]
+        elif len(ans) == 1 and ans.isprintable():
+            self.search += ans
+        else:
+            return False
+        if self.lower_lines is None:
+            self.lower_lines = [x.lower() for x in self.lines]
+        needle, found = self.search.lower(), None
+        for cnt in range(len(self.lines)):
+            idx = (start + cnt) % len(self.lines)
+            if needle in self.lower_lines[idx]:
+                found = idx
+                break
+        if found is not None:
+            self._move(found - self.selected)
+        self._bottom_line(f'/{self.search}' + ('' if found is not None or not needle
+                          else ' (no match)') + '  [Enter:select ESC:done]')
+        return True
+
+    key_seq = ('abcdefghijklmnopqrstuvwxyz'
+               'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
     @staticmethod
     def get_next_key(key):
-        """ Returns the next ASCII char after the given;
-            e.g., 'b' = get_next_key('a')
+        """ Returns the next key after the given;
+            e.g., 'b' = get_next_key('a').  Keys go a-z, A-Z, 0-9 and
+            then, when out of typeable keys, '#62', '#63', ... (which
+            are reached by moving or by searching).
         """
-        # old_int = ord(key[0])
-        # next_int = old_int + 1
-        # next_chr = chr(next_int)
-        # next_str = str(next_chr)
-        # return next_str
+        idx = Menu.key_seq.find(key) if len(key) == 1 else -1
+        if 0 <= idx < len(Menu.key_seq) - 1:
+            return Menu.key_seq[idx+1]
+        if idx == len(Menu.key_seq) - 1:
+            return f'#{len(Menu.key_seq)}'
+        if key.startswith('#') and key[1:].isdigit():
+            return f'#{int(key[1:])+1}'
         return str(chr(1+ord(key[0])))
+
     def get_command(self, obj):
         """ Return the 'command' from the returned Namespace which
             by convention is the 'extra', the 'paload' if a string,
@@ -290,37 +474,49 @@ class Menu:
     def get_prompt_obj(self):
         """ The external entry point which prompts the user
         to select and choose a menu entry an returns a namespace  """
+        mark = None
         while True:
             try:
                 self._prompt_mode(enable=True)
-                ans = ''
-                while True:
-                    key = self._get_char()
-                    ans += key
-                    if key.isalnum() or key in ('\r', '\n', ' '):
-                        break
-                if ans in ('\033[A', '\033[C'):
+                ans = self._get_key()
+                mark = self.bytes_written
+                if self.search is not None and self._search_key(ans):
+                    pass
+                elif ans in ('\033[A', '\033[C'):
                     self._restore_default_bottom()
                     self._move(-1)
                 elif ans in ('\033[B', '\033[C'):
                     self._restore_default_bottom()
                     self._move(1)
+                elif ans in ('\033[5~', '\033[6~'): # PgUp, PgDn
+                    self._restore_default_bottom()
+                    self._move(self.view if ans == '\033[6~' else -self.view)
+                elif ans in ('\033[H', '\033OH', '\033[1~'): # Home
+                    self._move(-len(self.lines))
+                elif ans in ('\033[F', '\033OF', '\033[4~'): # End
+                    self._move(len(self.lines))
                 elif ans in ('\r', '\n', ' '):
                     if self.selected < len(self.lines):
                         self._restore_default_bottom()
-                        picked = list(self.prompts.keys())[self.selected]
+                        picked = self.keys[self.selected]
                         self._prompt_mode(enable=False)
                         # self.finish(f'\n\nrunning {repr(picked)}')
                         self._finish()
                         return self.objects[picked]
                     self._bottom_line('invalid(no selection); pick again')
-                elif ans in self.prompts:
+                elif ans in self.key_idx:
                     self._restore_default_bottom()
-                    idx = list(self.prompts.keys()).index(ans)
-                    self._move(idx - self.selected)
+                    self._move(self.key_idx[ans] - self.selected)
+                elif ans == '/':
+                    self.search = ''
+                    self._search_key('\x7f')
                 else:
                     self._bottom_line(f'invalid({repr(ans)}); pick again')
             finally:
+                if mark is not None:
+                    self.key_bytes.append(self.bytes_written - mark)
+                    Menu.keys_total += 1
+                    mark = None
                 self._prompt_mode(enable=False)
 
 def runner(_): # def runner(argv):
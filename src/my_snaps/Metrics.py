@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Collect metrics and write them as a node-exporter "textfile" (i.e.,
+the Prometheus text exposition format) so that snapshot coverage and
+operation latencies can be scraped and alerted on.  Several jobs
+(e.g., per-period cron jobs and bt-smart-balance) may share one file:
+each write merges with the samples already there.
+"""
+# pylint: disable=invalid-name,too-many-arguments
+import os
+import re
+import time
+import fcntl
+import threading
+from types import SimpleNamespace
+
+class Metrics:
+    """ Gauges keyed by name and labels; written atomically to a file
+    (normally in node-exporter's --collector.textfile.directory). """
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.families = {} # name => ns(help, kind, samples={labels-str: value})
+        self.replaced = set() # names of families whose older samples are dropped
+        self.lock = threading.Lock() # bt-smart-balance --all adds from threads
+
+    @staticmethod
+    def _labels_str(labels):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items())) + '}'
+
+    def set(self, name, value, help_str='', kind='gauge', **labels):
+        """Set the value of one sample (replacing any with the same labels)."""
+        with self.lock:
+            family = self.families.get(name, None)
+            if not family:
+                family = self.families[name] = SimpleNamespace(
+                        help=help_str, kind=kind, samples={})
+            family.samples[self._labels_str(labels)] = value
+
+    def replace(self, name):
+        """Drop the older samples of the family when writing (i.e., each
+        run sets all of its samples, so any others are stale)."""
+        with self.lock:
+            self.replaced.add(name)
+
+    def _merge_file(self):
+        """Add the samples in the existing file that were not set by this
+        run (e.g., the operations of other jobs)."""
+        try:
+            with open(self.pathname, encoding='utf-8') as fh:
+                lines = fh.read().splitlines()
+        except OSError:
+            return
+        helps, kinds = {}, {}
+        with self.lock:
+            for line in lines:
+                if line.startswith(('# HELP ', '# TYPE ')):
+                    name, _, text = line[7:].partition(' ')
+                    (helps if line[2] == 'H' else kinds)[name] = text
+                    continue
+                mat = re.match(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$', line)
+                if not mat or mat.group(1) in self.replaced:
+                    continue
+                name = mat.group(1)
+                family = self.families.get(name, None)
+                if not family:
+                    family = self.families[name] = SimpleNamespace(
+                        help=helps.get(name, ''), kind=kinds.get(name, 'gauge'), samples={})
+                family.samples.setdefault(mat.group(2) or '', mat.group(3))
+
+    def record_op(self, op, started, code, **labels):
+        """Record the duration (since 'started' per time.monotonic()) and
+        exit status of an operation such as a snapshot create/delete."""
+        self.set('my_snaps_operation_duration_seconds', round(time.monotonic() - started, 3),
+                 'duration of the last operation', op=op, **labels)
+        self.set('my_snaps_operation_status', code,
+                 'exit status of the last operation (0 is success)', op=op, **labels)
+        self.set('my_snaps_operation_timestamp_seconds', int(time.time()),
+                 'when the last operation ended', op=op, **labels)
+
+    def text(self):
+        """The metrics in the text exposition format."""
+        lines = []
+        with self.lock:
+            for name in sorted(self.families):
+                family = self.families[name]
+                if family.help:
+                    lines.append(f'# HELP {name} {family.help}')
+                lines.append(f'# TYPE {name} {family.kind}')
+                for labels in sorted(family.samples):
+                    lines.append(f'{name}{labels} {family.samples[labels]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Merge with the existing file and write it atomically (the
+        collector must never see a partial file) while holding a lock
+        (so concurrent jobs cannot drop each other's samples); returns
+        False (w/ a message) on failure."""
+        tmp_path = f'{self.pathname}.{os.getpid()}.tmp'
+        try:
+            with open(f'{self.pathname}.lock', 'a', encoding='utf-8') as lock_fh:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX)
+                self._merge_file()
+                with open(tmp_path, 'w', encoding='utf-8') as fh:
+                    fh.write(self.text())
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, self.pathname)
+            return True
+        except OSError as exc:
+            print(f'WARN: cannot write metrics to {self.pathname!r}: {exc}')
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return False
@@ -5,8 +5,11 @@ shared utilities fo the my-snap tools
 """
 # pylint: disable=broad-exception-caught,invalid-name
 
+import os
 import re
-import time
+import bisect
+import subprocess
+from types import SimpleNamespace
 from datetime import datetime
 
 ##############################################################################
@@ -26,6 +29,17 @@ def human(number):
             return f'{number:.1f}{suffix}'
     return None
 
+##############################################################################
+def parse_size(text):
+    """ Parse a size like '20G', '1.5GiB', '512MB', or '4096' (bytes)
+        using binary units; raises ValueError if not a size.
+    """
+    mat = re.match(r'^\s*(\d+(?:\.\d*)?)\s*(?:([KMGTP])(?:i?B)?|B)?\s*$', text, re.IGNORECASE)
+    if not mat:
+        raise ValueError(f'bad size {text!r}')
+    power = ' KMGTP'.index(mat.group(2).upper()) if mat.group(2) else 0
+    return int(float(mat.group(1)) * 1024 ** power)
+
 ##############################################################################
 def ago_str(delta_secs, signed=False):
     """ Turn time differences in seconds to a compact representation;
@@ -48,15 +62,212 @@ def ago_str(delta_secs, signed=False):
     return rv
 
 ##############################################################################
-def ago_whence(filename):
+def whence_epoch(filename):
     """ Find the standard time string in the file name and return
-        the ago_str()
+        it as seconds since the epoch (or None if absent/invalid)
     """
     mat = re.search(r'\b(\d\d\d\d-\d\d-\d\d-\d\d\d\d\d\d)\b', filename)
     if mat:
         try:
             dt_object = datetime.strptime(mat.group(1), "%Y-%m-%d-%H%M%S")
-            return ago_str(time.time() - dt_object.timestamp())
+            return dt_object.timestamp()
         except Exception:
             pass
-    return ''
+    return None
+
+##############################################################################
+def snapshot_subvol(name):
+    """ The subvolume of a snapshot name (e.g., 'eos@root' of
+    'eos@root.2024-01-13-093817=Daily'); '' if not a snapshot name."""
+    mat = re.match(r'^(.*)\.[\-\d\:]+', name) # as gather_snapshots() (subvols may have dots)
+    return mat.group(1) if mat and whence_epoch(name) is not None else ''
+
+##############################################################################
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7*86400, 'y': 365*86400}
+
+def parse_age_expr(term):
+    """ Parse an age expression like '>30d' (older than) or '<1w2d'
+        (younger than) using the ago_str() units.
+        Returns (op, seconds) or None if not an age expression.
+    """
+    mat = re.match(r'^([<>])((?:\d+[smhdwy])+)$', term)
+    if not mat:
+        return None
+    secs = 0
+    for num, unit in re.findall(r'(\d+)([smhdwy])', mat.group(2)):
+        secs += int(num) * AGE_UNITS[unit]
+    return mat.group(1), secs
+
+
+##############################################################################
+class TimeIndex:
+    """ A time-sorted array of items (e.g., snapshot namespaces) each having
+        an 'epoch' attribute (None sorts eldest) with bisect-based queries.
+        Indexing, len(), iteration and remove() work like a list.
+    """
+    def __init__(self, items=()):
+        self.items = sorted(items, key=self._key)
+        self.keys = [self._key(x) for x in self.items]
+
+    @staticmethod
+    def _key(item):
+        return (-1.0 if item.epoch is None else item.epoch, getattr(item, 'path', ''))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
+    def add(self, item):
+        """ Insert the item in time order."""
+        key = self._key(item)
+        idx = bisect.bisect_right(self.keys, key)
+        self.keys.insert(idx, key)
+        self.items.insert(idx, item)
+
+    def remove(self, item):
+        """ Remove the item (ValueError if absent)."""
+        idx = bisect.bisect_left(self.keys, self._key(item))
+        while idx < len(self.items) and self.items[idx] is not item:
+            idx += 1
+        if idx >= len(self.items):
+            raise ValueError('item not in TimeIndex')
+        del self.items[idx], self.keys[idx]
+
+    def older_than(self, epoch):
+        """ Items strictly older than the epoch (eldest first)."""
+        return self.items[:bisect.bisect_left(self.keys, (epoch, ''))]
+
+    def newer_than(self, epoch):
+        """ Items at or newer than the epoch (eldest first)."""
+        return self.items[bisect.bisect_left(self.keys, (epoch, '')):]
+
+    def eldest(self):
+        """ The eldest item or None."""
+        return self.items[0] if self.items else None
+
+    def newest(self):
+        """ The newest item or None."""
+        return self.items[-1] if self.items else None
+
+
+##############################################################################
+def find_btrfs_filesystems(sysfs='/sys/fs/btrfs', udev_dir='/run/udev/data',
+                           blkid_tabs=('/run/blkid/blkid.tab', '/etc/blkid.tab')):
+    """ Discover the BTRFS filesystems w/o scanning every block device
+        (as "btrfs filesystem show" does). Sources, cheapest first:
+         - sysfs (filesystems known to the kernel; e.g., mounted),
+         - the udev database (all probed devices), else the blkid cache,
+         - only if those find nothing, "btrfs filesystem show".
+        Returns a list of namespaces (uuid, label, devices, path) where
+        'path' is the first device (e.g., to mount).
+    """
+    found = {} # keyed by uuid
+
+    def add(uuid, label, device):
+        ns = found.get(uuid, None)
+        if not ns:
+            ns = found[uuid] = SimpleNamespace(uuid=uuid, label=label,
+                                               devices=[], path='')
+        ns.label = ns.label if ns.label else label
+        if device and device not in ns.devices:
+            ns.devices.append(device)
+            ns.path = ns.devices[0]
+
+    def slurp(pathname):
+        try:
+            with open(pathname, 'r', encoding='utf-8') as fh:
+                return fh.read()
+        except OSError:
+            return ''
+
+    try:
+        uuids = os.listdir(sysfs)
+    except OSError:
+        uuids = []
+    for uuid in uuids:
+        if not os.path.isdir(os.path.join(sysfs, uuid, 'devices')):
+            continue # e.g., "features"
+        label = slurp(os.path.join(sysfs, uuid, 'label')).strip()
+        for dev in sorted(os.listdir(os.path.join(sysfs, uuid, 'devices'))):
+            add(uuid, label, f'/dev/{dev}')
+
+    try:
+        records = os.listdir(udev_dir)
+    except OSError:
+        records = []
+    from_udev = False
+    for record in records:
+        if not record.startswith('b'): # block devices are "b{major}:{minor}"
+            continue
+        props = dict(re.findall(r'^E:(ID_FS_\w+)=(.*)$',
+                        slurp(os.path.join(udev_dir, record)), re.MULTILINE))
+        if props.get('ID_FS_TYPE', '') != 'btrfs' or 'ID_FS_UUID' not in props:
+            continue
+        link = f'/sys/dev/block/{record[1:]}'
+        dev = (f'/dev/{os.path.basename(os.path.realpath(link))}'
+               if os.path.exists(link) else f'/dev/block/{record[1:]}')
+        add(props['ID_FS_UUID'], props.get('ID_FS_LABEL', ''), dev)
+        from_udev = True
+
+    for blkid_tab in ([] if from_udev else blkid_tabs):
+        # <device DEVNO="0x0802" LABEL="x" UUID="..." TYPE="btrfs">/dev/sda2</device>
+        for mat in re.finditer(r'<device\s+([^>]*)>([^<]+)</device>', slurp(blkid_tab)):
+            attrs = dict(re.findall(r'(\w+)="([^"]*)"', mat.group(1)))
+            if attrs.get('TYPE', '') == 'btrfs' and 'UUID' in attrs:
+                add(attrs['UUID'], attrs.get('LABEL', ''), mat.group(2).strip())
+
+    if not found:
+        try:
+            lines = subprocess.check_output(['btrfs', 'filesystem', 'show'],
+                                            stderr=subprocess.DEVNULL).decode('utf-8')
+        except (OSError, subprocess.CalledProcessError):
+            lines = ''
+        uuid, label = '', ''
+        for line in lines.splitlines():
+            # Label: 'btrfs-common'  uuid: 8f60fc2f-872d-4327-aff9-34c4c4cefde7
+            mat = re.match(r"^Label:\s+(?:'([^']*)'|none)\s+uuid:\s+(\S+)", line)
+            if mat:
+                label, uuid = mat.group(1) or '', mat.group(2)
+            mat = re.search(r"\bpath\s+(/dev/\S+)", line)
+            if mat and uuid:
+                add(uuid, label, mat.group(1))
+
+    return sorted(found.values(), key=lambda x: (x.label, x.path))
+
+
+##############################################################################
+def btrfs_mounts(proc_mounts='/proc/mounts', sysfs='/sys/fs/btrfs'):
+    """ The mounted BTRFS filesystems per /proc/mounts as a list of
+        namespaces (mount, device, uuid) where uuid comes from sysfs
+        ('' if not found there).
+    """
+    dev_uuids = {} # device basename (e.g., nvme0n1p2 or dm-0) => uuid
+    try:
+        uuids = os.listdir(sysfs)
+    except OSError:
+        uuids = []
+    for uuid in uuids:
+        try:
+            for dev in os.listdir(os.path.join(sysfs, uuid, 'devices')):
+                dev_uuids[dev] = uuid
+        except OSError:
+            continue
+    rv = []
+    try:
+        with open(proc_mounts, 'r', encoding='utf-8') as fh:
+            lines = fh.readlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        wds = line.split()
+        if len(wds) < 3 or wds[2] != 'btrfs':
+            continue
+        device, mount = wds[0], wds[1].replace('\\040', ' ')
+        uuid = dev_uuids.get(os.path.basename(os.path.realpath(device)), '')
+        rv.append(SimpleNamespace(mount=mount, device=device, uuid=uuid))
+    return rv
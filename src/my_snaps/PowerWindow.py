@@ -6,9 +6,13 @@ Custom Wrapper for python curses.
 # pylint: disable=too-many-instance-attributes,too-many-arguments
 # pylint: disable=invalid-name,broad-except
 
+import os
+import sys
 import traceback
 import atexit
 import time
+import signal
+import selectors
 import curses
 import textwrap
 from types import SimpleNamespace
@@ -156,8 +160,8 @@ class OptionSpinner:
 
 class Window:
     """ Layer above curses to encapsulate what we need """
-    timeout_ms = 200
     static_scr = None
+    prev_winch = None # SIGWINCH handler to restore when stopping curses
     nav_keys = """
         Navigation:    H/M/L:   top/middle/end-of-page
             k, UP:  up one row               0, HOME:  first row
@@ -168,6 +172,7 @@ class Window:
     def __init__(self, head_line=True, head_rows=50, body_rows=200,
                  body_cols=200, keys=None, pick_mode=False, pick_size=1):
         self.scr = self._start_curses()
+        self._init_selector()
 
         self.head = SimpleNamespace(
             pad=curses.newpad(head_rows, body_cols),
@@ -194,6 +199,7 @@ class Window:
         self.rows, self.cols = 0, 0
         self.scroll_view_size = 0  # no. viewable lines of the body
         self.handled_keys = set(keys) if isinstance(keys, (set, list)) else []
+        self.capture_keys = False # return all non-navigation keys (e.g., for typing)
         self._set_screen_dims()
         self.calc()
 
@@ -219,10 +225,50 @@ class Window:
         curses.cbreak()
         curses.curs_set(0)
         scr.keypad(1)
-        scr.timeout(Window.timeout_ms)
+        scr.nodelay(True) # we block in select(), never in getch()
         scr.clear()
         return scr
 
+    def _init_selector(self):
+        """ Set up what prompt() blocks on: stdin for keys and a self-pipe
+        written by the SIGWINCH handler."""
+        self.wakeups = 0 # times prompt() woke from select() (for measuring)
+        self.pipes = {}
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sys.stdin.fileno(), selectors.EVENT_READ, 'key')
+        rfd, wfd = os.pipe()
+        os.set_blocking(rfd, False)
+        os.set_blocking(wfd, False)
+        self.selector.register(rfd, selectors.EVENT_READ, 'winch')
+        self.pipes['winch'] = (rfd, wfd)
+        Window.prev_winch = signal.signal(
+                signal.SIGWINCH, lambda *_: self._poke('winch'))
+
+    def _poke(self, tag):
+        """ Wake up prompt(); safe from signal handlers and other threads."""
+        try:
+            os.write(self.pipes[tag][1], b'.')
+        except BlockingIOError:
+            pass # pipe full ... a wakeup is already pending
+
+    def _drain(self, tag):
+        """ Empty the given wakeup pipe."""
+        try:
+            while os.read(self.pipes[tag][0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _resize(self):
+        """ Tell curses about the new terminal size (since our SIGWINCH
+        handler replaces the one curses installs)."""
+        try:
+            cols, rows = os.get_terminal_size(sys.__stdout__.fileno())
+            curses.resizeterm(rows, cols)
+        except (OSError, curses.error):
+            pass
+        self._set_screen_dims()
+
     def set_pick_mode(self, on=True, pick_size=1):
         """Set whether in highlight mode."""
         was_on, was_size = self.pick_mode, self.pick_size
@@ -234,6 +280,9 @@ class Window:
     @staticmethod
     def stop_curses():
         """ Curses shutdown (registered to be called on exit). """
+        if Window.prev_winch is not None:
+            signal.signal(signal.SIGWINCH, Window.prev_winch)
+            Window.prev_winch = None
         if Window.static_scr:
             curses.nocbreak()
             curses.echo()
@@ -584,13 +633,25 @@ class Window:
         self.head.row_cnt = self.body.row_cnt = 0
 
     def prompt(self, seconds=1.0):
-        """Here is where we sleep waiting for commands or timeout"""
+        """Here is where we sleep waiting for commands or timeout.  We block
+        in select() on stdin and SIGWINCH so an idle window
+        does not wake up until something happens. Returns None when the
+        caller should simply redraw."""
         ctl_b, ctl_d, ctl_f, ctl_u = 2, 4, 6, 21
-        elapsed = 0.0
-        while elapsed < seconds:
-            key = self.scr.getch()
+        deadline = time.monotonic() + seconds
+        while True:
+            key = self.scr.getch() # non-blocking; drains what curses has queued
             if key == curses.ERR:
-                elapsed += self.timeout_ms / 1000
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                events = self.selector.select(timeout=remaining)
+                self.wakeups += 1
+                tags = {sel_key.data for sel_key, _ in events}
+                if 'winch' in tags:
+                    self._drain('winch')
+                    self._resize()
+                    break
                 continue
             if key in (curses.KEY_RESIZE, ) or curses.is_term_resized(self.rows, self.cols):
                 # self.scr.erase()
@@ -601,6 +662,8 @@ class Window:
             # App keys...
             if key in self.handled_keys:
                 return key # return for handling
+            if self.capture_keys and (key < 256 or key == curses.KEY_BACKSPACE):
+                return key # caller is taking typed input
 
             # Navigation Keys...
             pos = self.pick_pos if self.pick_mode else self.scroll_pos
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Lightweight per-phase profiling for the my-snaps tools.
+
+When enabled (i.e., by --profile), it records the wall and CPU time of
+each instrumented phase and of each external command (i.e., anything
+run via subprocess or os.system), optionally the tracemalloc peak per
+phase, and at exit writes a Chrome trace-event JSON file (load it in
+chrome://tracing or https://ui.perfetto.dev) plus a summary table.
+When disabled, phases cost one attribute test.
+"""
+# pylint: disable=invalid-name,too-many-instance-attributes
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import threading
+import functools
+import contextlib
+import subprocess
+
+class Profiler:
+    """ Collects complete ("X") trace events. """
+    def __init__(self):
+        self.enabled = False
+        self.pathname = ''
+        self.trace_malloc = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.epoch = time.perf_counter()
+        self.tids = {} # thread ident => small number (for the trace)
+
+    def start(self, pathname, trace_malloc=False):
+        """Enable profiling; the results are written at exit."""
+        self.enabled, self.pathname = True, pathname
+        self.epoch = time.perf_counter()
+        if trace_malloc:
+            import tracemalloc
+            tracemalloc.start()
+            self.trace_malloc = True
+        self._hook_commands()
+        atexit.register(self.finish)
+
+    def _tid(self):
+        ident = threading.get_ident()
+        with self.lock:
+            return self.tids.setdefault(ident, len(self.tids) + 1)
+
+    def _add(self, name, cat, start, wall, args):
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(),
+                 'tid': self._tid(), 'ts': round((start - self.epoch) * 1e6),
+                 'dur': round(wall * 1e6), 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def phase(self, name, cat='phase'):
+        """Time the enclosed block as a named phase."""
+        if not self.enabled:
+            yield
+            return
+        if self.trace_malloc:
+            import tracemalloc
+            if hasattr(tracemalloc, 'reset_peak'): # python >= 3.9
+                tracemalloc.reset_peak()
+                before = None
+            else:
+                before = tracemalloc.get_traced_memory()
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            args = {'cpu_ms': round((time.thread_time() - cpu) * 1000, 3)}
+            if self.trace_malloc:
+                import tracemalloc
+                current, peak = tracemalloc.get_traced_memory()
+                if before is not None: # w/o reset_peak(), the growth during the phase
+                    peak = (peak - before[0] if peak > before[1]
+                            else max(0, current - before[0]))
+                args['peak_kb'] = round(peak / 1024, 1)
+            self._add(name, cat, start, wall, args)
+
+    def instrument(self, obj, names):
+        """Replace the named methods of obj (an instance) with timed ones."""
+        if not self.enabled:
+            return
+        for name in names:
+            method = getattr(obj, name)
+            @functools.wraps(method)
+            def timed(*args, _method=method, _name=name, **kwargs):
+                with self.phase(_name):
+                    return _method(*args, **kwargs)
+            setattr(obj, name, timed)
+
+    def _hook_commands(self):
+        """Time external commands by wrapping os.system and subprocess.Popen
+        (which subprocess.run/check_output use); a Popen's end is noticed
+        when wait() or poll() first sees its exit."""
+        profiler = self
+        orig_system = os.system
+        def system(command):
+            start, children = time.perf_counter(), os.times()
+            code = orig_system(command)
+            profiler._add_command(command, start, children, code)
+            return code
+        os.system = system
+
+        orig_init, orig_wait, orig_poll = (subprocess.Popen.__init__,
+                subprocess.Popen.wait, subprocess.Popen.poll)
+        def init(self, args, *more, **kwargs):
+            self._prof = (time.perf_counter(), os.times(), args)
+            orig_init(self, args, *more, **kwargs)
+        def note_end(self):
+            prof = getattr(self, '_prof', None)
+            if prof and self.returncode is not None:
+                self._prof = None
+                command = prof[2] if isinstance(prof[2], str) else ' '.join(map(str, prof[2]))
+                profiler._add_command(command, prof[0], prof[1], self.returncode)
+        def wait(self, *args, **kwargs):
+            rv = orig_wait(self, *args, **kwargs)
+            note_end(self)
+            return rv
+        def poll(self):
+            rv = orig_poll(self)
+            note_end(self)
+            return rv
+        subprocess.Popen.__init__ = init
+        subprocess.Popen.wait = wait
+        subprocess.Popen.poll = poll
+
+    @staticmethod
+    def command_name(command):
+        """A short name to aggregate on; e.g., 'set -x; mount /dev/sda2 /mnt'
+        => 'mount' and 'sudo btrfs sub list /' => 'btrfs sub list'."""
+        segments = [x for x in re.split(r';|&&', command) if x.strip()]
+        words = segments[-1].split() if segments else ['?']
+        if words[0] == 'sudo' and len(words) > 1:
+            words = words[1:]
+        return ' '.join(words[:3]) if words[0] == 'btrfs' else words[0]
+
+    def _add_command(self, command, start, children, code):
+        now = os.times()
+        child_cpu = (now.children_user - children.children_user
+                     + now.children_system - children.children_system)
+        self._add(self.command_name(command), 'command', start, time.perf_counter() - start,
+                  {'command': command[:500], 'status': code,
+                   'child_cpu_ms': round(child_cpu * 1000, 3)})
+
+    def summary(self):
+        """A table of count, total/max wall, and CPU ms per name."""
+        totals = {} # (cat, name) => [count, wall_ms, max_ms, cpu_ms, peak_kb]
+        for event in self.events:
+            row = totals.setdefault((event['cat'], event['name']), [0, 0.0, 0.0, 0.0, 0.0])
+            wall = event['dur'] / 1000
+            row[0] += 1
+            row[1] += wall
+            row[2] = max(row[2], wall)
+            row[3] += event['args'].get('cpu_ms', event['args'].get('child_cpu_ms', 0))
+            row[4] = max(row[4], event['args'].get('peak_kb', 0))
+        lines = [f'{"kind":<8} {"name":<26} {"count":>6} {"wall_ms":>10}'
+                 f' {"max_ms":>9} {"cpu_ms":>9}' + (f' {"peak_kb":>9}' if self.trace_malloc else '')]
+        for (cat, name), row in sorted(totals.items(), key=lambda x: -x[1][1]):
+            lines.append(f'{cat:<8} {name[:26]:<26} {row[0]:>6} {row[1]:>10.1f}'
+                         f' {row[2]:>9.1f} {row[3]:>9.1f}'
+                         + (f' {row[4]:>9.1f}' if self.trace_malloc else ''))
+        return '\n'.join(lines)
+
+    def finish(self):
+        """Write the trace file and print the summary (once)."""
+        if not self.enabled:
+            return
+        self.enabled = False
+        try:
+            with open(self.pathname, 'w', encoding='utf-8') as fh:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fh)
+            print(f'\nPROFILE: wrote {len(self.events)} events to {self.pathname!r}',
+                  file=sys.stderr)
+        except OSError as exc:
+            print(f'\nPROFILE: cannot write {self.pathname!r}: {exc}', file=sys.stderr)
+        print(self.summary(), file=sys.stderr)
+
+profiler = Profiler()
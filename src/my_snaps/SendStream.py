@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Decode a "btrfs send" stream incrementally and turn the commands of an
+incremental (-p) stream into the paths that differ between the parent
+and the sent snapshot; with --no-data, the stream is all metadata, so
+the difference costs a walk of the changed tree blocks only.
+
+Stream layout: "btrfs-stream\\0" and a le32 version, then commands,
+each a header (le32 payload length, le16 command, le32 crc32c) and a
+payload of TLV attributes (le16 type, le16 length, value).
+"""
+# pylint: disable=invalid-name,too-few-public-methods
+import os
+import re
+import struct
+from types import SimpleNamespace
+
+MAGIC = b'btrfs-stream\0'
+
+class StreamError(Exception):
+    """ A malformed or truncated stream. """
+
+# btrfs_send_cmd values (v1 + v2)
+COMMANDS = {1: 'subvol', 2: 'snapshot', 3: 'mkfile', 4: 'mkdir', 5: 'mknod',
+            6: 'mkfifo', 7: 'mksock', 8: 'symlink', 9: 'rename', 10: 'link',
+            11: 'unlink', 12: 'rmdir', 13: 'set_xattr', 14: 'remove_xattr',
+            15: 'write', 16: 'clone', 17: 'truncate', 18: 'chmod', 19: 'chown',
+            20: 'utimes', 21: 'end', 22: 'update_extent', 23: 'fallocate',
+            24: 'fileattr', 25: 'encoded_write', 26: 'enable_verity'}
+
+# the btrfs_send_attr values decoded (as str or int); others stay bytes
+A_UUID, A_CTRANSID, A_INO, A_SIZE, A_MODE = 1, 2, 3, 4, 5
+A_PATH, A_PATH_TO, A_PATH_LINK, A_FILE_OFFSET, A_DATA = 15, 16, 17, 18, 19
+A_CLONE_PATH = 22
+PATH_ATTRS = (A_PATH, A_PATH_TO, A_PATH_LINK, A_CLONE_PATH)
+U64_ATTRS = (A_CTRANSID, A_INO, A_SIZE, A_MODE, A_FILE_OFFSET)
+
+CMD_HEADER = struct.Struct('<IHI')
+TLV_HEADER = struct.Struct('<HH')
+U64 = struct.Struct('<Q')
+
+def read_exactly(fh, nbytes):
+    """ Read nbytes (fewer only at the end of the stream)."""
+    data = fh.read(nbytes)
+    while data and len(data) < nbytes:
+        more = fh.read(nbytes - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def iter_commands(fh):
+    """ Yield ns(name, attrs) per command as read from the binary file
+    object fh (e.g., the stdout pipe of "btrfs send"); attrs maps the
+    attribute numbers to str (paths), int (numbers), or bytes.
+    Several streams may be concatenated (as "btrfs send" does for
+    multiple subvolumes)."""
+    version = 0
+    while True:
+        header = read_exactly(fh, CMD_HEADER.size)
+        if not header:
+            return
+        if header.startswith(MAGIC[:CMD_HEADER.size]):
+            rest = read_exactly(fh, len(MAGIC) + 4 - len(header))
+            header += rest
+            if not header.startswith(MAGIC) or len(header) < len(MAGIC) + 4:
+                raise StreamError('bad stream header')
+            version = struct.unpack_from('<I', header, len(MAGIC))[0]
+            continue
+        if len(header) < CMD_HEADER.size:
+            raise StreamError('truncated command header')
+        length, cmd, _ = CMD_HEADER.unpack(header)
+        payload = read_exactly(fh, length)
+        if len(payload) < length:
+            raise StreamError(f'truncated {COMMANDS.get(cmd, cmd)} command')
+        attrs, pos = {}, 0
+        while pos < length:
+            kind, size = TLV_HEADER.unpack_from(payload, pos)
+            pos += TLV_HEADER.size
+            if kind == A_DATA and version >= 2: # the rest (w/o a true length)
+                size = length - pos
+            value = payload[pos:pos + size]
+            pos += size
+            if kind in PATH_ATTRS:
+                value = value.decode('utf-8', 'surrogateescape')
+            elif kind in U64_ATTRS and size == 8:
+                value = U64.unpack(value)[0]
+            attrs[kind] = value
+        yield SimpleNamespace(name=COMMANDS.get(cmd, str(cmd)), attrs=attrs)
+
+class SnapDiff:
+    """ Turns the commands of an incremental stream into events passed
+    to emit(kind, path, new_path) where kind is 'A' (added), 'M'
+    (modified), 'D' (deleted), or 'R' (renamed to new_path), each path
+    being relative to the subvolume.  Events go out as the commands are
+    decoded except for the contents of new directories which wait for
+    the directory's final name (new inodes are first created at the top
+    with temporary "orphan" names like 'o261-7-0' and renamed later).
+    Times-only updates (utimes) are not reported: every directory with
+    a changed entry gets one. """
+    orphan_re = re.compile(r'^o\d+-\d+-\d+$')
+    created = ('mkfile', 'mkdir', 'mknod', 'mkfifo', 'mksock', 'symlink')
+    modifying = ('write', 'clone', 'truncate', 'chmod', 'chown', 'set_xattr',
+                 'remove_xattr', 'update_extent', 'fallocate', 'fileattr',
+                 'encoded_write', 'enable_verity')
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.orphans = {} # name => ns(old=original path or None, pending=[(kind, rest)])
+        self.reported = set() # paths reported as added/modified (to report once)
+        self.counts = {'A': 0, 'M': 0, 'D': 0, 'R': 0}
+
+    def _report(self, kind, path, new_path=None):
+        """ Report an event, resolving (or deferring) orphan names."""
+        first, _, rest = path.partition('/')
+        orphan = self.orphans.get(first, None)
+        if orphan:
+            if orphan.old is None: # within a new dir w/o its final name yet
+                if kind != 'M':
+                    orphan.pending.append((kind, rest, new_path))
+                return
+            path = os.path.join(orphan.old, rest) if rest else orphan.old
+        if kind in ('A', 'M'):
+            if path in self.reported:
+                return
+            self.reported.add(path)
+        self.counts[kind] += 1
+        self.emit(kind, path, new_path)
+
+    def feed(self, command):
+        """ Process one command (from iter_commands())."""
+        name, attrs = command.name, command.attrs
+        path = attrs.get(A_PATH, '')
+        if name in self.created:
+            if self.orphan_re.match(path):
+                self.orphans[path] = SimpleNamespace(old=None, pending=[])
+            else:
+                self._report('A', path)
+        elif name in self.modifying:
+            self._report('M', path)
+        elif name == 'link':
+            self._report('A', path)
+        elif name in ('unlink', 'rmdir'):
+            orphan = self.orphans.pop(path, None)
+            if orphan is None:
+                self._report('D', path)
+            elif orphan.old is not None:
+                self._report('D', orphan.old)
+        elif name == 'rename':
+            self._rename(path, attrs.get(A_PATH_TO, ''))
+
+    def _rename(self, src, dst):
+        orphan = self.orphans.pop(src, None)
+        if self.orphan_re.match(dst): # moved aside (to be renamed/removed later)
+            if orphan is None:
+                orphan = SimpleNamespace(old=self._resolved(src), pending=[])
+            self.orphans[dst] = orphan
+        elif orphan is not None and orphan.old is None: # a new inode gets its name
+            self._report('A', dst)
+            for kind, rest, new_path in orphan.pending:
+                self._report(kind, os.path.join(dst, rest) if rest else dst, new_path)
+        elif orphan is not None:
+            self._report('R', orphan.old, dst)
+        else:
+            self._report('R', src, dst)
+
+    def _resolved(self, path):
+        first, _, rest = path.partition('/')
+        orphan = self.orphans.get(first, None)
+        if orphan and orphan.old is not None:
+            return os.path.join(orphan.old, rest) if rest else orphan.old
+        return path
+
+    def finish(self):
+        """ Report what remains under orphan names (e.g., a truncated
+        stream) as-is; returns the counts by kind."""
+        orphans, self.orphans = self.orphans, {}
+        for name, orphan in orphans.items():
+            if orphan.old is None:
+                self._report('A', name)
+                for kind, rest, new_path in orphan.pending:
+                    self._report(kind, os.path.join(name, rest) if rest else name, new_path)
+        return self.counts
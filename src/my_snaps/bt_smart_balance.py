@@ -3,81 +3,512 @@
 # pylint: disable=invalid-name,too-many-instance-attributes
 import os
 import sys
+import glob
 import subprocess
 import re
+import shlex
+import time
+import copy
+from datetime import datetime
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from my_snaps.MyUtils import human, btrfs_mounts
+from my_snaps.Metrics import Metrics
+from my_snaps.Profiler import profiler
 
 class BtSmartBalance:
     """ Methods to do BTRFS balancing when needed """
-    def __init__(self, options):
-        self.opts = options # gets: mount_point, allocated_pct_min, wasted_pct_min
+    profile_names = ('data', 'metadata', 'system')
+    sysfs = '/sys/fs/btrfs'
+
+    history_max = 520 # about 10 years of weekly runs
+    threshold_keys = {'a': 'allocated_pct_min', 'w': 'wasted_pct_min',
+                      'W': 'meta_wasted_pct_min', 'd': 'dusage'}
+
+    def __init__(self, options, uuid='', tag='', metrics=None):
+        self.opts = options # gets: mount_point, allocated_pct_min, wasted_pct_min, ...
+        self.uuid = uuid # if known (else found from the mount point)
+        self.tag = tag # prefix for output lines when running several
+        self.metrics = metrics # a Metrics if --metrics-file
+        profiler.instrument(self, ('get_usage', 'decide', 'balance_filesystem',
+                'stepped_balance', 'run_balance_step', 'save_history'))
         self.allocated_pct, self.wasted_pct = 0, 0 # computed actual
-        self.device_size, self.allocated, self.used = 0, 0, 0
+        self.data_wasted_pct, self.meta_wasted_pct = 0, 0
+        self.device_size, self.allocated, self.used = 0, 0, 0 # in bytes
+        self.profiles = {} # profile name => ns(disk_total, disk_used) in raw bytes
+        self.source = '' # where the stats came from
+        self.now = 0
+        self.reclaimed = None # bytes, when known (i.e., after stepped balance)
+        self.pressure_secs = 0.0 # paused under pressure (not charged to the budget)
+        self.forecast_days = {} # threshold name => days to cross (or None)
         self.do_balance = False
+        self.do_data, self.do_meta = False, False
+
+    def get_sysfs_usage(self):
+        """Read exact byte counts per profile from /sys/fs/btrfs/<uuid>/
+        (i.e., w/o running anything); returns False if not available."""
+        def read_int(pathname):
+            with open(pathname, 'r', encoding='utf-8') as fh:
+                return int(fh.read().strip())
+
+        uuids = [self.uuid] if self.uuid else [
+                x.uuid for x in btrfs_mounts(sysfs=self.sysfs)
+                if x.mount == self.opts.mount_point and x.uuid]
+        if not uuids:
+            return False
+        self.uuid = uuids[0]
+        base = os.path.join(self.sysfs, self.uuid)
+        try:
+            profiles = {}
+            for name in self.profile_names:
+                folder = os.path.join(base, 'allocation', name)
+                profiles[name] = SimpleNamespace(
+                    disk_total=read_int(os.path.join(folder, 'disk_total')),
+                    disk_used=read_int(os.path.join(folder, 'disk_used')))
+            device_size = 0
+            for dev_dir in glob.glob(os.path.join(base, 'devices', '*')):
+                device_size += read_int(os.path.join(dev_dir, 'size')) * 512
+        except (OSError, ValueError):
+            return False
+        if not device_size:
+            return False
+        self.set_usage(device_size, profiles, source='sysfs')
+        return True
+
+    def set_usage(self, device_size, profiles, source):
+        """Set the stats from the device size and per-profile raw bytes."""
+        self.device_size, self.profiles, self.source = device_size, profiles, source
+        self.allocated = sum(x.disk_total for x in profiles.values())
+        self.used = sum(x.disk_used for x in profiles.values())
+
+    def say(self, *args):
+        """Print, prefixed by the tag if any (so parallel output is legible)."""
+        if self.tag:
+            print(f'[{self.tag}]', *args, flush=True)
+        else:
+            print(*args)
 
     def get_bt_usage(self):
-        """Retrieve Btrfs filesystem usage details."""
+        """Retrieve Btrfs filesystem usage details (in bytes)."""
         try:
             result = subprocess.run(
-                f'sudo btrfs filesystem usage {self.opts.mount_point}'.split(),
+                ['sudo', 'btrfs', 'filesystem', 'usage', '-b', self.opts.mount_point],
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                 text=True, check=True)
             return result.stdout
         except subprocess.CalledProcessError as e:
-            print(f"Error retrieving usage data: {e}")
+            self.say(f"Error retrieving usage data: {e}")
             return None
 
     def parse_usage_data(self, usage_data):
-        """Parse the relevant data from the Btrfs usage output."""
+        """Parse the relevant data from the Btrfs usage output which is
+        normally in bytes (-b), but human units (e.g., 1.5GiB) are handled."""
+        def to_bytes(number, unit):
+            power = ' KMGTPE'.index(unit[0].upper()) if unit and unit[0] != 'B' else 0
+            return int(round(float(number) * (1024 ** power)))
+
         def parse_value(pattern, data):
-            # ignore anything less and GiB and assume not greater than TiB
-            pattern += r':\s+([\d.]+)([GT])'
+            pattern += r':\s+([\d.]+)\s*([KMGTPE]i?B|B)?'
             match = re.search(pattern, data)
-            if match:
-                rv = float(match.group(1))
-                if match.group(2) == 'T':
-                    rv *= 1024
-                return round(rv, 2)
-            return 0.0
+            return to_bytes(match.group(1), match.group(2)) if match else 0
 
-        self.device_size = parse_value(r'Device size', usage_data)
-        self.allocated = parse_value(r'Device allocated', usage_data)
-        self.used = parse_value(r'Used', usage_data)
+        device_size = parse_value(r'Device size', usage_data)
+        profiles = {}
+        # Data,single: Size:107374182400, Used:64424509440 (60.00%)
+        for match in re.finditer(r'^(Data|Metadata|System),\S+:\s+Size:([\d.]+)\s*([KMGTPE]i?B|B)?'
+                                 r',\s+Used:([\d.]+)\s*([KMGTPE]i?B|B)?', usage_data, re.MULTILINE):
+            name = match.group(1).lower()
+            ratio = re.search(rf'^\s*{match.group(1)} ratio:\s+([\d.]+)', usage_data, re.MULTILINE)
+            ratio = float(ratio.group(1)) if ratio else 1.0
+            ns = profiles.get(name, SimpleNamespace(disk_total=0, disk_used=0))
+            ns.disk_total += int(to_bytes(match.group(2), match.group(3)) * ratio)
+            ns.disk_used += int(to_bytes(match.group(4), match.group(5)) * ratio)
+            profiles[name] = ns
+        if not profiles: # w/o the breakdown, count it all as data
+            profiles['data'] = SimpleNamespace(
+                disk_total=parse_value(r'Device allocated', usage_data),
+                disk_used=parse_value(r'Used', usage_data))
+        self.set_usage(device_size, profiles, source='btrfs-usage')
+        # prefer the overall figures (they include unlisted profiles)
+        self.allocated = parse_value(r'Device allocated', usage_data) or self.allocated
+        self.used = parse_value(r'Used', usage_data) or self.used
+
+    def wasted_pct_of(self, name):
+        """Percent of the device allocated to the profile but unused."""
+        ns = self.profiles.get(name, None)
+        if not ns or not self.device_size:
+            return 0
+        return int(round(100.0 * (ns.disk_total - ns.disk_used) / self.device_size, 0))
 
     def should_balance(self):
-        """Determine if a balance is necessary based on thresholds."""
+        """Determine if a balance is necessary based on thresholds.
+        Data and metadata waste are weighed separately so that only the
+        needed block groups are balanced."""
         self.allocated_pct = int(round(100.0 * self.allocated / self.device_size, 0))
         self.wasted_pct = int(round(100.0 * (self.allocated - self.used) / self.device_size, 0))
+        self.data_wasted_pct = self.wasted_pct_of('data')
+        self.meta_wasted_pct = self.wasted_pct_of('metadata')
 
-        self.do_balance = bool(self.allocated_pct >= self.opts.allocated_pct_min
-                               or self.wasted_pct >= self.opts.wasted_pct_min)
+        full = bool(self.allocated_pct >= self.opts.allocated_pct_min)
+        self.do_data = bool(full or self.data_wasted_pct >= self.opts.wasted_pct_min
+                            or ('metadata' not in self.profiles
+                                and self.wasted_pct >= self.opts.wasted_pct_min))
+        self.do_meta = bool(self.meta_wasted_pct >= self.opts.meta_wasted_pct_min)
+        self.do_balance = self.do_data or self.do_meta
         return self.do_balance
 
     def balance_filesystem(self):
-        """Perform the Btrfs balance operation."""
+        """Perform the Btrfs balance operation; returns 'launched' or
+        'failed' (or when supervised, how it ended)."""
+        if self.opts.supervise: # must stay in the foreground to supervise
+            deadline = time.monotonic() + self.opts.budget_mins * 60
+            status = self.run_balance_step(self.opts.dusage, deadline)
+            self.say(f'BALANCE: {status}')
+            return status
+        cmd = ['sudo', 'btrfs', 'balance', 'start']
+        if self.do_data:
+            cmd.append(f'-dusage={self.opts.dusage}')
+        if self.do_meta:
+            cmd.append(f'-musage={self.opts.dusage}')
+        cmd += ['--bg', self.opts.mount_point]
         try:
-            cmd = f'sudo btrfs balance start -dusage={self.opt.dusage}'
-            cmd = f' --bg {self.opts.mount_point}'
-            subprocess.run(cmd.split(), check=True)
-            print(f'LAUNCHED: {cmd}')
+            subprocess.run(cmd, check=True)
+            self.say(f'LAUNCHED: {" ".join(cmd)}')
+            return 'launched'
         except subprocess.CalledProcessError as e:
-            print(f"Error starting balance: {e}")
+            self.say(f"Error starting balance: {e}")
+            return 'failed'
 
-    def main_loop(self):
-        """ Logic when run as a program """
-        usage_data = self.get_bt_usage()
+    def run_balance_step(self, usage, deadline):
+        """Run one foreground balance with the given usage filter on the
+        needed block group types; cancels it if the deadline passes.
+        Returns 'done', 'failed', or 'timeout'."""
+        cmd = ['sudo', 'btrfs', 'balance', 'start']
+        if self.do_data:
+            cmd.append(f'-dusage={usage}')
+        if self.do_meta:
+            cmd.append(f'-musage={usage}')
+        cmd.append(self.opts.mount_point)
+        if self.opts.supervise:
+            return self.supervise(subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                                   stderr=subprocess.DEVNULL), deadline)
+        with subprocess.Popen(cmd, stdout=subprocess.DEVNULL) as proc:
+            try:
+                rc = proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                subprocess.run(['sudo', 'btrfs', 'balance', 'cancel', self.opts.mount_point],
+                               check=False, stdout=subprocess.DEVNULL)
+                proc.wait()
+                return 'timeout'
+        return 'done' if rc == 0 else 'failed'
+
+    @staticmethod
+    def read_psi(resource, proc_pressure='/proc/pressure'):
+        """The 'some' avg10 pressure percent of 'io' or 'cpu' (None if
+        PSI is not available)."""
+        try:
+            with open(os.path.join(proc_pressure, resource), 'r', encoding='utf-8') as fh:
+                for line in fh:
+                    if line.startswith('some '):
+                        return float(line.split('avg10=')[1].split()[0])
+        except (OSError, IndexError, ValueError):
+            pass
+        return None
+
+    def in_window(self, when=None):
+        """Whether now (or 'when') is within the maintenance window (if any);
+        a window like 22:00-05:00 wraps past midnight."""
+        if not self.opts.window:
+            return True
+        start, end = self.opts.window
+        when = when or datetime.now()
+        minute = when.hour * 60 + when.minute
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end
+
+    def pause_reason(self, paused):
+        """Why the balance should be (or stay) paused, else ''. Once paused,
+        pressure must drop below the lower resume threshold (hysteresis)."""
+        if not self.in_window():
+            return 'outside maintenance window'
+        limit = self.opts.psi_resume if paused else self.opts.psi_max
+        for resource in ('io', 'cpu'):
+            pressure = self.read_psi(resource)
+            if pressure is not None and pressure >= limit:
+                return f'{resource} pressure {pressure:.1f}% >= {limit}%'
+        return ''
+
+    def balance_running(self):
+        """Whether a balance is running or paused on the mount point (per
+        "btrfs balance status"); True if that cannot be told."""
+        proc = subprocess.run(['sudo', 'btrfs', 'balance', 'status', self.opts.mount_point],
+                              check=False, capture_output=True, text=True)
+        return 'No balance found' not in proc.stdout
+
+    def supervise(self, proc, deadline):
+        """Watch a foreground balance, pausing it while IO/CPU pressure is high
+        or outside the maintenance window and resuming when it is calm again;
+        cancels it if the deadline (extended by the time paused under pressure)
+        passes. Returns 'done', 'failed', or 'timeout'."""
+        mount_point = self.opts.mount_point
+        paused, status, paused_why = False, '', ''
+        active_secs, paused_secs, pauses = 0.0, 0.0, 0
+        last = time.monotonic()
+        while not status:
+            time.sleep(self.opts.psi_poll)
+            now = time.monotonic()
+            if paused:
+                paused_secs += now - last
+                if 'pressure' in paused_why:
+                    self.pressure_secs += now - last
+            else:
+                active_secs += now - last
+            last = now
+            if proc and proc.poll() is not None:
+                if not paused:
+                    status = 'done' if proc.returncode == 0 else 'failed'
+                    break
+                proc = None # "balance start" returns when paused
+                if not self.balance_running(): # it finished before the pause took
+                    status = 'done'
+                    break
+            if now >= deadline + self.pressure_secs:
+                subprocess.run(['sudo', 'btrfs', 'balance', 'cancel', mount_point],
+                               check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                status = 'timeout'
+                break
+            why = self.pause_reason(paused)
+            paused_why = why if paused and why else paused_why
+            if why and not paused:
+                subprocess.run(['sudo', 'btrfs', 'balance', 'pause', mount_point],
+                               check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                paused, pauses, paused_why = True, pauses + 1, why
+                self.say(f'PAUSE: {why}')
+            elif not why and paused:
+                if proc:
+                    proc.wait()
+                    proc = None
+                if not self.balance_running(): # e.g., it ended as it was paused
+                    status = 'done'
+                    break
+                proc = subprocess.Popen(['sudo', 'btrfs', 'balance', 'resume', mount_point],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                paused = False
+                self.say('RESUME: pressure is down')
+        if proc:
+            proc.wait()
+        self.say(f'SUPERVISED: {status} active={active_secs:.0f}s'
+                 f' paused={paused_secs:.0f}s pauses={pauses}')
+        return status
+
+    def stepped_balance(self):
+        """Balance with increasing usage filters (e.g., 0, 5, 10, 20), so that
+        the cheap, nearly empty block groups go first; after each step,
+        re-check the thresholds and stop when below them or when the
+        wall-clock budget is spent. Returns how the last step ended."""
+        deadline = time.monotonic() + self.opts.budget_mins * 60
+        total, status = 0, 'done'
+        for usage in self.opts.steps:
+            if time.monotonic() >= deadline + self.pressure_secs:
+                self.say(f'STOP: budget of {self.opts.budget_mins}m spent')
+                status = 'timeout'
+                break
+            before, started = self.allocated, time.monotonic()
+            status = self.run_balance_step(usage, deadline)
+            if not self.get_usage():
+                self.say('Failed to retrieve filesystem usage data.')
+                status = 'failed'
+                break
+            reclaimed = before - self.allocated
+            total += reclaimed
+            self.say(f'STEP usage={usage}: {status} in {time.monotonic()-started:.0f}s'
+                     f' reclaimed={human(max(0, reclaimed))}'
+                     f' allocated={human(self.allocated)}')
+            if status != 'done':
+                break
+            if not self.should_balance():
+                self.say('STOP: now below thresholds')
+                break
+        self.say(f'RECLAIMED: {human(max(0, total))} total')
+        self.reclaimed = max(0, total)
+        return status
 
+    def history_path(self):
+        """The history file for this filesystem (by UUID if known)."""
+        key = self.uuid or re.sub(r'[^\w.-]', '_', self.opts.mount_point.strip('/')) or 'root'
+        return os.path.join(self.opts.history_dir, f'{key}.csv')
+
+    def load_history(self):
+        """Read the history as a list of ns(epoch, device_size, allocated,
+        used, wasted, balanced); missing/garbled lines are skipped."""
+        rv = []
+        try:
+            with open(self.history_path(), 'r', encoding='utf-8') as fh:
+                for line in fh:
+                    wds = line.strip().split(',')
+                    if len(wds) == 6:
+                        try:
+                            rv.append(SimpleNamespace(epoch=int(wds[0]),
+                                device_size=int(wds[1]), allocated=int(wds[2]),
+                                used=int(wds[3]), wasted=int(wds[4]), balanced=wds[5] == 'B'))
+                        except ValueError:
+                            continue
+        except OSError:
+            pass
+        return rv
+
+    def save_history(self, history):
+        """Write the latest entries of the history (one short CSV line per
+        run: epoch,device_size,allocated,used,wasted,B|-) atomically."""
+        history = history[-self.history_max:]
+        pathname = self.history_path()
+        try:
+            os.makedirs(os.path.dirname(pathname), exist_ok=True)
+            with open(pathname + '.tmp', 'w', encoding='utf-8') as fh:
+                for ns in history:
+                    fh.write(f'{ns.epoch},{ns.device_size},{ns.allocated},{ns.used},'
+                             f'{ns.wasted},{"B" if ns.balanced else "-"}\n')
+            os.replace(pathname + '.tmp', pathname)
+        except OSError as exc:
+            self.say(f'WARN: cannot save history: {exc}')
+
+    def forecast(self, history):
+        """Fit the allocated% and wasted% trends since the last balance (a
+        balance resets them) and estimate the days until each threshold is
+        crossed; sets self.forecast_days = {'allocated': days, 'wasted': days}
+        with None where not rising or unknown."""
+        since = [ns for ns in history if ns.device_size]
+        for idx in range(len(since) - 1, -1, -1):
+            if since[idx].balanced:
+                since = since[idx + 1:]
+                break
+        since = [ns for ns in since if ns.epoch >= time.time() - self.opts.forecast_span * 86400]
+        self.forecast_days = {}
+        for name, thresh in (('allocated', self.opts.allocated_pct_min),
+                             ('wasted', self.opts.wasted_pct_min)):
+            points = [((ns.epoch - self.now) / 86400,
+                       100.0 * getattr(ns, name) / ns.device_size) for ns in since]
+            current = self.allocated if name == 'allocated' else self.allocated - self.used
+            points.append((0.0, 100.0 * current / self.device_size))
+            fit = linear_fit(points)
+            days = None
+            if fit and fit[0] > 0:
+                days = max(0.0, (thresh - fit[1]) / fit[0])
+            self.forecast_days[name] = days
+        return self.forecast_days
+
+    def forecast_str(self):
+        """Describe the forecast for the output."""
+        parts = []
+        for name, days in self.forecast_days.items():
+            parts.append(f'{name}: {"flat/falling" if days is None else f"~{days:.0f}d"}')
+        return '    forecast (days to threshold): ' + ', '.join(parts)
+
+    def get_usage(self):
+        """Get the stats from sysfs else from "btrfs filesystem usage";
+        returns False on failure."""
+        if self.opts.stats != 'cli' and self.get_sysfs_usage():
+            return True
+        if self.opts.stats == 'sysfs':
+            return False
+        usage_data = self.get_bt_usage()
         if usage_data:
             self.parse_usage_data(usage_data)
-            if self.should_balance():
-                self.balance_filesystem()
+            return bool(self.device_size)
+        return False
+
+    def decide(self, history):
+        """Apply the thresholds plus the forecast: balance early if a
+        threshold will be crossed before the next run, and skip a balance
+        that the allocated% alone triggers when there is nothing to reclaim."""
+        if self.should_balance():
+            if (self.allocated_pct >= self.opts.allocated_pct_min
+                    and not self.do_meta and self.wasted_pct < 1):
+                self.do_balance = self.do_data = False
+                return 'skip: over allocated% but nothing to reclaim'
+            return 'over threshold'
+        if not history:
+            return ''
+        self.forecast(history)
+        soon = [name for name, days in self.forecast_days.items()
+                if days is not None and days <= self.opts.forecast_days]
+        if soon:
+            self.do_balance = self.do_data = True
+            return f'early: {"/".join(soon)} forecast to cross within {self.opts.forecast_days}d'
+        return ''
+
+    def main_loop(self):
+        """ Logic when run as a program """
+        if self.get_usage():
+            self.now = int(time.time())
+            history = self.load_history()
+            why = self.decide(history)
+            if not self.forecast_days:
+                self.forecast(history)
+            row = SimpleNamespace(epoch=self.now, device_size=self.device_size,
+                    allocated=self.allocated, used=self.used,
+                    wasted=self.allocated - self.used, balanced=False) # the stats before any balance
+            self.say(f'BTRFS stats ({self.source}): used={human(self.used)}'
+                     f' allocated={human(self.allocated)} device_size={human(self.device_size)}')
+            for name, ns in self.profiles.items():
+                self.say(f'    {name:>8}: allocated={human(ns.disk_total)} used={human(ns.disk_used)}'
+                         f' wasted={self.wasted_pct_of(name)}%')
+            self.say(f'    tests:  wasted={self.wasted_pct}% [data={self.data_wasted_pct}%'
+                     f' min={self.opts.wasted_pct_min}%; metadata={self.meta_wasted_pct}%'
+                     f' min={self.opts.meta_wasted_pct_min}%]',
+                     f'OR allocated={self.allocated_pct}% [min={self.opts.allocated_pct_min}%]')
+            self.say(self.forecast_str(), f'[{len(history)} runs of history]')
+            if self.do_balance and self.opts.supervise and not self.in_window():
+                self.say('No balance now: outside maintenance window.')
+            elif self.do_balance:
+                self.say(f'BALANCE: {why}')
+                started = time.monotonic()
+                status = self.stepped_balance() if self.opts.steps else self.balance_filesystem()
+                if self.metrics:
+                    self.metrics.record_op('balance', started,
+                        {'done': 0, 'launched': 0, 'timeout': 2}.get(status, 1),
+                        mount=self.opts.mount_point)
+                row.balanced = status in ('done', 'launched') or bool(self.reclaimed) # trends restart
             else:
-                print("No balance needed based on current usage data.")
-            print(f'BTRFS stats (GiB): used={self.used} allocated={self.allocated}',
-                  f'device_size={self.device_size}')
-            print(f'    tests:  wasted={self.wasted_pct}% [min={self.opts.wasted_pct_min}%]',
-                  f'OR allocated={self.allocated_pct}% [min={self.opts.allocated_pct_min}%]')
+                self.say(f'No balance needed based on current usage data{"; " + why if why else ""}.')
+            history.append(row)
+            self.save_history(history)
+            self.set_metrics()
         else:
-            print("Failed to retrieve filesystem usage data.")
+            self.say("Failed to retrieve filesystem usage data.")
+            if self.metrics:
+                self.metrics.set('btrfs_balance_stats_ok', 0,
+                        'whether the usage stats could be read', mount=self.opts.mount_point)
+
+    def set_metrics(self):
+        """Add this filesystem's stats and forecast to the metrics (if any)."""
+        if not self.metrics:
+            return
+        mount, put = self.opts.mount_point, self.metrics.set
+        put('btrfs_balance_stats_ok', 1, 'whether the usage stats could be read', mount=mount)
+        put('btrfs_balance_device_bytes', self.device_size, 'device size', mount=mount)
+        put('btrfs_balance_allocated_bytes', self.allocated, 'bytes allocated to block groups',
+            mount=mount)
+        put('btrfs_balance_used_bytes', self.used, 'bytes used within block groups', mount=mount)
+        put('btrfs_balance_allocated_percent', self.allocated_pct,
+            'allocated percent of the device', mount=mount)
+        put('btrfs_balance_wasted_percent', self.wasted_pct,
+            'allocated but unused percent of the device', mount=mount, profile='all')
+        for name in self.profiles:
+            put('btrfs_balance_wasted_percent', self.wasted_pct_of(name),
+                'allocated but unused percent of the device', mount=mount, profile=name)
+        put('btrfs_balance_needed', int(self.do_balance),
+            'whether the last run decided to balance', mount=mount)
+        for name, days in self.forecast_days.items():
+            if days is not None:
+                put('btrfs_balance_forecast_days', round(days, 1),
+                    'forecast days until the threshold is crossed', mount=mount, threshold=name)
+        if self.reclaimed is not None:
+            put('btrfs_balance_reclaimed_bytes', self.reclaimed,
+                'bytes reclaimed by the last stepped balance', mount=mount)
+        put('btrfs_balance_last_run_timestamp_seconds', self.now,
+            'when bt-smart-balance last ran', mount=mount)
 
     def install_cron_job(self):
         """ Add/replace an anacron job for scheduled snapshots """
@@ -89,13 +520,112 @@ class BtSmartBalance:
         text = '#!/bin/bash\n'
         text += f'( date; {sys.executable} {os.path.abspath(__file__)}'
         text += f' -a{self.opts.allocated_pct_min}'
-        text += f' -w{self.opts.wasted_pct_min} -m{self.opts.mount_point!r}'
+        text += f' -w{self.opts.wasted_pct_min} -W{self.opts.meta_wasted_pct_min}'
+        text += f' -d{self.opts.dusage} -f{self.opts.forecast_days}'
+        if self.opts.history_dir != '/var/lib/bt-smart-balance':
+            text += f' --history-dir {shlex.quote(os.path.abspath(self.opts.history_dir))}'
+        if self.opts.metrics_file:
+            text += f' --metrics-file {shlex.quote(os.path.abspath(self.opts.metrics_file))}'
+        if self.opts.all:
+            text += ' --all'
+            for spec in self.opts.thresholds:
+                text += f' -t{spec!r}'
+        else:
+            text += f' -m{self.opts.mount_point!r}'
+        if self.opts.supervise:
+            if not self.opts.steps:
+                text += f' -b{self.opts.budget_mins}'
+            text += f' -S --psi-max {self.opts.psi_max} --psi-resume {self.opts.psi_resume}'
+            if self.opts.window:
+                text += ' --window {:02d}:{:02d}-{:02d}:{:02d}'.format(
+                    *divmod(self.opts.window[0], 60), *divmod(self.opts.window[1], 60))
+        if self.opts.steps:
+            text += f' -s{",".join(str(x) for x in self.opts.steps)} -b{self.opts.budget_mins}'
         text += ') >/tmp/bt-smart-balance-job.txt 2>&1\n'
         with open(filename, mode='w', encoding='utf-8') as f:
             f.write(text)
         os.chmod(filename, 0o755)
         print(f'OK: to {filename!r}, wrote:\n{text}')
 
+def linear_fit(points):
+    """Least squares fit of [(x, y), ...]; returns (slope, intercept)
+    or None if there are too few distinct x values."""
+    if len(points) < 2:
+        return None
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x <= 0:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    return slope, mean_y - slope * mean_x
+
+def physical_disks(dev_name, sys_block='/sys/class/block'):
+    """The whole disks under a block device name (e.g., 'nvme0n1p2' =>
+    {'nvme0n1'}; 'dm-0' => the disks of its slaves)."""
+    path = os.path.join(sys_block, dev_name)
+    slaves = os.path.join(path, 'slaves')
+    if os.path.isdir(slaves) and os.listdir(slaves):
+        rv = set()
+        for slave in os.listdir(slaves):
+            rv |= physical_disks(slave, sys_block)
+        return rv
+    if os.path.exists(os.path.join(path, 'partition')):
+        return {os.path.basename(os.path.dirname(os.path.realpath(path)))}
+    return {dev_name}
+
+def balance_all(opts, metrics=None):
+    """Evaluate/balance every mounted BTRFS filesystem once (by UUID), each
+    with its own thresholds; those sharing no physical disk run in parallel
+    while those sharing a disk run one after the other."""
+    filesystems = {} # uuid => ns(mount, disks)
+    for mnt in btrfs_mounts(sysfs=BtSmartBalance.sysfs):
+        if not mnt.uuid or mnt.uuid in filesystems:
+            continue
+        devs_dir = os.path.join(BtSmartBalance.sysfs, mnt.uuid, 'devices')
+        disks = set()
+        for dev in os.listdir(devs_dir):
+            disks |= physical_disks(dev)
+        filesystems[mnt.uuid] = SimpleNamespace(mount=mnt.mount, disks=disks)
+    if not filesystems:
+        print('No mounted BTRFS filesystems found.')
+        return
+
+    groups = [] # lists of uuids that share disks (transitively)
+    for uuid, fs in filesystems.items():
+        joined = [g for g in groups if any(fs.disks & filesystems[x].disks for x in g)]
+        group = [uuid] + [x for g in joined for x in g]
+        groups = [g for g in groups if g not in joined] + [group]
+
+    def run_group(group):
+        for uuid in group:
+            fs_opts = copy.copy(opts)
+            fs_opts.mount_point = filesystems[uuid].mount
+            for key, value in opts.mount_thresholds.get(fs_opts.mount_point, {}).items():
+                setattr(fs_opts, key, value)
+            BtSmartBalance(fs_opts, uuid=uuid, tag=fs_opts.mount_point,
+                           metrics=metrics).main_loop()
+
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        for future in [executor.submit(run_group, g) for g in groups]:
+            future.result()
+
+def parse_thresholds(specs):
+    """Parse 'MOUNT:a=80,w=10,W=5,d=20' specs into {mount: {attr: value}}."""
+    rv = {}
+    for spec in specs:
+        mount, _, assigns = spec.rpartition(':')
+        if not mount:
+            raise ValueError(f'no mount point in {spec!r}')
+        for assign in assigns.split(','):
+            key, _, value = assign.partition('=')
+            if key.strip() not in BtSmartBalance.threshold_keys:
+                raise ValueError(f'unknown key {key!r} in {spec!r}')
+            attr = BtSmartBalance.threshold_keys[key.strip()]
+            rv.setdefault(mount, {})[attr] = max(0, min(99, int(value)))
+    return rv
+
 def rerun_module_as_root(module_name):
     """ rerun using the module name """
     if os.geteuid() != 0: # Re-run the script with sudo
@@ -114,21 +644,83 @@ def run():
             help='pass thru to balance (less is more aggressive) [0<=val<=99,dflt=20]')
     parser.add_argument('-w', '--wasted-pct-min', type=int, default=7,
             help='min wasted percent to balance [0<=val<=99,dflt=7]')
+    parser.add_argument('-W', '--meta-wasted-pct-min', type=int, default=5,
+            help='min wasted metadata percent to balance metadata [0<=val<=99,dflt=5]')
+    parser.add_argument('--stats', choices=('auto', 'sysfs', 'cli'), default='auto',
+            help='where to get usage: sysfs, "btrfs filesystem usage", or auto [dflt=auto]')
+    parser.add_argument('-s', '--steps', type=str, default='',
+            help='balance in foreground steps with these usage filters, e.g. 0,5,10,20'
+                 ' [dflt=one --bg balance]')
+    parser.add_argument('-b', '--budget-mins', type=float, default=60,
+            help='wall-clock budget for stepped balance in minutes [dflt=60]')
     parser.add_argument('-m', '--mount-point', type=str, default='/',
             help='BTRFS mount point [dflt=/]')
+    parser.add_argument('--history-dir', type=str, default='/var/lib/bt-smart-balance',
+            help='where per-filesystem usage history is kept [dflt=/var/lib/bt-smart-balance]')
+    parser.add_argument('-f', '--forecast-days', type=float, default=7,
+            help='balance early if a threshold is forecast to be crossed within'
+                 ' this many days [dflt=7, i.e., before the next weekly run]')
+    parser.add_argument('--forecast-span', type=float, default=90,
+            help='days of history to fit the trends over [dflt=90]')
+    parser.add_argument('-S', '--supervise', action="store_true",
+            help='run the balance in the foreground, pausing it while IO/CPU pressure'
+                 ' is high or outside the --window (implies --budget-mins)')
+    parser.add_argument('--psi-max', type=float, default=20,
+            help='pause when IO or CPU "some" avg10 pressure reaches this percent [dflt=20]')
+    parser.add_argument('--psi-resume', type=float, default=5,
+            help='resume when pressure drops below this percent [dflt=5]')
+    parser.add_argument('--psi-poll', type=float, default=5,
+            help='seconds between pressure checks [dflt=5]')
+    parser.add_argument('--window', type=str, default='',
+            help='maintenance window (local time) for supervised balances, e.g. 01:00-05:00')
+    parser.add_argument('-A', '--all', action="store_true",
+            help='balance every mounted BTRFS filesystem (ignores --mount-point)')
+    parser.add_argument('-t', '--thresholds', action='append', default=[],
+            help='per-mount thresholds for --all, e.g. /data:a=80,w=10,W=5,d=20 (repeatable)')
+    parser.add_argument('--metrics-file', type=str, default='',
+            help='write node-exporter textfile metrics to this file'
+                 ' (e.g., /var/lib/node_exporter/bt-smart-balance.prom)')
+    parser.add_argument('--profile', type=str, default='', metavar='TRACE_JSON',
+            help='record wall/CPU time per phase and external command to this'
+                 ' Chrome trace file and print a summary at exit')
+    parser.add_argument('--profile-mem', action="store_true",
+            help='with --profile, also record tracemalloc peaks per phase')
     parser.add_argument('-i', '--install-anacron-job', action="store_true",
             help='creates a script in /etc/cron.weekly with current args')
 
     opts = parser.parse_args()
     opts.allocated_pct_min = max(0, min(99, opts.allocated_pct_min))
     opts.wasted_pct_min = max(0, min(99, opts.wasted_pct_min))
+    opts.meta_wasted_pct_min = max(0, min(99, opts.meta_wasted_pct_min))
     opts.dusage = max(0, min(99, opts.dusage))
+    try:
+        opts.steps = sorted(set(max(0, min(99, int(x)))
+                                for x in opts.steps.split(',') if x.strip()))
+    except ValueError:
+        parser.error(f'invalid --steps {opts.steps!r} (e.g., 0,5,10,20)')
+    window = re.match(r'^(\d\d?):(\d\d)-(\d\d?):(\d\d)$', opts.window.strip())
+    if opts.window and not window:
+        parser.error(f'invalid --window {opts.window!r} (e.g., 01:00-05:00)')
+    opts.window = ((int(window.group(1)) * 60 + int(window.group(2)),
+                    int(window.group(3)) * 60 + int(window.group(4))) if window else None)
+    try:
+        opts.mount_thresholds = parse_thresholds(opts.thresholds)
+    except ValueError as exc:
+        parser.error(f'invalid --thresholds: {exc}')
 
-    tool = BtSmartBalance(options=opts)
+    if opts.profile:
+        profiler.start(opts.profile, trace_malloc=opts.profile_mem)
+    metrics = Metrics(opts.metrics_file) if opts.metrics_file else None
+    tool = BtSmartBalance(options=opts, metrics=metrics)
     if opts.install_anacron_job:
         tool.install_cron_job()
+        return
+    if opts.all:
+        balance_all(opts, metrics=metrics)
     else:
         tool.main_loop()
+    if metrics:
+        metrics.write()
 
 if __name__ == "__main__":
     run()
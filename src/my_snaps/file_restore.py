@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+File-level restore: copy selected paths from a snapshot back into the
+live subvolume w/o a reboot.  Files are reflinked (FICLONE) so even
+huge ones restore in constant time using no extra space; when that is
+not possible (e.g., another filesystem), copy_file_range and then a
+plain copy are the fallbacks.  Directories are walked in parallel.
+Each file is written to a temporary name and renamed over the
+original, so a failure never leaves a half-restored file.  Paths that
+exist only in the live subvolume are left alone.
+"""
+# pylint: disable=invalid-name,too-many-instance-attributes,import-outside-toplevel
+import os
+import sys
+import stat
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from types import SimpleNamespace
+from my_snaps.Profiler import profiler
+from my_snaps.MyUtils import snapshot_subvol
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int)
+
+class FileRestore:
+    """ Restores paths (relative to the subvolume) from src_root (the
+    snapshot) into dst_root (where the live subvolume is mounted). """
+    def __init__(self, src_root, dst_root, jobs=8, dry_run=False, say=print):
+        self.src_root, self.dst_root = src_root, dst_root
+        self.jobs, self.dry_run, self.say = max(1, jobs), dry_run, say
+        self.lock = threading.Lock()
+        self.stats = SimpleNamespace(files=0, dirs=0, links=0, bytes=0,
+                                     cloned=0, copied=0, unchanged=0, errors=0)
+
+    def _count(self, **deltas):
+        with self.lock:
+            for key, delta in deltas.items():
+                setattr(self.stats, key, getattr(self.stats, key) + delta)
+
+    @staticmethod
+    def same_file(src_st, dst_path):
+        """ Whether dst already matches (same size and mtime)."""
+        try:
+            dst_st = os.lstat(dst_path)
+        except OSError:
+            return False
+        return (stat.S_IFMT(dst_st.st_mode) == stat.S_IFMT(src_st.st_mode)
+                and dst_st.st_size == src_st.st_size
+                and dst_st.st_mtime_ns == src_st.st_mtime_ns)
+
+    @staticmethod
+    def _copy_data(src_fd, dst_fd, size):
+        """ Reflink the data if possible; returns 'cloned' or 'copied'."""
+        import fcntl
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return 'cloned'
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL,
+                                 errno.ENOTTY, errno.EPERM):
+                raise
+        offset = 0
+        try:
+            while offset < size: # reflinks too where the kernel can
+                done = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+                if not done:
+                    break
+                offset += done
+        except (OSError, AttributeError):
+            offset = 0
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+            while True:
+                chunk = os.read(src_fd, 1 << 20)
+                if not chunk:
+                    break
+                os.write(dst_fd, chunk)
+        return 'copied'
+
+    @staticmethod
+    def _copy_meta(src_st, dst_path, follow=True):
+        if stat.S_ISDIR(src_st.st_mode): # via the directory itself; never a symlink to one
+            fd = os.open(dst_path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+            try:
+                os.fchown(fd, src_st.st_uid, src_st.st_gid)
+                os.fchmod(fd, stat.S_IMODE(src_st.st_mode))
+                os.utime(fd, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+            finally:
+                os.close(fd)
+            return
+        os.chown(dst_path, src_st.st_uid, src_st.st_gid, follow_symlinks=follow)
+        if follow:
+            os.chmod(dst_path, stat.S_IMODE(src_st.st_mode))
+        os.utime(dst_path, ns=(src_st.st_atime_ns, src_st.st_mtime_ns), follow_symlinks=follow)
+
+    def restore_file(self, rel, src_st):
+        """ Restore one non-directory (file, symlink, or special)."""
+        src, dst = os.path.join(self.src_root, rel), os.path.join(self.dst_root, rel)
+        if self.same_file(src_st, dst):
+            self._count(unchanged=1)
+            return
+        if self.dry_run:
+            verb = '~' if os.path.lexists(dst) else '+'
+            self.say(f'{verb} {rel}' + (f' ({src_st.st_size} bytes)'
+                                        if stat.S_ISREG(src_st.st_mode) else ''))
+            if stat.S_ISLNK(src_st.st_mode):
+                self._count(links=1)
+            else:
+                self._count(files=1, bytes=src_st.st_size if stat.S_ISREG(src_st.st_mode) else 0)
+            return
+        tmp = os.path.join(os.path.dirname(dst), f'.{os.path.basename(dst)}.restore-{os.getpid()}')
+        try:
+            if stat.S_ISLNK(src_st.st_mode):
+                os.symlink(os.readlink(src), tmp)
+                self._copy_meta(src_st, tmp, follow=False)
+                os.replace(tmp, dst)
+                self._count(links=1)
+                return
+            if not stat.S_ISREG(src_st.st_mode):
+                os.mknod(tmp, src_st.st_mode, src_st.st_rdev)
+                self._copy_meta(src_st, tmp)
+                os.replace(tmp, dst)
+                self._count(files=1)
+                return
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                try:
+                    how = self._copy_data(src_fd, dst_fd, src_st.st_size)
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+            self._copy_meta(src_st, tmp)
+            os.replace(tmp, dst)
+            self._count(files=1, bytes=src_st.st_size, **{how: 1})
+        except OSError as exc:
+            self.say(f'ERROR: {rel}: {exc}')
+            self._count(errors=1)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def scan_dir(self, rel):
+        """ Create the directory (if needed; replacing a non-directory,
+        incl. a symlink, which is never followed); returns ([(rel, stat)]
+        of its subdirectories, [(rel, stat)] of the rest)."""
+        dirs, others = [], []
+        dst = os.path.join(self.dst_root, rel)
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            dst_st = None
+        if dst_st is None or not stat.S_ISDIR(dst_st.st_mode):
+            if self.dry_run:
+                self.say(f'{"~" if dst_st else "+"} {rel}/')
+            else:
+                if dst_st is not None:
+                    os.unlink(dst) # e.g., a symlink (not what it points to)
+                os.makedirs(dst, exist_ok=True) # parents are checked dirs (or safe_rels'd)
+            self._count(dirs=1)
+        with os.scandir(os.path.join(self.src_root, rel)) as entries:
+            for entry in entries:
+                sub_st = entry.stat(follow_symlinks=False)
+                sub_rel = os.path.join(rel, entry.name)
+                (dirs if stat.S_ISDIR(sub_st.st_mode) else others).append((sub_rel, sub_st))
+        return dirs, others
+
+    def restore(self, rels):
+        """ Restore the given relative paths (files or whole trees);
+        returns the stats."""
+        with profiler.phase('file_restore'), ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            pending, dir_stats = set(), []
+            for rel in rels:
+                rel = rel.strip('/')
+                try:
+                    src_st = os.lstat(os.path.join(self.src_root, rel))
+                except OSError as exc:
+                    self.say(f'ERROR: {rel}: {exc}')
+                    self._count(errors=1)
+                    continue
+                if not stat.S_ISDIR(src_st.st_mode):
+                    parent = os.path.dirname(os.path.join(self.dst_root, rel))
+                    if not self.dry_run:
+                        os.makedirs(parent, exist_ok=True)
+                    pending.add(pool.submit(self.restore_file, rel, src_st))
+                else:
+                    dir_stats.append((rel, src_st))
+                    pending.add(pool.submit(self.scan_dir, rel))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except OSError as exc:
+                        self.say(f'ERROR: {exc}')
+                        self._count(errors=1)
+                        continue
+                    if result is None: # a restore_file()
+                        continue
+                    dirs, others = result
+                    for rel, sub_st in dirs:
+                        dir_stats.append((rel, sub_st))
+                        pending.add(pool.submit(self.scan_dir, rel))
+                    for rel, sub_st in others:
+                        pending.add(pool.submit(self.restore_file, rel, sub_st))
+        if not self.dry_run: # after the contents (which change the mtimes)
+            for rel, src_st in sorted(dir_stats, key=lambda x: -x[0].count('/')):
+                try:
+                    self._copy_meta(src_st, os.path.join(self.dst_root, rel))
+                except OSError as exc:
+                    self.say(f'ERROR: {rel}: {exc}')
+                    self._count(errors=1)
+        return self.stats
+
+    def summary(self):
+        """ One line of the stats."""
+        st = self.stats
+        return (f'{"WOULD restore" if self.dry_run else "restored"} {st.files} files'
+                f' ({st.bytes} bytes; {st.cloned} reflinked, {st.copied} copied),'
+                f' {st.links} symlinks, {st.dirs} new dirs; {st.unchanged} unchanged,'
+                f' {st.errors} errors')
+
+def live_mount_of(snapshot, proc_mounts='/proc/mounts'):
+    """ Where the subvolume of a snapshot (named like
+    "eos@root.2024-01-13-093817=Daily") is mounted on the same filesystem
+    (i.e., device) as the snapshot, else '' (incl. when ambiguous)."""
+    subvol = snapshot_subvol(os.path.basename(os.path.normpath(snapshot)))
+    mounts = [] # (device, mount point, subvol path) of the BTRFS mounts
+    try:
+        with open(proc_mounts, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                wds = line.split()
+                if len(wds) >= 4 and wds[2] == 'btrfs':
+                    subvols = [x[7:] for x in wds[3].split(',') if x.startswith('subvol=')]
+                    mounts.append((wds[0], wds[1], subvols[0] if subvols else ''))
+    except OSError:
+        return ''
+    real, snap_dev, longest = os.path.realpath(snapshot), None, -1
+    for dev, mount, _ in mounts: # the snapshot's device is that of its longest mount prefix
+        if len(mount) > longest and (real == mount or real.startswith(mount.rstrip('/') + '/')):
+            snap_dev, longest = dev, len(mount)
+    candidates = {} # (device, subvol path) => first mount point
+    for dev, mount, path in mounts:
+        if subvol and os.path.basename(path) == subvol and snap_dev in (None, dev):
+            candidates.setdefault((dev, path), mount)
+    return list(candidates.values())[0] if len(candidates) == 1 else ''
+
+def safe_rels(paths, target):
+    """ The paths as normalized paths relative to target (absolute ones
+    must be under it); None if any would land outside of target (e.g.,
+    'etc/../../x' or a parent directory symlinked elsewhere)."""
+    root, rels = os.path.realpath(target), []
+    for path in paths:
+        rel = os.path.normpath(os.path.relpath(path, target) if os.path.isabs(path) else path)
+        if rel == '..' or rel.startswith('../') or os.path.isabs(rel):
+            return None
+        dst = os.path.join(os.path.realpath(os.path.dirname(os.path.join(root, rel))),
+                           os.path.basename(rel)) # the leaf itself is replaced, not followed
+        if os.path.commonpath([root, dst]) != root:
+            return None
+        rels.append(rel)
+    return rels
+
+def main(argv):
+    """ Parse the "restore-files" arguments and run it; returns the exit code."""
+    import argparse
+    from my_snaps.snap_diff import resolve_snapshot
+    parser = argparse.ArgumentParser(prog='my-snaps restore-files',
+            description='restore files/directories from a snapshot into the live subvolume')
+    parser.add_argument('snapshot', help='the snapshot (a path or a name in /.snapshots)')
+    parser.add_argument('paths', nargs='+',
+            help='paths to restore; relative to the subvolume or absolute under --to')
+    parser.add_argument('--to', type=str, default='',
+            help="the live subvolume's mount point [dflt: found in /proc/mounts]")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+            help='just list what would be restored')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+            help='parallel workers [dflt=8]')
+    opts = parser.parse_args(argv)
+    snapshot = resolve_snapshot(opts.snapshot)
+    target = opts.to or live_mount_of(snapshot)
+    if not os.path.isdir(snapshot) or not target:
+        print(f'ERROR: cannot find snapshot {opts.snapshot!r} or its live mount'
+              ' on the same filesystem unambiguously (use --to)', file=sys.stderr)
+        return 2
+    rels = safe_rels(opts.paths, target)
+    if rels is None:
+        print(f'ERROR: paths must be under {target!r}', file=sys.stderr)
+        return 2
+    restorer = FileRestore(snapshot, target, jobs=opts.jobs, dry_run=opts.dry_run)
+    restorer.restore(rels)
+    print(restorer.summary())
+    return 1 if restorer.stats.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
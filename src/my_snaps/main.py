@@ -18,18 +18,26 @@ starting the window.
 import sys
 import os
 import re
+import time
+import shlex
 import atexit
 import traceback
 import subprocess
 import curses as cs
 from types import SimpleNamespace
 from my_snaps.PowerWindow import Window, OptionSpinner
-from my_snaps.MyUtils import human, ago_whence, timestamp_str
+from my_snaps.MyUtils import human, ago_str, timestamp_str, parse_size
+from my_snaps.MyUtils import whence_epoch, parse_age_expr, TimeIndex
+from my_snaps.Metrics import Metrics
+from my_snaps.Profiler import profiler
+from my_snaps.Backends import make_backend, BackendError
 
 ##############################################################################
 
 class BTRFS:
     """ TBD """
+    proc_mounts = '/proc/mounts' # overridden by benchmarks
+
     def __init__(self, opts):
         self.tmp_dir = '/tmp/.btrfs/'
         self.temps = {} # keyed by device (e.g., /dev/nvme0n1p2)
@@ -42,15 +50,28 @@ class BTRFS:
         self.label = None   # one label of current interest
         self.help_mode = False
         self.win = None
-        self.rows = []
+        self.rows = [] # the rows shown (i.e., all_rows narrowed by filter_str)
+        self.all_rows = []
+        self.filter_str = '' # the "/" filter
+        self.filter_mode = False # True while typing the filter
         self.dirty = True # TBD: need to refresh knowledge
         self.show_size = False # until we calc disk usage
+        self.show_changed = False # until we calc changed bytes
 
         self.blkid_lines = [] # to avoid rerunning "blkid" on refresh
         self.mounts_lines = [] # to avoid rereading "/proc/mounts" on refresh
+        self.metrics = Metrics(opts.metrics_file) if opts.metrics_file else None
+        self.backend = make_backend(getattr(opts, 'backend', 'cli'))
 
         atexit.register(self.umount_tmps)
-
+        profiler.instrument(self, ('_load_devs', '_mount_tmps', '_determine_mount_points',
+                'gather_snapshots', 'make_rows', 'refresh_info', '_get_disk_usage', '_get_changed',
+                '_create_snap', '_del_subvolume', '_replace_eldest_snaps', '_run_schedule'))
+        profiler.instrument(self.backend, ('list_subvols', 'snapshot', 'delete', 'delete_many',
+                                           'usage', 'changed_extents'))
+
+    def main_loop(self, opts):
+        """ Logic when run as a program (per the options) """
         if opts.cron:
             self._install_cron_job(opts)
             sys.exit(0)
@@ -61,19 +82,51 @@ class BTRFS:
             self._get_disk_usage()
             sys.exit(0)
 
+        if opts.free_target:
+            started = time.monotonic()
+            success = self._free_target(opts.free_target, opts.keep, yes=opts.yes)
+            print("OK" if success else "FAIL", f'free_target={human(opts.free_target)}')
+            if opts.print or self.metrics:
+                self._refresh_if_dirty()
+            if opts.print:
+                self._print()
+            if self.metrics and opts.yes:
+                self.metrics.record_op('free_target', started, 0 if success else 1)
+                self._write_metrics()
+            sys.exit(0 if success else 1)
+
+        if opts.schedule:
+            started = time.monotonic()
+            success = self._run_schedule(opts.schedule_periods)
+            print("OK" if success else "FAIL", f'schedule={opts.schedule}')
+            if opts.print or self.metrics:
+                self._refresh_if_dirty()
+            if opts.print:
+                self._print()
+            if self.metrics:
+                self.metrics.record_op('schedule', started, 0 if success else 1)
+                self._write_metrics()
+            sys.exit(0 if success else 1)
 
         if self.add_limit > 0:
             if opts.label:
                 self.label = '=' + opts.label.replace('=', '')
+            started = time.monotonic()
             success = self._replace_eldest_snaps()
             print("OK" if success else "FAIL", f'add_snap_limit={self.add_limit}')
-            if success and opts.print:
+            if opts.print or self.metrics: # even after a failure (for the metrics)
                 self._refresh_if_dirty()
+            if success and opts.print:
                 self._print()
+            if self.metrics:
+                self.metrics.record_op('replace_eldest', started, 0 if success else 1,
+                                       label=(self.label or opts.label or '').lstrip('='))
+                self._write_metrics()
             sys.exit(0 if success else 1)
 
         if opts.print:
             self._print()
+            self._write_metrics()
             sys.exit(0)
 
         self._start_window()
@@ -93,17 +146,78 @@ class BTRFS:
                   f' {row.dev:>{devs_width}}'
                   f' {shown_path:<{path_width}}')
 
+    def _write_metrics(self):
+        """ Write per-subvolume snapshot counts (by label), newest snapshot
+        age, and sizes when known (i.e., after "du") to the metrics file."""
+        if not self.metrics:
+            return
+        now = time.time()
+        for name in ('my_snaps_snapshots', 'my_snaps_newest_snapshot_age_seconds'):
+            self.metrics.replace(name) # set for every subvolume on each run
+        for ns in self.subvol_iter():
+            if ns.snap_of or not ns.snaps:
+                continue
+            for label, group in ns.label_groups.items():
+                self.metrics.set('my_snaps_snapshots', len(group),
+                        'number of snapshots of the subvolume by label',
+                        dev=ns.dev, subvol=ns.path, label=label.lstrip('='))
+            newest = ns.snaps.newest()
+            if newest and newest.epoch is not None:
+                self.metrics.set('my_snaps_newest_snapshot_age_seconds',
+                        int(now - newest.epoch), 'age of the newest snapshot of the subvolume',
+                        dev=ns.dev, subvol=ns.path)
+            if ns.size is not None:
+                self.metrics.set('my_snaps_referenced_bytes', ns.size,
+                        'referenced bytes of the subvolume (per "btrfs fi du")',
+                        dev=ns.dev, subvol=ns.path)
+            exclusive = [x.size for x in ns.snaps if x.size is not None]
+            if exclusive:
+                self.metrics.set('my_snaps_snapshots_exclusive_bytes', sum(exclusive),
+                        'exclusive bytes of the snapshots of the subvolume',
+                        dev=ns.dev, subvol=ns.path)
+        self.metrics.set('my_snaps_last_run_timestamp_seconds', int(now),
+                'when my-snaps last wrote these metrics')
+        self.metrics.write()
+
     def _install_cron_job(self, opts):
         """ Add/replace an anacron job for scheduled snapshots """
         dirname = f'/etc/cron.{opts.cron}'
         if not os.path.isdir(dirname):
             print(f'ERROR: {dirname!r} does not exist')
             sys.exit(-1)
+        if opts.schedule:
+            filename = os.path.join(dirname, 'schedule-snaps')
+            spec = os.path.abspath(opts.schedule) if os.path.isfile(opts.schedule) else opts.schedule
+            text = '#!/bin/sh\n'
+            text += f'{sys.executable} {os.path.abspath(__file__)} -p --schedule {shlex.quote(spec)}'
+            if opts.metrics_file:
+                text += f' --metrics-file {shlex.quote(os.path.abspath(opts.metrics_file))}'
+            text += ' >/tmp/.my-snaps-schedule.txt 2>&1\n'
+            with open(filename, mode='w', encoding='utf-8') as f:
+                f.write(text)
+            os.chmod(filename, 0o755)
+            print(f'OK: to {filename!r}, wrote:\n{text}')
+            for period in SCHEDULE_INTERVALS: # the jobs this one replaces
+                for name in (f'{period}-snaps', 'schedule-snaps'):
+                    other = os.path.join(f'/etc/cron.{period}', name)
+                    if other != filename and os.path.isfile(other):
+                        os.remove(other)
+                        print(f'OK: removed {other!r} (replaced by {filename!r})')
+            shortest = min(x.interval for x in opts.schedule_periods)
+            if shortest < SCHEDULE_INTERVALS[opts.cron]:
+                fits = [x for x, secs in SCHEDULE_INTERVALS.items() if secs <= shortest]
+                print(f'WARNING: some periods are due more often than the {opts.cron} job'
+                      f' runs (so are snapshotted at most once per {opts.cron} run);'
+                      f' consider --cron={fits[-1] if fits else "hourly"}')
+            return
         filename = os.path.join(dirname, f'{opts.cron}-snaps')
         if opts.add_snap_max > 0:
             text = '#!/bin/sh\n'
             text += f'{sys.executable} {os.path.abspath(__file__)} -p -s{opts.add_snap_max}'
-            text += f' -L{opts.label} >/tmp/.my-snaps-{opts.cron}.txt 2>&1\n'
+            text += f' -L{opts.label}'
+            if opts.metrics_file:
+                text += f' --metrics-file {shlex.quote(os.path.abspath(opts.metrics_file))}'
+            text += f' >/tmp/.my-snaps-{opts.cron}.txt 2>&1\n'
             with open(filename, mode='w', encoding='utf-8') as f:
                 f.write(text)
             os.chmod(filename, 0o755)
@@ -174,16 +288,25 @@ class BTRFS:
                 win.set_pick_mode(True)
                 self.refresh_info()
 
+            elif key in (ord('c'), ) and not self.help_mode:
+                self._get_changed()
+
+            elif key in (ord('f'), ) and not self.help_mode and self.rows:
+                self._restore_files()
+
             elif key in (ord('r'), ) and not self.help_mode:
                 self._replace_eldest_snaps()
 
             elif key in (ord('a'), ) and not self.help_mode:
                 self._replace_eldest_snaps(just_add=True)
 
-            elif key in (ord('s'), ) and not self.help_mode:
+            elif key in (ord('/'), ) and not self.help_mode:
+                self.filter_mode = win.capture_keys = True
+
+            elif key in (ord('s'), ) and not self.help_mode and self.rows:
                 self._create_snap()
 
-            elif key in (ord('d'), ) and not self.help_mode:
+            elif key in (ord('d'), ) and not self.help_mode and self.rows:
                 self._del_subvolume()
 
             elif key in (ord('x'), ) and not self.help_mode:
@@ -200,13 +323,30 @@ class BTRFS:
 
             return value
 
+        def do_filter_key(key):
+            nonlocal win, self
+            if key in (cs.KEY_ENTER, 10, 13):
+                self.filter_mode = win.capture_keys = False
+            elif key == 27: # ESC
+                self.filter_mode = win.capture_keys = False
+                self.filter_str = ''
+            elif key in (cs.KEY_BACKSPACE, 127, 8):
+                self.filter_str = self.filter_str[:-1]
+            elif 32 <= key < 127:
+                self.filter_str += chr(key)
+            else:
+                return
+            self.filter_rows()
+            win.pick_pos = 0
+
         spin = OptionSpinner()
         spin.add_key('help_mode', '? - toggle help screen', vals=[False, True], obj=self)
 
-        base_keys_we_handle=[cs.KEY_ENTER,
-                10, ord('s'), ord('d'), ord('u'), ord('r'), ord('a'), ord('x')]
+        base_keys_we_handle=[cs.KEY_ENTER, 10, ord('s'), ord('d'),
+                ord('u'), ord('c'), ord('f'), ord('r'), ord('a'), ord('x'), ord('/')]
 
         win = self.win = Window(keys=set(list(spin.keys) + list(base_keys_we_handle)))
+        profiler.instrument(win, ('render',))
 
         for _ in range(100000000000):
             if self.help_mode:
@@ -217,15 +357,23 @@ class BTRFS:
                 self.win.add_body(' d - delete highlighted item')
                 self.win.add_body(' s - create snapshot for highlighted item')
                 self.win.add_body(' u - compute "du" for all subvols (very slow)')
+                self.win.add_body(' c - compute bytes changed since each snapshot (fast)')
+                self.win.add_body(' f - restore files/dirs from highlighted snapshot')
                 self.win.add_body(' r - replace eldest snapshot of each subvol')
                 self.win.add_body(' a - add snapshot o each subvol with snapshots')
+                self.win.add_body(' / - filter rows by words and/or ages'
+                                  ' (e.g., "root =daily >30d"); ESC clears')
                 self.win.add_body(' x - exit')
             else:
                 win.set_pick_mode(True)
                 self.refresh_info()
             win.render()
             try:
-                _ = do_key(win.prompt(seconds=300))
+                key = win.prompt(seconds=300)
+                if key is not None and self.filter_mode:
+                    do_filter_key(key)
+                else:
+                    _ = do_key(key)
             except Exception as exce:
                 win.stop_curses()
                 print("exception:", str(exce))
@@ -240,11 +388,13 @@ class BTRFS:
         if not subvol_ns.snaps:
             return True
 
-        while discard > 0 and like_snaps:
-            if not self._del_subvolume(like_snaps[0], ans="y"):
+        dated = [x for x in like_snaps if x.epoch is not None] # never retire undated ones
+        while discard > 0 and dated:
+            eldest = dated.pop(0) # label groups are TimeIndex (eldest first)
+            if not self._del_subvolume(eldest, ans="y"):
                 return False  # all must succeed
-            subvol_ns.snaps.remove(like_snaps[0])
-            like_snaps.pop(0)
+            subvol_ns.snaps.remove(eldest)
+            like_snaps.remove(eldest)
             discard -= 1
         return self._create_snap(subvol_ns, suffix=suffix)
 
@@ -290,21 +440,127 @@ class BTRFS:
         return success
 
 
+    def _run_schedule(self, periods):
+        """ One pass for all periods: snapshot each subvolume having
+        snapshots (as for -s) for every period that is due (i.e., w/o a
+        snapshot of its label within the interval), then delete the eldest
+        beyond each label's limit in one batch.  Returns True if all
+        succeeded."""
+        now, stamp, success = time.time(), timestamp_str(), True
+        doomed = [] # snapshots to delete
+        for subvol_ns in self.snap_targets:
+            if not subvol_ns.snaps: # i.e., not opted in (as for -s)
+                continue
+            for period in periods:
+                group = subvol_ns.label_groups.get(period.label, [])
+                newest = group.newest() if group else None
+                if (newest and newest.epoch is not None
+                        and now - newest.epoch < period.interval - period.slack):
+                    continue
+                print(f'+ {subvol_ns.path}.{stamp}{period.label}')
+                if not self._create_snap(subvol_ns, suffix=f'.{stamp}{period.label}'):
+                    success = False
+                    continue # keep the old ones if the new one failed
+                dated = [x for x in group if x.epoch is not None] # never retire undated ones
+                for eldest in dated[:max(0, len(dated) + 1 - period.limit)]:
+                    print(f'- {eldest.path}')
+                    doomed.append(eldest)
+        return self._delete_batch(doomed) and success
+
+    def _delete_batch(self, snaps):
+        """ Delete the snapshots (and any nested subvolumes) with one
+        batched backend call w/o prompting; returns True if all were."""
+        doomed = [y for x in snaps for y in self.subvol_iter(x, top_down=False)]
+        mounted = [x for x in doomed if x.mount]
+        for ns in mounted:
+            print(f'ERROR: cannot delete mounted subvol {ns.mount}')
+        paths = [f'{self.devs[x.dev].tmp_path}{x.path}' for x in doomed if x not in mounted]
+        code = 0
+        if paths:
+            if self.DB: print(f'DB: + delete {" ".join(paths)}')
+            started = time.monotonic()
+            try:
+                self.backend.delete_many(paths)
+            except BackendError as exc:
+                code = exc.code
+                print(f'FAILED({code}): {exc.command}', *exc.output, sep='\n')
+            if self.metrics:
+                self.metrics.record_op('snapshot_delete_batch', started, code)
+            self.dirty = True
+        return not code and not mounted
+
+    def _plan_free_target(self, target, keep):
+        """ The fewest snapshots whose exclusive bytes add up to target
+        while keeping the newest keep[label] (else keep['*']) snapshots of
+        each label of each subvolume; returns ([snapshot ns], bytes, source).
+        Exclusive bytes are a lower bound of what deleting several
+        snapshots frees (blocks shared only among them are freed too)."""
+        candidates = []
+        for subvol_ns in self.snap_targets:
+            for label, group in subvol_ns.label_groups.items():
+                kept = keep.get(label.lstrip('='), keep.get('*', 1))
+                dated = [x for x in group if x.epoch is not None] # never retire undated ones
+                candidates += [x for x in dated[:max(0, len(dated) - kept)]
+                               if not any(y.mount for y in self.subvol_iter(x))]
+        source, dev_ns = 'qgroup', self.devs.get(self.snap_subvol.dev, None)
+        sizes = self.backend.qgroup_usage(
+                f'{dev_ns.tmp_path}{self.snap_subvol.path}') if dev_ns else {}
+        if sizes:
+            for ns in candidates:
+                ns.size = sizes.get(int(ns.ident), ns.size)
+        else:
+            source = 'du'
+            self._get_disk_usage()
+        candidates.sort(key=lambda x: x.size or 0, reverse=True)
+        picked, total = [], 0
+        for idx, ns in enumerate(candidates):
+            if total >= target or not ns.size:
+                break
+            if total + ns.size >= target: # the smallest that still suffices goes last
+                ns = min((x for x in candidates[idx:] if total + (x.size or 0) >= target),
+                         key=lambda x: x.size)
+            picked.append(ns)
+            total += ns.size
+        return picked, total, source
+
+    def _free_target(self, target, keep, yes=False):
+        """ Show the plan to free target bytes and, if yes, delete its
+        snapshots in one batch; returns True if the target was reachable
+        (and the deletes succeeded)."""
+        picked, total, source = self._plan_free_target(target, keep)
+        for ns in picked:
+            print(f'- {human(ns.size):>7} {ns.path}')
+        print(f'PLAN: delete {len(picked)} snapshot(s) to free >={human(total)}'
+              f' of {human(target)} (exclusive bytes per {source})')
+        if total < target:
+            print('WARNING: the retention minimums (--keep) leave too little to delete')
+        if not yes:
+            print('NOTE: plan only; add --yes to delete')
+            return total >= target
+        return self._delete_batch(picked) and total >= target
+
+    def _alert(self, title, message='', height=1):
+        """ An alert box; printed when w/o the window (e.g., cron runs)."""
+        if self.win:
+            self.win.alert(title, message=message, height=height)
+        else:
+            print(title, *([message] if message else []), sep='\n')
+
     def _create_snap(self, subvol_ns=None, suffix=None):
         if not subvol_ns:
             subvol_ns = self.rows[self.win.pick_pos].subvol_ns
         dev_ns = self.devs[subvol_ns.dev]
 
         if subvol_ns.snap_of:
-            self.win.alert('Sorry, cannot create snapshot of snapshot')
+            self._alert('Sorry, cannot create snapshot of snapshot')
             return False
 
         if not subvol_ns.mount:
-            self.win.alert('Sorry, cannot create snapshot of unmounted subvolume')
+            self._alert('Sorry, cannot create snapshot of unmounted subvolume')
             return False
 
         if subvol_ns.mount == '/.snapshots':
-            self.win.alert('Sorry, cannot create snapshot of snapshot subvolume')
+            self._alert('Sorry, cannot create snapshot of snapshot subvolume')
             return False
 
         if not suffix:
@@ -317,11 +573,18 @@ class BTRFS:
         snap_dir = f'{dev_ns.tmp_path}{self.snap_subvol.path}'
         snap_path = f'{snap_dir}{subvol_ns.path}{suffix}'
 
-        cmd = f'btrfs sub snap -r {subvol_ns.mount} {snap_path}'
-        out, err, code = self._slurp_command(cmd)
+        if self.DB: print(f'DB: + snapshot {subvol_ns.mount} {snap_path}')
+        started, code = time.monotonic(), 0
+        try:
+            self.backend.snapshot(subvol_ns.mount, snap_path, readonly=True)
+        except BackendError as exc:
+            code = exc.code
+            self._alert(f'FAILED({code}): {exc.command}', message='\n'.join(exc.output),
+                           height=len(exc.output))
+        if self.metrics:
+            self.metrics.record_op('snapshot_create', started, code,
+                                   dev=subvol_ns.dev, subvol=subvol_ns.path)
         if code:
-            self.win.alert(f'FAILED({code}): {cmd}', message='\n'.join(out + err),
-                           height=len(out)+len(err))
             return False
         self.dirty = True
         return True
@@ -332,7 +595,7 @@ class BTRFS:
 
         for ns in self.subvol_iter(subvol_ns, top_down=False):
             if ns.mount:
-                self.win.alert(f'Sorry, cannot delete mounted subvol {ns.mount}')
+                self._alert(f'Sorry, cannot delete mounted subvol {ns.mount}')
                 return False
 
         if not ans:
@@ -343,15 +606,58 @@ class BTRFS:
         dev_ns = self.devs[subvol_ns.dev]
         for ns in self.subvol_iter(subvol_ns, top_down=False):
             snap_path = f'{dev_ns.tmp_path}{ns.path}'
-            cmd = f'btrfs sub del {snap_path}'
-            out, err, code = self._slurp_command(cmd)
+            if self.DB: print(f'DB: + delete {snap_path}')
+            started, code = time.monotonic(), 0
+            try:
+                self.backend.delete(snap_path)
+            except BackendError as exc:
+                code = exc.code
+                self._alert(f'FAILED({code}): {exc.command}', message='\n'.join(exc.output),
+                               height=len(exc.output))
+            if self.metrics:
+                self.metrics.record_op('snapshot_delete', started, code,
+                                       dev=ns.dev, subvol=(ns.snap_of or ns).path)
             if code:
-                self.win.alert('FAILED: {cmd}', message='\n'.join(out + err),
-                               height=len(out)+len(err))
                 return False
             self.dirty = True
         return True
 
+    def _restore_files(self, subvol_ns=None, paths=None):
+        """ Reflink chosen paths from a snapshot into its mounted subvolume
+        (after showing what a dry run finds)."""
+        from my_snaps.file_restore import FileRestore, safe_rels
+        if not subvol_ns:
+            subvol_ns = self.rows[self.win.pick_pos].subvol_ns
+        if not subvol_ns.snap_of:
+            self.win.alert('Sorry, pick a snapshot to restore files from')
+            return False
+        live = subvol_ns.snap_of.mount
+        if not live:
+            self.win.alert('Sorry, the subvolume of that snapshot is not mounted')
+            return False
+        if not paths:
+            paths = self.win.answer(f'Paths to restore into "{live}" (space-separated) OR clear',
+                                    seed='').split()
+        rels = safe_rels(paths, live)
+        if not rels:
+            if rels is None:
+                self.win.alert(f'Sorry, paths must be under "{live}"')
+            return False
+        src = f'{self.devs[subvol_ns.dev].tmp_path}{subvol_ns.path}'
+        lines = []
+        dry = FileRestore(src, live, dry_run=True, say=lines.append)
+        dry.restore(rels)
+        ans = self.win.answer(f'{dry.summary()}; type "y" to restore')
+        if not ans.strip().lower().startswith('y'):
+            return False
+        lines = []
+        restorer = FileRestore(src, live, say=lines.append)
+        restorer.restore(rels)
+        lines.append(restorer.summary())
+        self.win.alert(title='Restored', message='\n'.join(lines[-20:]),
+                       height=min(len(lines), 20))
+        return not restorer.stats.errors
+
     def _slurp_command(self, command):
         if self.DB: print('DB: +', command)
         process = subprocess.Popen(command, stdout=subprocess.PIPE,
@@ -405,12 +711,12 @@ class BTRFS:
                 print(f'DB: {dev}: {vars(ns)}')
 
     @staticmethod
-    def init_subvol_ns(dev='', path='', ident=None, parent=None):
+    def init_subvol_ns(dev='', path='', ident=None, parent=None, gen=None):
         """ Create a subvolume namespace"""
-        return SimpleNamespace(dev=dev, path=path, size=None,
+        return SimpleNamespace(dev=dev, path=path, size=None, gen=gen, changed=None,
                    depth=0, mount='', snaps=[], label_groups={},
                     children=[], snap_label='', snap_of=None,
-                    ident=ident, parent=parent, ago_str='')
+                    ident=ident, parent=parent, epoch=None)
 
     def _mount_tmps(self):
         """ mount each btrfs as needed """
@@ -424,18 +730,16 @@ class BTRFS:
                 if code:
                     raise Exception(f'cannot mount {dev_ns.dev} {code=}')
             dev_ns.tmp_path = tmp_mount_dir
-            lines, _, _ = self._slurp_command(f'btrfs sub list {tmp_mount_dir}')
+            if self.DB: print(f'DB: + list_subvols {tmp_mount_dir}')
+            listed = self.backend.list_subvols(tmp_mount_dir)
 
             dev_ns.paths = {} # subvols keyed by relative path
             dev_ns.idents = {} # subvols keyed by ident
             dev_ns.subvols = []
-            for line in lines:
-                wds = line.split(maxsplit=8)
-                if len(wds) < 9:
-                    continue
-                ident, parent, path = wds[1], wds[6], f'/{wds[8]}'
+            for sub in listed:
+                ident, parent, path = str(sub.ident), str(sub.parent), f'/{sub.path}'
                 child = BTRFS.init_subvol_ns(dev=dev,
-                             path=path, ident=ident, parent=parent)
+                             path=path, ident=ident, parent=parent, gen=sub.gen)
                 if parent in dev_ns.idents:
                     parent_ns = dev_ns.idents[parent]
                     child.depth = parent_ns.depth+1
@@ -444,7 +748,7 @@ class BTRFS:
                     dev_ns.subvols.append(child)
                 dev_ns.idents[ident] = child
                 dev_ns.paths[path] = child
-                child.ago_str = ago_whence(child.path)
+                child.epoch = whence_epoch(child.path) # parsed just once
 
         if self.DB:
             print('DB: --->>> after mount_tmps()')
@@ -461,7 +765,7 @@ class BTRFS:
 
     def _determine_mount_points(self):
         if not self.mounts_lines:
-            self.mounts_lines = self._slurp_file('/proc/mounts')
+            self.mounts_lines = self._slurp_file(self.proc_mounts)
         for line in self.mounts_lines:
             wds = re.split(r'\s+', line)
             if len(wds) < 4:
@@ -477,8 +781,15 @@ class BTRFS:
             if not match:
                 continue
             ident = match.group(1)
-            for subvol in self.subvol_iter():
-                if subvol.ident == ident:
+            # subvol IDs repeat across filesystems, so find the device first
+            # (formerly, the first subvolume of any device w/ the ID got the mount)
+            dev = os.path.basename(wds[0])
+            if dev not in self.devs:
+                dev = os.path.basename(os.path.realpath(wds[0]))
+            dev_nss = [self.devs[dev]] if dev in self.devs else self.devs.values()
+            for dev_ns in dev_nss:
+                subvol = dev_ns.idents.get(ident, None)
+                if subvol:
                     subvol.mount = mount
                     if mount == '/.snapshots':
                         self.snap_subvol = subvol
@@ -508,11 +819,12 @@ class BTRFS:
         return ''
 
     def gather_snapshots(self):
-        """ TBD """
+        """ Link snapshots to their subvolumes.  Each subvolume's snaps
+        and each of its label_groups ends up as a TimeIndex (i.e., sorted
+        eldest first by the parsed epoch)."""
         def link(of_subvol, subvol):
             if of_subvol and subvol:
                 of_subvol.snaps.append(subvol)
-                of_subvol.snaps = sorted(of_subvol.snaps, key=lambda x: x.path)
                 subvol.snap_of = of_subvol
                 subvol.snap_label = label = self._get_label(remainder)
                 label_group = of_subvol.label_groups.get(label, [])
@@ -538,6 +850,12 @@ class BTRFS:
             else:
                 link(self.snap_subvol, subvol)
 
+        for subvol in self.subvol_iter():
+            if subvol.snaps:
+                subvol.snaps = TimeIndex(subvol.snaps)
+                for label, group in list(subvol.label_groups.items()):
+                    subvol.label_groups[label] = TimeIndex(group)
+
         if self.DB:
             print('DB: --->>> after gather_snapshots()')
             for subvol in self.subvol_iter():
@@ -549,64 +867,83 @@ class BTRFS:
 
     def make_rows(self):
         """ Create the set of rows for display with only the subset of info
-        needed for display"""
+        needed for display.  Each row also carries its search index (the
+        lowercased words and the parsed age) so filtering is cheap."""
         def init_row(size, mount, dev, path, subvol_ns):
-            return SimpleNamespace(size=size, mount=mount,
-                               dev=dev, path=path, subvol_ns=subvol_ns)
+            words = [path, subvol_ns.snap_label, dev, mount]
+            return SimpleNamespace(size=size, changed=subvol_ns.changed, mount=mount,
+                               dev=dev, path=path, subvol_ns=subvol_ns,
+                               words=' '.join(words).lower(),
+                               epoch=subvol_ns.epoch)
 
-        self.rows = []
+        self.all_rows = []
 
         for dev, dev_ns in self.devs.items():
             for ns in dev_ns.subvols:
                 row = init_row(ns.size, ns.mount, dev, ns.path, ns)
-                self.rows.append(row)
+                self.all_rows.append(row)
                 for snap in ns.snaps:
                     row = init_row(snap.size,
                            snap.mount, snap.dev, snap.path, snap)
-                    self.rows.append(row)
+                    self.all_rows.append(row)
+        self.filter_rows()
         if self.DB:
             for row in self.rows:
                 print(f'DB: row: {row.size=} {row.mount=}'
                       f' {row.dev=} {row.path=!r}')
 
-    def _get_disk_usage(self):
-        """This actually only works for the snaps."""
-        def convert_human(val):
-            if val.endswith('GiB'):
-                val = float(val[:-3]) * (2**30)
-            elif val.endswith('MiB'):
-                val = float(val[:-3]) * (2**20)
-            elif val.endswith('KiB'):
-                val = float(val[:-3]) * (2**10)
-            elif re.search(r'\dB$', val):
-                val = float(val[:-1]) * 1
+    def filter_rows(self):
+        """ Narrow all_rows to rows per the filter_str whose terms must all
+        match; a term is either an age expression (e.g., ">30d" for older
+        than 30 days) or a word to find in the path/label/device/mount."""
+        words, ages, now = [], [], time.time()
+        for term in self.filter_str.lower().split():
+            age = parse_age_expr(term)
+            if age:
+                ages.append(age)
             else:
-                print(f'ERR: cannot parse({val}')
-                val = 0
-            return int(round(val))
+                words.append(term)
+
+        def is_match(row):
+            for word in words:
+                if word not in row.words:
+                    return False
+            for op, secs in ages:
+                if row.epoch is None:
+                    return False
+                if (now - row.epoch > secs) != (op == '>'):
+                    return False
+            return True
+
+        self.rows = [x for x in self.all_rows if is_match(x)] if (
+                    words or ages) else self.all_rows
 
+    def _get_disk_usage(self):
+        """This actually only works for the snaps."""
         if not self.snap_subvol:
             return
         dev_ns = self.devs.get(self.snap_subvol.dev, None)
         if not dev_ns:
             return
 
-        cmd = f'cd "{dev_ns.tmp_path}" && btrfs fi du -s {self.snap_subvol.path[1:]}/*'
-        lines, _, _ = self._slurp_command(cmd)
-        for line in lines[1:]:
-            total, exclusive, _, pathname = re.split(r'\s+', line.strip(), maxsplit=3)
-            pathname = os.path.join('/', pathname)
-            if not pathname in dev_ns.paths:
+        snaps = {f'{dev_ns.tmp_path}{ns.path}': ns for ns in dev_ns.paths.values()
+                 if os.path.dirname(ns.path) == self.snap_subvol.path}
+        try:
+            usages = self.backend.usage(list(snaps))
+        except BackendError as exc:
+            print(f'ERR: {exc}')
+            usages = {}
+        for pathname, usage in usages.items():
+            snap_ns = snaps.get(pathname, None)
+            if not snap_ns:
                 continue
-            snap_ns = dev_ns.paths[pathname]
-            snap_ns.size = convert_human(exclusive)
+            snap_ns.size = usage.exclusive
             if snap_ns.snap_of:
                 if not snap_ns.snap_of.size:
                     snap_ns.snap_of.size = 0
-                snap_ns.snap_of.size = max(convert_human(total),
-                    snap_ns.snap_of.size)
+                snap_ns.snap_of.size = max(usage.total, snap_ns.snap_of.size)
 
-        for row in self.rows:
+        for row in self.all_rows:
             row.size = row.subvol_ns.size
         self.show_size = True
 
@@ -615,19 +952,45 @@ class BTRFS:
             for ns in self.subvol_iter():
                 print(f'DB: {ns.size=} {ns.path=!r}')
 
+    def _get_changed(self):
+        """For each snapshot, the bytes its subvolume has written since
+        (i.e., in extents of a newer generation); unlike "du", this reads
+        just the changed parts of one tree per subvolume."""
+        for dev_ns in self.devs.values():
+            for ns in dev_ns.subvols:
+                gens = [x.gen for x in ns.snaps if x.gen is not None]
+                if ns.snap_of or not gens:
+                    continue
+                try:
+                    extents = self.backend.changed_extents(f'{dev_ns.tmp_path}{ns.path}', min(gens))
+                except BackendError as exc:
+                    print(f'ERR: {exc}')
+                    continue
+                for snap in ns.snaps:
+                    snap.changed = sum(nbytes for gen, nbytes in extents.items()
+                                       if gen > snap.gen)
+        for row in self.all_rows:
+            row.changed = row.subvol_ns.changed
+        self.show_changed = True
+
+        if self.DB:
+            print('DB: --->>> after _get_changed()')
+            for ns in self.subvol_iter():
+                print(f'DB: {ns.changed=} {ns.gen=} {ns.path=!r}')
+
     def calc_path_width(self):
         """ TBD """
-        rv = max([len(x.path) for x in self.rows])
+        rv = max([len(x.path) for x in self.rows], default=0)
         return max(len('Subvolume'), rv)
 
     def calc_mounts_width(self):
         """ TBD """
-        rv = max([len(x.mount) for x in self.rows])
+        rv = max([len(x.mount) for x in self.rows], default=0)
         return max(len('Mount'), rv)
 
     def calc_devs_width(self):
         """ TBD """
-        rv = max([len(x.dev) for x in self.rows])
+        rv = max([len(x.dev) for x in self.rows], default=0)
         return max(len('Device'), rv)
 
     def refresh_info(self, body=None):
@@ -641,14 +1004,21 @@ class BTRFS:
 
         win.add_header('MY-SNAPS', attr=cs.A_REVERSE)
         win.add_header(
-            '  s:+snap d:-subvol u:disk-usage r:replace-all a:add-all x:exit ?:help',
+            '  s:+snap d:-subvol u:disk-usage c:changed f:restore-files r:replace-all'
+            ' a:add-all /:filter x:exit ?:help',
             resume=True)
         for dev_ns in self.devs.values():
             win.add_header(f'df: {dev_ns.diskfree}')
+        if self.filter_mode or self.filter_str:
+            win.add_header(f'/{self.filter_str}{"_" if self.filter_mode else ""}'
+                           f'  [{len(self.rows)}/{len(self.all_rows)} rows]'
+                           + ('  (Enter:done ESC:clear)' if self.filter_mode else ''))
         size_hdr = f' {"~Size":>7}'
+        changed_hdr = f' {"Changed":>7}'
         win.add_header(
               f'{"Mount":>{mounts_width}}'
               f'{size_hdr if self.show_size else ""}'
+              f'{changed_hdr if self.show_changed else ""}'
               f' {"Device":>{devs_width}}'
               f' {"Subvolume":<{path_width}}',
               attr=cs.A_BOLD,
@@ -660,24 +1030,69 @@ class BTRFS:
                 win.add_body(line, attr=cs.A_REVERSE)
             return
 
+        now = time.time()
         for row in self.rows:
             wds = row.path.split('@snapshots/', maxsplit=1)
             if len(wds) < 2:
                 shown_path = row.path
             else:
                 shown_path = f'--> {wds[1]}'
-                if row.subvol_ns.ago_str:
-                    shown_path += f' {row.subvol_ns.ago_str}'
+                if row.epoch is not None:
+                    shown_path += f' {ago_str(now - row.epoch)}'
             if row.subvol_ns.snap_of == self.snap_subvol:
                 shown_path = '!!!' + shown_path[3:]
             mount_str = row.mount if row.mount else '' if row.subvol_ns.snap_of else '~'
             size_str = f' {"-" if row.size is None else human(row.size):>7}'
+            changed_str = f' {"-" if row.changed is None else human(row.changed):>7}'
             win.add_body(
                   f'{mount_str:>{mounts_width}}'
                   f'{size_str if self.show_size else ""}'
+                  f'{changed_str if self.show_changed else ""}'
                   f' {row.dev:>{devs_width}}'
                   f' {shown_path:<{path_width}}')
 
+SCHEDULE_DEFAULT = 'hourly=2,daily=2,weekly=2,monthly=1'
+SCHEDULE_INTERVALS = {'hourly': 3600, 'daily': 86400, 'weekly': 7*86400, 'monthly': 30*86400}
+
+def parse_schedule(spec):
+    """ Parse 'hourly=2,daily=2,boot/6h=3' (or a file of such terms,
+    one or more per line, '#' comments) into [ns(label, interval, limit, slack)]
+    where the label is capitalized (e.g., '=Daily') and the interval is
+    known for hourly/daily/weekly/monthly or given as an age (e.g., 6h)."""
+    if os.path.isfile(spec):
+        with open(spec, 'r', encoding='utf-8') as fh:
+            spec = ','.join(x.split('#', 1)[0] for x in fh)
+    rv = []
+    for term in re.split(r'[,\s]+', spec.strip()):
+        if not term:
+            continue
+        name, _, limit = term.partition('=')
+        name, _, interval = name.partition('/')
+        secs = parse_age_expr('>' + interval) if interval else None
+        secs = secs[1] if secs else SCHEDULE_INTERVALS.get(name.lower(), None)
+        if not re.match(r'^\w+$', name) or not secs:
+            raise ValueError(f'bad period {term!r} (need NAME[/AGE]=LIMIT'
+                             f' where NAME w/o AGE is one of {",".join(SCHEDULE_INTERVALS)})')
+        if not limit.isdigit() or not 1 <= int(limit) <= 8:
+            raise ValueError(f'bad limit in {term!r} [1<=LIMIT<=8]')
+        # a little early is on time (e.g., cron/boot jitter)
+        rv.append(SimpleNamespace(label='=' + name.capitalize(), interval=secs,
+                                  limit=int(limit), slack=min(secs // 20, 900)))
+    if not rv:
+        raise ValueError(f'no periods in {spec!r}')
+    return rv
+
+def parse_keep(spec):
+    """ Parse 'daily=2,weekly=1,*=1' into {label: count} where '*' is
+    for the other labels (and '' for the unlabeled snapshots)."""
+    rv = {}
+    for term in [x for x in re.split(r'[,\s]+', spec.strip()) if x]:
+        label, _, count = term.rpartition('=')
+        if not count.isdigit():
+            raise ValueError(f'bad count in {term!r} (need LABEL=COUNT)')
+        rv[label if label in ('*', '') else label.lstrip('=').capitalize()] = int(count)
+    return rv
+
 btrfs = None
 
 def rerun_module_as_root(module_name):
@@ -692,6 +1107,18 @@ def main():
     global btrfs
     import argparse
     rerun_module_as_root('my_snaps.main')
+    if sys.argv[1:2] == ['diff']:
+        from my_snaps.snap_diff import main as diff_main
+        sys.exit(diff_main(sys.argv[2:]))
+    if sys.argv[1:2] in (['index'], ['versions']):
+        from my_snaps.version_index import main as version_index_main
+        sys.exit(version_index_main(sys.argv[1:]))
+    if sys.argv[1:2] == ['replicate']:
+        from my_snaps.replicate import main as replicate_main
+        sys.exit(replicate_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['restore-files']:
+        from my_snaps.file_restore import main as restore_files_main
+        sys.exit(restore_files_main(sys.argv[2:]))
     if os.geteuid() != 0: # Re-run the script with sudo
         module_name = 'my_snaps.main'
         os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -708,10 +1135,52 @@ def main():
     parser.add_argument('--cron', type=str,
             choices=('hourly', 'daily', 'weekly', 'monthly'),
             help='install a periodic snapshot anacron job')
+    parser.add_argument('--schedule', type=str, nargs='?', const=SCHEDULE_DEFAULT,
+            default='', metavar='SPEC',
+            help='in one pass, snapshot for each due period and prune to its'
+                 ' limit; SPEC (or a file of it) is like NAME[/AGE]=LIMIT,...'
+                 f' [dflt={SCHEDULE_DEFAULT}]')
+    parser.add_argument('--free-target', type=str, default='', metavar='SIZE',
+            help='delete the fewest snapshots whose exclusive sizes add up to'
+                 ' SIZE (e.g., 20G); shows the plan and deletes only with --yes')
+    parser.add_argument('--keep', type=str, default='*=1', metavar='SPEC',
+            help='with --free-target, the snapshots to keep per label of each'
+                 ' subvolume like daily=2,weekly=1,*=1 [dflt=*=1]')
+    parser.add_argument('-y', '--yes', action="store_true",
+            help='with --free-target, run the plan')
+    parser.add_argument('--metrics-file', type=str, default='',
+            help='with -s/-p/--schedule/--free-target, write node-exporter textfile'
+                 ' metrics to this file (e.g., /var/lib/node_exporter/my-snaps.prom)')
+    parser.add_argument('--profile', type=str, default='', metavar='TRACE_JSON',
+            help='record wall/CPU time per phase and external command to this'
+                 ' Chrome trace file and print a summary at exit')
+    parser.add_argument('--profile-mem', action="store_true",
+            help='with --profile, also record tracemalloc peaks per phase')
+    parser.add_argument('--backend', choices=('cli', 'ioctl'), default='cli',
+            help='how to list/snapshot/delete subvolumes: run "btrfs" (the'
+                 ' default) or call the kernel ioctls directly')
     parser.add_argument('--DB', action="store_true",
             help='add some debugging output')
     opts = parser.parse_args()
-    if opts.cron:
+    if opts.profile:
+        profiler.start(opts.profile, trace_malloc=opts.profile_mem)
+    if opts.free_target != '':
+        try:
+            opts.free_target, opts.keep = parse_size(opts.free_target), parse_keep(opts.keep)
+            if opts.free_target <= 0:
+                raise ValueError('SIZE must be positive')
+        except ValueError as exc:
+            print(f'ERROR: --free-target/--keep: {exc}', file=sys.stderr)
+            sys.exit(2)
+        opts.add_snap_max, opts.schedule = 0, ''
+    if opts.schedule:
+        try:
+            opts.schedule_periods = parse_schedule(opts.schedule)
+        except (ValueError, OSError) as exc:
+            print(f'ERROR: --schedule: {exc}', file=sys.stderr)
+            sys.exit(2)
+        opts.add_snap_max = 0
+    if opts.cron and not opts.schedule:
         if not opts.label:
             opts.label = '=' + opts.cron.capitalize()
         if opts.add_snap_max is None:
@@ -724,6 +1193,7 @@ def main():
         opts.add_snap_max = min(opts.add_snap_max, 8)
 
     btrfs = BTRFS(opts)
+    btrfs.main_loop(opts)
     btrfs.umount_tmps()
 
 def run():
@@ -8,27 +8,37 @@ import os
 import glob
 import subprocess
 import re
+import json
+import time
+import contextlib
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from types import SimpleNamespace
 from my_snaps.InlineMenu import Menu
-from my_snaps.MyUtils import timestamp_str, ago_whence
+from my_snaps.MyUtils import timestamp_str, ago_str, whence_epoch, TimeIndex
+from my_snaps.MyUtils import find_btrfs_filesystems
+from my_snaps.Profiler import profiler
+from my_snaps.Backends import make_backend, BackendError
 
 class BtrfsRestore:
     """ TBD """
-    def __init__(self):
-        if os.geteuid() != 0: # Re-run the script with sudo
-            print('NOTE: restarting with "sudo"')
-            os.execvp('sudo', ['sudo', sys.executable] + sys.argv)
+    proc_mounts = '/proc/mounts' # overridden by benchmarks
+
+    def __init__(self): # NOTE: run() re-execs as root (not here, so benchmarks can construct it)
         self.dry_run = False
+        self.backend = make_backend('cli')
         self.filesystems = []
         self.mounted_ids = set()
         self.root_subvol = None
         self.mounted_subpaths = set()
         self.slash_mnt = self.get_slash_mnt()
         self.is_bootable = True # until proved otherwise
+        self.marks = {} # subvol => (kind, target) of the marked action
+        self.reserved_keys = ('x', 'y', 'z') # not used for actions
 
-    def do_command(self, prompts, todo=None, precmd='', once=False, force=False):
-        """ TBD"""
+    def run_menu(self, prompts, todo=None):
+        """ Show the menu plus the EXIT and dry-run entries until something
+        else is picked; returns (menu, choice)."""
         prompts['x'] = 'EXIT'
         while True:
             prompts['y'] = ('toggle dry-run='
@@ -39,10 +49,19 @@ class BtrfsRestore:
             choice = menu.get_prompt_obj()
             if choice.key == 'x':
                 self.check_bootable()
+                if Menu.minimal:
+                    print(f'NOTE: wrote {Menu.bytes_total} bytes for {Menu.keys_total} keys'
+                          f' ({Menu.bytes_total/max(Menu.keys_total, 1):.0f}/key)')
                 sys.exit(0)
             if choice.key == 'y':
                 self.dry_run = not self.dry_run
                 continue
+            return menu, choice
+
+    def do_command(self, prompts, todo=None, precmd='', once=False, force=False):
+        """ TBD"""
+        while True:
+            menu, choice = self.run_menu(prompts, todo)
             cmd = menu.get_command(choice)
             if not cmd.startswith('#'):
                 if not force and self.dry_run:
@@ -60,7 +79,7 @@ class BtrfsRestore:
                 return [line.strip() for line in fh]
 
         rv = SimpleNamespace(device='', fstype='')
-        lines = slurp_file('/proc/mounts')
+        lines = slurp_file(self.proc_mounts)
         # /dev/mmcblk1p2 / btrfs rw,noatime,compress=zstd:3,ssd,discard=async,space_cache=v2,subvolid=318,subvol=/eos@root 0 0
         for line in lines:
             wds = re.split(r'\s+', line)
@@ -89,25 +108,17 @@ class BtrfsRestore:
         return rv
 
     def select_mount(self):
-        """ TBD """
-        command_output = subprocess.check_output(['btrfs', 'filesystem', 'show']).decode('utf-8')
-        lines = command_output.split('\n')
-        self.filesystems = []
-        for line in lines:
-            mat = re.match(r"^Label:\s+('[^']*')", line)
-            if mat:
-                label = mat.group(1)
-            mat = re.search(r"\bpath\s+(/dev/\S+)", line)
-            if mat:
-                path = mat.group(1)
-                self.filesystems.append(SimpleNamespace(label=label, path=path))
+        """ Choose the BTRFS filesystem to mount on /mnt.  The filesystems
+        are discovered once per session (see find_btrfs_filesystems())."""
+        if not self.filesystems:
+            self.filesystems = find_btrfs_filesystems()
         cmds, todo, mnt = {}, '-', self.slash_mnt
         for idx, fs in enumerate(self.filesystems):
-            if fs.path == mnt.device:
+            if mnt.device in fs.devices:
                 cmd = f'# KEEP {fs.path!r} mounted on /mnt'
             else:
                 cmd = 'umount /dev && ' if mnt.device else ''
-                cmd += f'mount {fs.path} /mnt # {fs.label}'
+                cmd += f'mount {fs.path} /mnt # {fs.label!r}'
             cmds[str(idx)] = cmd
             todo = '0'
         todo = self.do_command(cmds, todo, once=True, force=True)
@@ -140,23 +151,14 @@ class BtrfsRestore:
 
     def get_state(self):
         """ Create a dict of subvolumes that have a snapshots and/or a reverted tip """
-        command_output = subprocess.check_output([
-            'btrfs', 'sub', 'list', '.']).decode('utf-8')
-        lines = command_output.split('\n')
-        # ID 667 gen 216849 top level 5 path eos@my-opt
-        # ID 699 gen 217076 top level 5 path eos@snapshots
-        # ID 782 ... eos@snapshots/eos@root.2024-01-10-174732=Update
-        # ID 791 ... eos@snapshots/eos@root.2024-01-13-084102=Daily
+        # paths are like: eos@my-opt, eos@snapshots,
+        #   eos@snapshots/eos@root.2024-01-10-174732=Update
         subnames = set()
         subs = {}
         reverts = {}
         self.mounted_subpaths = set()
-        for line in lines:
-            mat = re.search(r"\bID\s+(\d+)\b.*\bpath\s+(\S+)", line)
-            if not mat:
-                continue
-            subid = int(mat.group(1))
-            subpath = mat.group(2)
+        for sub in self.backend.list_subvols('.'):
+            subid, subpath = sub.ident, sub.path
             if subid in self.mounted_ids:
                 self.mounted_subpaths.add(subpath)
             basename = os.path.basename(subpath)
@@ -168,8 +170,11 @@ class BtrfsRestore:
                     subnames.add(basename)
                 elif basename.endswith('ToDel'):
                     if subpath not in self.mounted_subpaths:
-                        cmd = f'btrfs sub del "{subpath}"'
-                        os.system(f'set -x; {cmd}')
+                        print(f'+ btrfs sub del "{subpath}"')
+                        try:
+                            self.backend.delete(subpath)
+                        except BackendError as exce:
+                            print(f'WARNING: {exce}')
                     continue
                 continue
             if parent.endswith('@snapshots'):
@@ -177,7 +182,8 @@ class BtrfsRestore:
                 if len(wds) > 1:
                     subvol = wds[0]
                     sub_snaps = subs.get(subvol, [])
-                    sub_snaps.append(subpath)
+                    sub_snaps.append(SimpleNamespace(path=subpath,
+                            epoch=whence_epoch(basename))) # parsed just once
                     subs[subvol] = sub_snaps
         rv = {}
         for name in sorted(subnames):
@@ -185,59 +191,323 @@ class BtrfsRestore:
             revert = reverts.get(name, None)
             if sub_snaps or revert:
                 rv[name] = SimpleNamespace(
-                    revert=revert, snaps=sorted(sub_snaps))
+                    revert=revert, snaps=TimeIndex(sub_snaps))
 
         # for name, ns in rv.items(): print(f'{name}: {ns}')
         return rv
 
-    def select_restores(self, todo='a'):
-        """ TBD """
+    def make_actions(self, subs):
+        """ Build the possible actions keyed by menu key. Each action has
+        the 'steps' to apply it; see apply_steps() for the step kinds.
+        Steps that cannot be undone (deletes, the /efi sync) are 'commit'
+        steps run only after every marked action applied cleanly."""
         def advance(key, lead):
-            return Menu.get_next_key(key), ' '*len(lead)
+            key = Menu.get_next_key(key)
+            while key in self.reserved_keys:
+                key = Menu.get_next_key(key)
+            return key, ' '*len(lead)
 
-        def sync_cmd(subvol, whence):
-            sync, efi_back = '', os.path.join(whence, '.efi-back')
-            if os.path.isdir(efi_back) and subvol == self.root_subvol:
-                sync = f'rsync -a -del -H "{efi_back}/" "/efi/" && '
-            return sync
+        def step(op, src, dst=None, commit=False, mounted=False):
+            return SimpleNamespace(op=op, src=src, dst=dst,
+                                   commit=commit, mounted=mounted)
 
-        # pylint: disable=too-many-branches
-        os.chdir('/mnt')
-        subs = self.get_state()
-        key, cmds = 'a', {}
+        def sync_steps(subvol, whence):
+            if (subvol == self.root_subvol
+                    and os.path.isdir(os.path.join(whence, '.efi-back'))):
+                return [step('sync', os.path.join(subvol, '.efi-back'),
+                             '/efi', commit=True)]
+            return []
 
+        def retire_steps(subvol):
+            # the current subvol is deleted only when all went well
+            to_del = f'{subvol}.{timestamp_str()}=ToDel'
+            return [step('rename', subvol, to_del),
+                    step('delete', to_del, commit=True,
+                         mounted=subvol in self.mounted_subpaths)]
+
+        def action(subvol, kind, target, descr, steps):
+            return SimpleNamespace(subvol=subvol, kind=kind, target=target,
+                                   descr=descr, steps=steps)
+
+        key, actions, now = 'a', {}, time.time()
         for subvol, ns in subs.items():
             lead = f'{subvol}'
             if ns.revert:
-                run = sync_cmd(subvol, ns.revert)
-                if subvol in self.mounted_subpaths:
-                    run += f' mv "{subvol}" "{subvol}.ToDel" && '
-                else:
-                    run += f' btrfs sub del "{subvol}" && '
-                run += f'mv "{ns.revert}" "{subvol}"'
-                cmds[key] = [f'{lead}: revert {ns.revert}', run]
+                steps = retire_steps(subvol)
+                steps += [step('rename', ns.revert, subvol)]
+                steps += sync_steps(subvol, ns.revert)
+                actions[key] = action(subvol, 'revert', ns.revert,
+                                      f'{lead}: revert {ns.revert}', steps)
                 key, lead = advance(key, lead)
                 if ns.revert not in self.mounted_subpaths:
-                    cmds[key] = [
-                        f'{lead}: del {ns.revert}',
-                        f'btrfs sub del "{ns.revert}"',
-                    ]
+                    actions[key] = action(subvol, 'del', ns.revert,
+                            f'{lead}: del {ns.revert}',
+                            [step('delete', ns.revert, commit=True)])
                     key, lead = advance(key, lead)
-                prep = f'btrfs sub del "{subvol}" && '
+                prep = retire_steps(subvol)
             else:
-                prep = f'mv "{subvol}" "{subvol}.{timestamp_str()}=Reverted" && '
+                prep = [step('rename', subvol,
+                             f'{subvol}.{timestamp_str()}=Reverted')]
 
             for snap in ns.snaps:
-                snap_base = os.path.basename(snap)
-                sync = sync_cmd(subvol, snap)
-
-                cmds[key] = [
-                    f'{lead}: restore {snap_base} {ago_whence(snap_base)}', # prompt
-                    f'{prep}{sync}btrfs sub snap "{snap}" "{subvol}"', # actual cmd
-                ]
+                snap_base = os.path.basename(snap.path)
+                ago = '' if snap.epoch is None else ago_str(now - snap.epoch)
+                steps = prep + [step('snap', snap.path, subvol)]
+                steps += sync_steps(subvol, snap.path)
+                actions[key] = action(subvol, 'restore', snap.path,
+                            f'{lead}: restore {snap_base} {ago}', steps)
                 key, lead = advance(key, lead)
-        cmds[key] = 'reboot now'
-        return self.do_command(cmds, once=True, todo=todo)
+        return actions
+
+    @staticmethod
+    def step_str(step):
+        """ Shell-like description of a step (for plans and tracing)."""
+        if step.op == 'rename':
+            return f'mv "{step.src}" "{step.dst}"'
+        if step.op == 'snap':
+            return f'btrfs sub snap "{step.src}" "{step.dst}"'
+        if step.op == 'delete':
+            return f'btrfs sub del "{step.src}"'
+        return f'rsync -a --del -H "{step.src}/" "{step.dst}/"'
+
+    def apply_step(self, step):
+        """ Apply one step; raises on failure."""
+        print('+', self.step_str(step), flush=True)
+        if step.op == 'rename':
+            self.backend.rename(step.src, step.dst)
+        elif step.op == 'snap':
+            self.backend.snapshot(step.src, step.dst, readonly=False)
+        elif step.op == 'delete':
+            if step.mounted:
+                print(f'   (mounted; {step.src!r} is removed on a later run)')
+                return
+            self.backend.delete(step.src)
+        elif step.op == 'sync':
+            subprocess.run(['rsync', '-a', '--del', '-H',
+                            f'{step.src}/', f'{step.dst}/'], check=True)
+
+    def undo_step(self, step):
+        """ Reverse an applied (non-commit) step."""
+        if step.op == 'rename':
+            print('- undo:', f'mv "{step.dst}" "{step.src}"', flush=True)
+            self.backend.rename(step.dst, step.src)
+        elif step.op == 'snap':
+            print('- undo:', f'btrfs sub del "{step.dst}"', flush=True)
+            self.backend.delete(step.dst)
+
+    def run_plan(self, plan):
+        """ Execute the actions (at most one per subvol) as one transaction:
+         - apply the reversible steps; each subvol concurrently,
+         - if any fails, undo every applied step (newest first), else
+         - run the commit steps (deletes concurrently; /efi sync last).
+        Returns 'ok', 'rolled_back' (nothing changed), or 'sync_failed'
+        (restored, but the /efi sync failed after the commit)."""
+        def apply_action(action):
+            done = []
+            try:
+                for step in action.steps:
+                    if not step.commit:
+                        self.apply_step(step)
+                        done.append(step)
+                return done, None
+            except Exception as exce:
+                return done, exce
+
+        def commit_action(action):
+            for step in action.steps:
+                if step.commit and step.op == 'delete':
+                    self.apply_step(step)
+
+        if self.dry_run:
+            for action in plan:
+                for step in action.steps:
+                    print('WOULD +', self.step_str(step))
+            return 'ok'
+
+        with ThreadPoolExecutor(max_workers=max(len(plan), 1)) as pool:
+            results = list(pool.map(apply_action, plan))
+        failures = [(act, res[1]) for act, res in zip(plan, results) if res[1]]
+        if failures:
+            for action, exce in failures:
+                print(f'FAILED: {action.descr.strip()}: {exce}')
+            print('ROLLING BACK ...')
+            for done, _ in results:
+                for step in reversed(done):
+                    try:
+                        self.undo_step(step)
+                    except Exception as exce:
+                        print(f'ERROR: undo failed: {exce}')
+            return 'rolled_back'
+
+        status = 'ok'
+        with ThreadPoolExecutor(max_workers=max(len(plan), 1)) as pool:
+            for future in [pool.submit(commit_action, x) for x in plan]:
+                try:
+                    future.result()
+                except Exception as exce: # applied ... just a leftover
+                    print(f'WARNING: cleanup failed: {exce}')
+        for action in plan:
+            for step in action.steps:
+                if step.commit and step.op == 'sync':
+                    try:
+                        self.apply_step(step)
+                    except Exception as exce:
+                        print(f'ERROR: /efi sync failed: {exce}')
+                        status = 'sync_failed'
+        return status
+
+    def select_restores(self, todo='a'):
+        """ Let the user mark actions (one per subvol), show the combined
+        plan, and run it as one transaction.  Returns the next key."""
+        os.chdir('/mnt')
+        subs = self.get_state()
+        actions = self.make_actions(subs)
+        reboot_key = Menu.get_next_key(list(actions)[-1]) if actions else 'a'
+        while reboot_key in self.reserved_keys:
+            reboot_key = Menu.get_next_key(reboot_key)
+
+        while True:
+            marked = {x.subvol: x for x in actions.values()
+                      if self.marks.get(x.subvol) == (x.kind, x.target)}
+            prompts = {}
+            for key, action in actions.items():
+                box = '[*]' if marked.get(action.subvol) is action else '[ ]'
+                prompts[key] = (f'{box} {action.descr}', action)
+            prompts[reboot_key] = 'reboot now'
+            prompts['z'] = (f'RUN the {len(marked)} marked action(s)'
+                            if marked else '# (select entries to mark them)')
+            menu, choice = self.run_menu(prompts, todo)
+            todo = choice.next
+            if choice.payload: # toggle the mark (one per subvol)
+                action = choice.payload
+                ident = (action.kind, action.target)
+                if self.marks.get(action.subvol) == ident:
+                    del self.marks[action.subvol]
+                else:
+                    self.marks[action.subvol] = ident
+                continue
+            if choice.key == 'z':
+                if marked and self.confirm_plan(list(marked.values())):
+                    self.run_plan(list(marked.values()))
+                    self.marks = {}
+                    input('Press ENTER to continue ... ')
+                    return 'a' # rescan once after the whole plan
+                continue
+            cmd = menu.get_command(choice)
+            if self.dry_run:
+                print(f'WOULD + {cmd}')
+            elif self.check_bootable():
+                os.system(f'clear;set -x; {cmd}')
+            return todo
+
+    def confirm_plan(self, plan):
+        """ Show the combined plan and ask whether to run it."""
+        os.system('clear')
+        print('\nPLAN' + (' (DRY-RUN)' if self.dry_run else '') + ':')
+        for action in plan:
+            print(f'  {action.descr.strip()}')
+            for step in action.steps:
+                when = '   (after all succeed)' if step.commit else ''
+                print(f'      {self.step_str(step)}{when}')
+        menu = Menu({'g': 'GO: run the plan above', 'c': 'CANCEL'},
+                    'g', title='confirm plan')
+        return menu.prompt() == 'g'
+
+    def mount_device(self, spec):
+        """ Ensure the filesystem given by device path, label, or UUID
+        (or the only one, if spec is empty) is mounted on /mnt.
+        Returns the filesystem namespace or raises ValueError."""
+        if not self.filesystems:
+            self.filesystems = find_btrfs_filesystems()
+        if spec:
+            fss = [x for x in self.filesystems
+                   if spec in x.devices or spec in (x.label, x.uuid)]
+        elif any(self.slash_mnt.device in x.devices for x in self.filesystems):
+            fss = [x for x in self.filesystems if self.slash_mnt.device in x.devices]
+        else:
+            fss = self.filesystems
+        if len(fss) != 1:
+            raise ValueError(f'--device {spec!r} matches {len(fss)} BTRFS filesystems'
+                + ''.join(f'\n  {x.path} label={x.label!r} uuid={x.uuid}'
+                          for x in self.filesystems))
+        fs = fss[0]
+        if self.slash_mnt.device not in fs.devices:
+            if self.slash_mnt.device:
+                subprocess.run(['umount', '/mnt'], check=True)
+            subprocess.run(['mount', fs.path, '/mnt'], check=True)
+            self.slash_mnt = SimpleNamespace(device=fs.path, fstype='btrfs')
+        return fs
+
+    @staticmethod
+    def resolve_restore(spec, subs, actions):
+        """ Find the action for a --restore spec of the forms:
+          SUBVOL=SNAPSHOT (name or path), SUBVOL=latest:LABEL, SUBVOL=revert
+        Raises ValueError if it cannot be resolved."""
+        subvol, _, what = spec.partition('=')
+        if not what or subvol not in subs:
+            raise ValueError(f'--restore {spec!r}: unknown subvol'
+                             f' (have: {" ".join(subs) or "none"})')
+        if what == 'revert':
+            kind, target = 'revert', subs[subvol].revert
+        elif what.startswith('latest:'):
+            label = what[len('latest:'):].lstrip('=')
+            snaps = [x for x in subs[subvol].snaps if not label # eldest first
+                     or os.path.basename(x.path).endswith(f'={label}')]
+            kind, target = 'restore', snaps[-1].path if snaps else None
+        else:
+            snaps = [x for x in subs[subvol].snaps
+                     if os.path.basename(x.path) == os.path.basename(what)]
+            kind, target = 'restore', snaps[-1].path if snaps else None
+        for action in actions.values():
+            if (action.subvol, action.kind, action.target) == (subvol, kind, target):
+                return action
+        raise ValueError(f'--restore {spec!r}: no such {kind} for {subvol}')
+
+    def batch_restore(self, opts):
+        """ Non-interactive restore; returns the exit code:
+          0: OK (or plan shown w/o --yes), 1: failed (rolled back or an
+          unexpected error), 2: bad arguments / nothing to do, 3: restored
+          but the /efi sync failed."""
+        result = SimpleNamespace(device='', plan=[], dry_run=self.dry_run
+                                 or not opts.yes, ok=False, status='', bootable=None, error='')
+        out = sys.stdout
+        try:
+            with contextlib.redirect_stdout(sys.stderr if opts.json else out):
+                code = self._batch_restore(opts, result)
+        except (ValueError, BackendError, subprocess.CalledProcessError) as exce:
+            result.error, result.status, code = str(exce), 'bad_args', 2
+            if not opts.json:
+                print(f'ERROR: {exce}', file=sys.stderr)
+        except Exception as exce: # e.g., an OSError mounting or in /mnt
+            result.error, result.status, code = f'{type(exce).__name__}: {exce}', 'error', 1
+            print(traceback.format_exc(), file=sys.stderr)
+        if opts.json:
+            print(json.dumps(vars(result), indent=2), file=out)
+        return code
+
+    def _batch_restore(self, opts, result):
+        fs = self.mount_device(opts.device)
+        result.device = fs.path
+        os.chdir('/mnt')
+        subs = self.get_state()
+        actions = self.make_actions(subs)
+        plan = [self.resolve_restore(x, subs, actions) for x in opts.restore]
+        subvols = [x.subvol for x in plan]
+        if len(set(subvols)) != len(subvols):
+            raise ValueError('more than one --restore for the same subvol')
+        result.plan = [{'subvol': x.subvol, 'kind': x.kind, 'target': x.target,
+                        'steps': [self.step_str(y) for y in x.steps]} for x in plan]
+        print(f'PLAN for {fs.path} (label={fs.label!r}):')
+        for action in plan:
+            print(f'  {action.descr.strip()}')
+        if result.dry_run:
+            self.dry_run = True
+        result.status = self.run_plan(plan)
+        result.ok = result.status == 'ok'
+        result.bootable = self.check_bootable()
+        print({'ok': 'OK', 'rolled_back': 'FAILED (rolled back)',
+               'sync_failed': 'RESTORED, but the /efi sync FAILED'}[result.status])
+        return {'ok': 0, 'rolled_back': 1, 'sync_failed': 3}[result.status]
 
     def main(self):
         """ The top-level function. """
@@ -246,8 +516,37 @@ class BtrfsRestore:
         parser = argparse.ArgumentParser()
         parser.add_argument('-n', '--dry-run', action="store_true",
                 help='do NOT do anything')
+        parser.add_argument('--slow-console', action="store_true",
+                help='minimal-bytes menu redraws (e.g., for serial/IPMI consoles)')
+        parser.add_argument('--device', type=str, default='',
+                help='non-interactive: BTRFS device, label, or UUID to mount on /mnt')
+        parser.add_argument('--restore', type=str, action='append', default=[],
+                metavar='SUBVOL=SNAPSHOT',
+                help='non-interactive: restore SUBVOL from SNAPSHOT (a name,'
+                     ' "latest:LABEL", or "revert"); repeatable')
+        parser.add_argument('-y', '--yes', action="store_true",
+                help='non-interactive: actually run the plan (else just show it)')
+        parser.add_argument('--json', action="store_true",
+                help='non-interactive: print the result as JSON on stdout')
+        parser.add_argument('--profile', type=str, default='', metavar='TRACE_JSON',
+                help='record wall/CPU time per phase and external command to this'
+                     ' Chrome trace file and print a summary at exit')
+        parser.add_argument('--profile-mem', action="store_true",
+                help='with --profile, also record tracemalloc peaks per phase')
+        parser.add_argument('--backend', choices=('cli', 'ioctl'), default='cli',
+                help='how to list/snapshot/delete subvolumes: run "btrfs" (the'
+                     ' default) or call the kernel ioctls directly')
         opts = parser.parse_args()
+        self.backend = make_backend(opts.backend)
+        if opts.profile:
+            profiler.start(opts.profile, trace_malloc=opts.profile_mem)
+            profiler.instrument(self, ('select_mount', 'get_state', 'make_actions',
+                    'check_bootable', 'run_plan', 'apply_step', 'undo_step', 'mount_device'))
+            profiler.instrument(self.backend, ('list_subvols', 'snapshot', 'delete', 'rename'))
         self.dry_run = opts.dry_run
+        Menu.minimal = opts.slow_console
+        if opts.restore:
+            sys.exit(self.batch_restore(opts))
         self.select_mount()
         os.system('clear')
         todo = 'a'
@@ -271,6 +570,7 @@ def run():
     except Exception as exce:
         print("exception:", str(exce))
         print(traceback.format_exc())
+        sys.exit(15)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+my-snaps replicate: copy the snapshots in /.snapshots to another local
+BTRFS (e.g., a backup disk) with "btrfs send | btrfs receive".
+
+ - each snapshot is sent incrementally (-p) from the closest snapshot
+   of the same subvolume already replicated (nearest older, else
+   nearest newer), so streams hold only the differences,
+ - send writes straight into receive through a pipe enlarged to
+   --pipe-mib (so neither stalls on small writes); Python only waits,
+ - the snapshots of independent subvolumes replicate concurrently
+   (those of one subvolume in order, as each is the next one's parent),
+ - what was replicated is recorded in a state file on the destination
+   so reruns only transfer new snapshots (snapshots received but not
+   recorded, e.g., when killed in between, are adopted; partial ones
+   are removed and sent again).
+"""
+# pylint: disable=invalid-name,too-many-instance-attributes,import-outside-toplevel
+# pylint: disable=consider-using-with
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from my_snaps.MyUtils import whence_epoch, snapshot_subvol
+from my_snaps.Backends import CliBackend, BackendError
+from my_snaps.Profiler import profiler
+
+F_SETPIPE_SZ = 1031 # fcntl.F_SETPIPE_SZ (named only in python >= 3.10)
+
+class Replicator:
+    """ Replicates snapshots from snap_dir into dest_dir. """
+    state_name = '.my-snaps-replicated.json'
+
+    def __init__(self, snap_dir, dest_dir, jobs=2, pipe_mib=16, dry_run=False, say=print):
+        self.snap_dir, self.dest_dir = snap_dir, dest_dir
+        self.jobs, self.pipe_bytes = max(1, jobs), pipe_mib << 20
+        self.dry_run, self.say = dry_run, say
+        self.backend = CliBackend()
+        self.lock = threading.Lock()
+        self.state_path = os.path.join(dest_dir, self.state_name)
+        self.state = self.load_state()
+        self.adopt_received()
+
+    def load_state(self):
+        """ {snapshot name: {parent, seconds, when}} of the replicated
+        ones still present on the destination."""
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            state = {}
+        return {k: v for k, v in state.items()
+                if os.path.isdir(os.path.join(self.dest_dir, k))}
+
+    def received(self, path):
+        """ Whether path is a subvolume that "btrfs receive" completed
+        (i.e., it has a received UUID; a partial one does not)."""
+        try:
+            lines = self.backend.run(['btrfs', 'sub', 'show', path])
+        except BackendError:
+            return False
+        for line in lines: # Received UUID:         8e5d1c0f-...  (or "-")
+            key, _, value = line.strip().partition(':')
+            if key == 'Received UUID':
+                return value.strip() not in ('', '-')
+        return False
+
+    def adopt_received(self):
+        """ Add the snapshots received but not recorded (e.g., killed
+        before the state was saved) to the state so they are not sent
+        again (which "btrfs receive" would refuse forever)."""
+        adopted = [x for x in os.listdir(self.dest_dir)
+                   if x not in self.state and snapshot_subvol(x)
+                   and os.path.isdir(os.path.join(self.dest_dir, x))
+                   and self.received(os.path.join(self.dest_dir, x))]
+        for name in adopted:
+            self.say(f'NOTE: {name} was received w/o being recorded; adopting it')
+            self.state[name] = {'parent': None, 'adopted': int(time.time())}
+        if adopted and not self.dry_run:
+            self.save_state()
+
+    def save_state(self):
+        """ Write the state file atomically (called under the lock)."""
+        tmp_path = f'{self.state_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(self.state, fh, indent=1, sort_keys=True)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def plan(self, subvols=None):
+        """ {subvol: [names eldest first]} of the snapshots to replicate."""
+        rv = {}
+        for name in os.listdir(self.snap_dir):
+            subvol = snapshot_subvol(name)
+            if (not subvol or name in self.state or (subvols and subvol not in subvols)
+                    or not os.path.isdir(os.path.join(self.snap_dir, name))):
+                continue
+            rv.setdefault(subvol, []).append(name)
+        for names in rv.values():
+            names.sort(key=whence_epoch)
+        return rv
+
+    def pick_parent(self, name):
+        """ The replicated snapshot of the same subvolume (and still in
+        snap_dir) closest in time to name: the newest older one, else
+        the eldest newer one; None for a full send."""
+        subvol, epoch = snapshot_subvol(name), whence_epoch(name)
+        with self.lock:
+            candidates = [x for x in self.state if snapshot_subvol(x) == subvol
+                          and os.path.isdir(os.path.join(self.snap_dir, x))]
+        older = [x for x in candidates if whence_epoch(x) < epoch]
+        if older:
+            return max(older, key=whence_epoch)
+        newer = [x for x in candidates if whence_epoch(x) > epoch]
+        return min(newer, key=whence_epoch) if newer else None
+
+    def _pipe(self):
+        """ A pipe enlarged (as allowed) to pipe_bytes."""
+        import fcntl
+        rfd, wfd = os.pipe()
+        try:
+            fcntl.fcntl(wfd, F_SETPIPE_SZ, self.pipe_bytes)
+        except OSError: # over /proc/sys/fs/pipe-max-size w/o privilege
+            pass
+        return rfd, wfd
+
+    def send_one(self, name):
+        """ Replicate one snapshot; returns True on success."""
+        parent = self.pick_parent(name)
+        src = os.path.join(self.snap_dir, name)
+        send_cmd = ['btrfs', 'send', '-q'] + (
+            ['-p', os.path.join(self.snap_dir, parent)] if parent else []) + [src]
+        recv_cmd = ['btrfs', 'receive', self.dest_dir]
+        how = f'incremental from {parent}' if parent else 'full'
+        if self.dry_run:
+            self.say(f'WOULD send {name} ({how})')
+            with self.lock: # as the parent of the next (never saved)
+                self.state[name] = {'parent': parent}
+            return True
+        partial = os.path.join(self.dest_dir, name)
+        if os.path.isdir(partial): # left by an interrupted receive (never completed)
+            self.say(f'NOTE: removing the partial {partial!r} of an earlier run')
+            try:
+                self.backend.delete(partial)
+            except BackendError as exc:
+                self.say(f'FAILED: {name}: cannot remove partial {partial!r}: {exc}')
+                return False
+        started = time.monotonic()
+        with profiler.phase('send_receive'), tempfile.TemporaryFile() as err_fh:
+            rfd, wfd = self._pipe()
+            try:
+                recv = subprocess.Popen(recv_cmd, stdin=rfd, stdout=subprocess.DEVNULL,
+                                        stderr=err_fh)
+                send = subprocess.Popen(send_cmd, stdout=wfd, stderr=err_fh)
+            finally:
+                os.close(rfd)
+                os.close(wfd)
+            send.wait()
+            recv.wait()
+            err_fh.seek(0)
+            err = err_fh.read().decode('utf-8', 'replace').strip().splitlines()
+        if send.returncode or recv.returncode:
+            self.say(f'FAILED: {name} ({how}): {err[-1] if err else "?"}')
+            if os.path.isdir(partial):
+                try:
+                    self.backend.delete(partial)
+                except BackendError as exc:
+                    self.say(f'WARNING: cannot remove partial {partial!r}: {exc}')
+            return False
+        seconds = round(time.monotonic() - started, 3)
+        with self.lock:
+            self.state[name] = {'parent': parent, 'seconds': seconds, 'when': int(time.time())}
+            self.save_state()
+        self.say(f'OK: {name} ({how}) in {seconds:.1f}s')
+        return True
+
+    def replicate_subvol(self, names):
+        """ Replicate the snapshots of one subvolume in order (stopping at
+        the first failure as later ones would lack their parent)."""
+        done = 0
+        for name in names:
+            if not self.send_one(name):
+                break
+            done += 1
+        return done
+
+    def run(self, subvols=None):
+        """ Replicate everything new; returns (done, wanted) counts."""
+        plan = self.plan(subvols)
+        wanted = sum(len(x) for x in plan.values())
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            done = sum(pool.map(self.replicate_subvol, plan.values()))
+        return done, wanted
+
+def main(argv):
+    """ Parse the "replicate" arguments and run it; returns the exit code."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='my-snaps replicate',
+            description='replicate new snapshots to another local BTRFS via send/receive')
+    parser.add_argument('--to', type=str, required=True, metavar='DEST_DIR',
+            help='directory on the backup BTRFS to receive the snapshots into')
+    parser.add_argument('--snap-dir', type=str, default='/.snapshots',
+            help='where the snapshots are [dflt=/.snapshots]')
+    parser.add_argument('--subvol', type=str, action='append', default=[],
+            help='replicate only snapshots of this subvolume (e.g., eos@root); repeatable')
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+            help='subvolumes replicated concurrently [dflt=2]')
+    parser.add_argument('--pipe-mib', type=int, default=16,
+            help='send-to-receive pipe buffer in MiB [dflt=16]')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+            help='just show what would be sent and from which parent')
+    parser.add_argument('--profile', type=str, default='', metavar='TRACE_JSON',
+            help='record wall/CPU time per phase and external command to this'
+                 ' Chrome trace file and print a summary at exit')
+    opts = parser.parse_args(argv)
+    if opts.profile:
+        profiler.start(opts.profile)
+    if not os.path.isdir(opts.to):
+        print(f'ERROR: {opts.to!r} is not a directory', file=sys.stderr)
+        return 2
+    replicator = Replicator(opts.snap_dir, opts.to, jobs=opts.jobs,
+                            pipe_mib=opts.pipe_mib, dry_run=opts.dry_run)
+    started = time.monotonic()
+    done, wanted = replicator.run(set(opts.subvol))
+    print(f'replicated {done} of {wanted} new snapshot(s)'
+          f' in {time.monotonic() - started:.1f}s')
+    return 0 if done == wanted else 1
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Cross-snapshot file version index: "my-snaps index" walks each new
+snapshot once and records its catalog (path, inode, size, mtime, ctime)
+in an SQLite database as version ranges, i.e., a file unchanged across
+consecutive snapshots of a subvolume is one row spanning them; so,
+"my-snaps versions PATH" lists the distinct versions of a file (and
+which snapshots hold each) with one indexed lookup.
+
+Indexing is incremental: snapshots already indexed are skipped, those
+newer than the newest indexed extend the ranges, and one that sorts
+before it (rare) rebuilds that subvolume's ranges.  Snapshots since
+deleted are marked so (keeping their sequence numbers unique) and are
+left out of the results.
+"""
+# pylint: disable=invalid-name,import-outside-toplevel
+import os
+import sys
+import stat
+import time
+import sqlite3
+from my_snaps.MyUtils import whence_epoch, human, snapshot_subvol
+from my_snaps.Profiler import profiler
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY, subvol TEXT NOT NULL, name TEXT NOT NULL UNIQUE,
+    seq INTEGER NOT NULL, epoch REAL, files INTEGER, indexed REAL,
+    present INTEGER NOT NULL DEFAULT 1);
+CREATE TABLE IF NOT EXISTS paths (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS versions (
+    path_id INTEGER NOT NULL, subvol TEXT NOT NULL,
+    first_seq INTEGER NOT NULL, last_seq INTEGER NOT NULL,
+    ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, kind TEXT);
+CREATE INDEX IF NOT EXISTS versions_by_path ON versions (path_id, subvol);
+CREATE INDEX IF NOT EXISTS versions_by_last ON versions (subvol, last_seq, path_id);
+"""
+
+class VersionIndex:
+    """ The database and the indexing/querying of it. """
+    batch = 5000 # catalog rows per executemany()
+
+    def __init__(self, db_path, say=print):
+        self.db_path, self.say = db_path, say
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+    @staticmethod
+    def walk(root):
+        """ Yield (relative path, stat) of everything under root w/o
+        crossing into other filesystems or nested subvolumes."""
+        root_dev = os.lstat(root).st_dev
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            try:
+                with os.scandir(os.path.join(root, rel)) as entries:
+                    for entry in entries:
+                        sub_rel = f'{rel}/{entry.name}' if rel else entry.name
+                        st = entry.stat(follow_symlinks=False)
+                        yield sub_rel, st
+                        if stat.S_ISDIR(st.st_mode) and st.st_dev == root_dev:
+                            stack.append(sub_rel)
+            except OSError:
+                continue # vanished or unreadable
+
+    @staticmethod
+    def kind_of(mode):
+        """ 'f', 'd', 'l', or 'o' (other)."""
+        return ('d' if stat.S_ISDIR(mode) else 'f' if stat.S_ISREG(mode)
+                else 'l' if stat.S_ISLNK(mode) else 'o')
+
+    def _load_catalog(self, snap_path):
+        """ Fill the temp table 'cur' with the snapshot's catalog."""
+        db = self.db
+        db.execute('DROP TABLE IF EXISTS temp.cur')
+        db.execute('CREATE TEMP TABLE cur (path TEXT PRIMARY KEY, ino INTEGER, size INTEGER,'
+                   ' mtime_ns INTEGER, ctime_ns INTEGER, kind TEXT, path_id INTEGER)')
+        rows, count = [], 0
+        for rel, st in self.walk(snap_path):
+            rows.append(('/' + rel, st.st_ino, st.st_size, st.st_mtime_ns,
+                         st.st_ctime_ns, self.kind_of(st.st_mode)))
+            if len(rows) >= self.batch:
+                db.executemany('INSERT INTO cur (path, ino, size, mtime_ns, ctime_ns, kind)'
+                               ' VALUES (?,?,?,?,?,?)', rows)
+                count, rows = count + len(rows), []
+        db.executemany('INSERT INTO cur (path, ino, size, mtime_ns, ctime_ns, kind)'
+                       ' VALUES (?,?,?,?,?,?)', rows)
+        db.execute('INSERT OR IGNORE INTO paths (path) SELECT path FROM cur')
+        db.execute('UPDATE cur SET path_id = (SELECT id FROM paths WHERE paths.path = cur.path)')
+        return count + len(rows)
+
+    def add_snapshot(self, subvol, name, snap_path, epoch):
+        """ Index one snapshot as the newest of its subvolume; unchanged
+        files extend their version's range, others start a new one."""
+        db = self.db
+        prev = db.execute('SELECT MAX(seq) FROM snapshots WHERE subvol=?',
+                          (subvol,)).fetchone()[0] or 0
+        seq = prev + 1
+        with profiler.phase('index_walk'):
+            count = self._load_catalog(snap_path)
+        with profiler.phase('index_merge'):
+            db.execute('CREATE INDEX temp.cur_by_id ON cur (path_id)')
+            db.execute("""UPDATE versions SET last_seq = ?
+                WHERE subvol = ? AND last_seq = ? AND EXISTS (SELECT 1 FROM cur
+                    WHERE cur.path_id = versions.path_id AND cur.ino = versions.ino
+                    AND cur.size = versions.size AND cur.mtime_ns = versions.mtime_ns
+                    AND cur.ctime_ns = versions.ctime_ns)""", (seq, subvol, prev))
+            db.execute("""INSERT INTO versions (path_id, subvol, first_seq, last_seq,
+                    ino, size, mtime_ns, ctime_ns, kind)
+                SELECT path_id, ?, ?, ?, ino, size, mtime_ns, ctime_ns, kind FROM cur
+                WHERE NOT EXISTS (SELECT 1 FROM versions v WHERE v.subvol = ?
+                    AND v.last_seq = ? AND v.path_id = cur.path_id)""",
+                       (subvol, seq, seq, subvol, seq))
+            db.execute('INSERT INTO snapshots (subvol, name, seq, epoch, files, indexed)'
+                       ' VALUES (?,?,?,?,?,?)', (subvol, name, seq, epoch, count, time.time()))
+            db.execute('DROP TABLE temp.cur')
+        db.commit()
+        return count
+
+    def _forget_subvol(self, subvol):
+        self.db.execute('DELETE FROM versions WHERE subvol=?', (subvol,))
+        self.db.execute('DELETE FROM snapshots WHERE subvol=?', (subvol,))
+        self.db.commit()
+
+    def update(self, snap_dir):
+        """ Index the snapshots in snap_dir not yet indexed; returns the
+        number indexed."""
+        present = {} # subvol => [(epoch, name)]
+        for name in os.listdir(snap_dir):
+            subvol = snapshot_subvol(name)
+            if subvol and os.path.isdir(os.path.join(snap_dir, name)):
+                present.setdefault(subvol, []).append((whence_epoch(name), name))
+        names = {name for snaps in present.values() for _, name in snaps}
+        known = {} # name => (subvol, epoch) of those indexed
+        for subvol, name, epoch in self.db.execute(
+                'SELECT subvol, name, epoch FROM snapshots').fetchall():
+            known[name] = (subvol, epoch)
+            if name not in names: # deleted (its seq is skipped in the results)
+                self.db.execute('UPDATE snapshots SET present=0 WHERE name=?', (name,))
+        self.db.commit()
+        added = 0
+        for subvol, snaps in sorted(present.items()):
+            snaps.sort()
+            newest = max((e for s, e in known.values() if s == subvol), default=None)
+            todo = [x for x in snaps if x[1] not in known]
+            if newest is not None and any(e < newest for e, _ in todo):
+                self.say(f'NOTE: {subvol}: an older snapshot appeared; reindexing it')
+                self._forget_subvol(subvol)
+                todo = snaps
+            for epoch, name in todo:
+                started = time.monotonic()
+                count = self.add_snapshot(subvol, name, os.path.join(snap_dir, name), epoch)
+                self.say(f'indexed {name}: {count} entries in {time.monotonic() - started:.1f}s')
+                added += 1
+        return added
+
+    def versions(self, subvol, path):
+        """ [ns(ino, size, mtime_ns, kind, snapshots=[names])] of the
+        distinct versions of path (relative to the subvolume; with a
+        leading '/') in the existing snapshots, eldest first."""
+        from types import SimpleNamespace
+        rv = []
+        names = dict(self.db.execute('SELECT seq, name FROM snapshots'
+                                     ' WHERE subvol=? AND present=1', (subvol,)))
+        for first, last, ino, size, mtime_ns, kind in self.db.execute(
+                """SELECT v.first_seq, v.last_seq, v.ino, v.size, v.mtime_ns, v.kind
+                   FROM versions v JOIN paths p ON p.id = v.path_id
+                   WHERE p.path = ? AND v.subvol = ? ORDER BY v.first_seq""", (path, subvol)):
+            snaps = [names[x] for x in range(first, last + 1) if x in names]
+            if snaps:
+                rv.append(SimpleNamespace(ino=ino, size=size, mtime_ns=mtime_ns,
+                                          kind=kind, snapshots=snaps))
+        return rv
+
+def subvol_of_path(path, proc_mounts='/proc/mounts'):
+    """ (subvolume name, path relative to it) for a path on a mounted
+    BTRFS subvolume (per the longest matching mount point)."""
+    path, best = os.path.abspath(path), ('', '', path)
+    with open(proc_mounts, 'r', encoding='utf-8') as fh:
+        for line in fh:
+            wds = line.split()
+            if len(wds) < 4 or wds[2] != 'btrfs':
+                continue
+            mount = wds[1]
+            if path == mount or path.startswith(mount.rstrip('/') + '/'):
+                subvols = [x[7:] for x in wds[3].split(',') if x.startswith('subvol=')]
+                if subvols and len(mount) > len(best[0]):
+                    rel = '/' + path[len(mount):].lstrip('/')
+                    best = (mount, os.path.basename(subvols[0]), rel)
+    return best[1], best[2]
+
+def main(argv):
+    """ "index" or "versions" (per argv[0]); returns the exit code."""
+    import argparse
+    parser = argparse.ArgumentParser(prog=f'my-snaps {argv[0]}')
+    parser.add_argument('--db', type=str, default='/var/lib/my-snaps/versions.db',
+            help='the index database [dflt=/var/lib/my-snaps/versions.db]')
+    if argv[0] == 'index':
+        parser.description = 'index new snapshots (incrementally)'
+        parser.add_argument('--snap-dir', type=str, default='/.snapshots',
+                help='where the snapshots are [dflt=/.snapshots]')
+        parser.add_argument('--profile', type=str, default='', metavar='TRACE_JSON',
+                help='record wall/CPU time per phase to this Chrome trace file')
+        opts = parser.parse_args(argv[1:])
+        if opts.profile:
+            profiler.start(opts.profile)
+        started = time.monotonic()
+        count = VersionIndex(opts.db).update(opts.snap_dir)
+        print(f'indexed {count} new snapshot(s) in {time.monotonic() - started:.1f}s')
+        return 0
+
+    parser.description = 'list the distinct versions of a file across the snapshots'
+    parser.add_argument('path', help='the file (e.g., /etc/fstab)')
+    parser.add_argument('--subvol', type=str, default='',
+            help='the subvolume (e.g., eos@root) with path relative to it'
+                 ' [dflt: per /proc/mounts]')
+    opts = parser.parse_args(argv[1:])
+    if opts.subvol:
+        subvol, rel = opts.subvol, '/' + opts.path.lstrip('/')
+    else:
+        subvol, rel = subvol_of_path(opts.path)
+    if not subvol or not os.path.exists(opts.db):
+        print(f'ERROR: no subvolume for {opts.path!r} or no index {opts.db!r}', file=sys.stderr)
+        return 2
+    started = time.monotonic()
+    versions = VersionIndex(opts.db).versions(subvol, rel)
+    for idx, ver in enumerate(versions):
+        span = ver.snapshots[0] + (f' .. {ver.snapshots[-1]}' if len(ver.snapshots) > 1 else '')
+        mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ver.mtime_ns / 1e9))
+        print(f'v{idx + 1}: {human(ver.size):>7} mtime={mtime}'
+              f' ino={ver.ino} in {len(ver.snapshots)} snapshot(s): {span}')
+    print(f'# {len(versions)} version(s) of {subvol}:{rel} in'
+          f' {(time.monotonic() - started) * 1000:.1f}ms', file=sys.stderr)
+    return 0 if versions else 1
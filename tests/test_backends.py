@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Tests of the IoctlBackend tree searches against a fake kernel that
+emulates BTRFS_IOC_TREE_SEARCH (whole-key ranges, the transid filter,
+and results limited to what fits the 4KiB buffer) so searches must
+continue across several calls.
+
+    PYTHONPATH=src python3 -m unittest discover -s tests
+"""
+# pylint: disable=invalid-name,protected-access,missing-function-docstring
+import os
+import struct
+import unittest
+from my_snaps.Backends import IoctlBackend
+
+class FakeKernelBackend(IoctlBackend):
+    """ An IoctlBackend whose TREE_SEARCH is served from 'items', a list
+    of (objectid, type, offset, transid, data) of one tree. """
+    def __init__(self, items, per_call=None):
+        self.items = sorted(items, key=lambda x: x[:3])
+        self.per_call = per_call # fewer items per call than fit (if set)
+        self.calls = 0
+
+    def _ioctl(self, fd, nr, buf, what, write_only=False):
+        assert nr == 17, what
+        self.calls += 1
+        assert self.calls < 1000, 'the search does not end'
+        (tree_id, min_objectid, max_objectid, min_offset, max_offset, min_transid,
+         max_transid, min_type, max_type, nr_items, _) = self.SEARCH_KEY.unpack_from(buf)
+        lo, hi = (min_objectid, min_type, min_offset), (max_objectid, max_type, max_offset)
+        pos, found = self.SEARCH_KEY.size, 0
+        for objectid, item_type, offset, transid, data in self.items:
+            if not lo <= (objectid, item_type, offset) <= hi:
+                continue
+            if not min_transid <= transid <= max_transid:
+                continue
+            size = self.SEARCH_HEADER.size + len(data)
+            if (pos + size > self.ARGS_SIZE or found >= nr_items
+                    or (self.per_call and found >= self.per_call)):
+                break
+            self.SEARCH_HEADER.pack_into(buf, pos, transid, objectid, offset,
+                                         item_type, len(data))
+            buf[pos + self.SEARCH_HEADER.size:pos + size] = data
+            pos, found = pos + size, found + 1
+        self.SEARCH_KEY.pack_into(buf, 0, tree_id, min_objectid, max_objectid, min_offset,
+                                  max_offset, min_transid, max_transid, min_type,
+                                  max_type, found, 0)
+
+    @staticmethod
+    def _open_dir(path):
+        return os.open('/', os.O_RDONLY | os.O_DIRECTORY)
+
+    def _ino_lookup(self, fd, tree_id, dirid):
+        return ''
+
+def root_item(gen):
+    return bytes(160) + struct.pack('=Q', gen) + bytes(271)
+
+def root_ref(name, dirid=256):
+    return struct.pack('=QQH', dirid, 0, len(name)) + name.encode()
+
+def file_extent(gen, nbytes):
+    """ A regular (non-inline) btrfs_file_extent_item."""
+    return struct.pack('=QQBBHB', gen, nbytes, 0, 0, 0, 1) + struct.pack(
+        '=QQQQ', 0, nbytes, 0, nbytes)
+
+class TestTreeSearch(unittest.TestCase):
+    """ Continuation of the searches across calls. """
+    def test_list_subvols_ends(self):
+        backend = IoctlBackend
+        items = [(5, backend.ROOT_ITEM_KEY, 0, 1, root_item(7))]
+        for ident in range(256, 266):
+            items += [(5, backend.ROOT_REF_KEY, ident, 1, root_ref(f'sub{ident}')),
+                      (ident, backend.ROOT_ITEM_KEY, 0, 1, root_item(ident)),
+                      (ident, 144, 5, 1, root_ref(f'sub{ident}'))] # ROOT_BACKREF
+        for per_call in (None, 1, 2, 3):
+            fake = FakeKernelBackend(items, per_call=per_call)
+            subvols = fake.list_subvols('/')
+            self.assertEqual([x.ident for x in subvols], list(range(256, 266)))
+            self.assertEqual([x.path for x in subvols], [f'sub{x}' for x in range(256, 266)])
+            self.assertEqual([x.gen for x in subvols], list(range(256, 266)))
+
+    def test_changed_extents_batch_ends_mid_inode(self):
+        backend, items, want = IoctlBackend, [], {}
+        for ino in range(257, 400):
+            items += [(ino, 1, 0, 20, bytes(160)), # INODE_ITEM
+                      (ino, 12, 256, 20, b'\0' * 12)] # INODE_REF
+            for offset in (0, 4096, 8192):
+                gen = 15 + ino % 10
+                items.append((ino, backend.EXTENT_DATA_KEY, offset, gen, file_extent(gen, 1024)))
+                if gen > 16:
+                    want[gen] = want.get(gen, 0) + 1024
+        for per_call in (None, 1, 2, 4, 5):
+            fake = FakeKernelBackend(items, per_call=per_call)
+            self.assertEqual(fake.changed_extents('/', 16), want, f'{per_call=}')
+
+if __name__ == '__main__':
+    unittest.main()